@@ -0,0 +1,211 @@
+
+# Standard library modules
+from collections import namedtuple
+import argparse
+import os
+
+# Count the allocations of the compiled functions (numba.core.runtime.rtsys),
+# which has to be enabled before numba is imported
+os.environ.setdefault('NUMBA_NRT_STATS', '1')
+
+# External modules
+import numba
+import numba.core.runtime
+import numpy as np
+
+# Own modules
+import model.data
+import model.fixed
+import model.ingest
+import model.initialization
+import model.optimization
+import model.prior
+import model.profiling
+import model.scheduling
+import model.state
+
+import settings
+
+# Numpy settings
+np.seterr(divide='raise', over='raise', under='ignore', invalid='raise')
+
+# Get user arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-MODEL', type=str, default='FULL')
+parser.add_argument('-M', type=int)
+parser.add_argument('-THREADS', type=int, nargs='+')
+parser.add_argument('-N_REPEAT', type=int, default=3)
+parser.add_argument(
+    '-LAYOUTS',
+    type=str,
+    nargs='+',
+    default=['separate'],
+    choices=['separate', 'interleaved'],
+)
+parser.add_argument(
+    '-PRECISIONS',
+    type=str,
+    nargs='+',
+    default=[settings.MISC['local_precision']],
+    choices=['float64', 'float32'],
+)
+parser_args = parser.parse_args()
+
+MODEL = parser_args.MODEL
+M = parser_args.M
+THREADS = parser_args.THREADS
+N_REPEAT = parser_args.N_REPEAT
+LAYOUTS = parser_args.LAYOUTS
+PRECISIONS = parser_args.PRECISIONS
+
+assert MODEL in ['FULL', 'CTM', 'LDA_X'], \
+    'Valid options for MODEL argument are FULL, CTM, or LDA_X'
+assert M >= 2, \
+    'M should be an integer larger than or equal to 2'
+
+if THREADS is None:
+    THREADS = [
+        n_threads for n_threads in model.profiling.THREAD_COUNTS
+        if n_threads <= numba.config.NUMBA_NUM_THREADS
+    ]
+
+EMULATE_LDA_X = MODEL == 'LDA_X'
+
+# Use the saved dataset of estimate.py, created first if it does not exist
+DATASET_FOLDER = model.ingest.prepare_dataset(
+    y_csv=settings.Y_CSV,
+    x_csv=settings.X_CSV,
+    h_csv=settings.H_CSV,
+    cache_folder=settings.CACHE_FOLDER,
+    datasets_folder=settings.DATASET_FOLDER,
+    index_folder=settings.INDEX_FOLDER,
+    emulate_lda_x=EMULATE_LDA_X,
+    raw_ids=settings.RAW_IDS,
+    out_of_core_index=settings.OUT_OF_CORE_INDEX,
+    compact_data=settings.COMPACT_DATA,
+    float32_regressors=settings.FLOAT32_REGRESSORS,
+)
+data = model.data.load_dataset(folder=DATASET_FOLDER)
+
+vi_settings = namedtuple('SettingsVI', settings.VI)(**settings.VI)
+misc_settings = namedtuple('SettingsMisc', settings.MISC)(**settings.MISC)
+
+is_fixed, fixed_values = model.fixed.create_fixed(
+    emulate_lda_x=EMULATE_LDA_X,
+    no_dynamics=MODEL == 'CTM',
+    no_regressors=False,
+    dim_i=data.dim_i,
+    dim_x=data.dim_x,
+    dim_h=data.dim_h,
+    M=M,
+)
+
+prior = model.prior.create_prior(
+    is_fixed=is_fixed,
+    dim_j=data.dim_j,
+    dim_x=data.dim_x,
+    dim_h=data.dim_h,
+    M=M,
+)
+
+# Use the C_JM matrix of estimate.py if it exists, the timings do not depend
+# much on the initialization
+INIT_C_JM_FILE = os.path.join(
+    settings.OUTPUT_FOLDER, 'M' + str(M), settings.INIT_C_JM_FILENAME)
+if os.path.exists(INIT_C_JM_FILE):
+    initial_c_jm = np.loadtxt(INIT_C_JM_FILE, dtype=float, delimiter=',')
+else:
+    initial_c_jm = np.random.default_rng(0).random((data.dim_j, M)) + 0.1
+
+q_start = model.state.create_state(
+    state_stub=model.initialization.create_stub_initialization(
+        init_ss_mu_q_alpha_ib=settings.INIT_SS_MU_Q_ALPHA_IB,
+        init_ss_log_sigma_q_alpha_ib=settings.INIT_SS_LOG_SIGMA_Q_ALPHA_IB,
+        c_jm=initial_c_jm,
+        prior=prior,
+        is_fixed=is_fixed,
+        data=data,
+        M=M,
+    ),
+    data=data,
+    prior=prior,
+    is_fixed=is_fixed,
+    fixed_values=fixed_values,
+    M=M,
+)
+
+print('Customers: {}, baskets: {}, M: {}, {} repeats per thread count'.format(
+    data.total_customers, data.total_baskets, M, N_REPEAT))
+print('{:>12} {:>10} {:>8} {:>12} {:>14} {:>10} {:>16} {:>18}'.format(
+    'layout', 'precision', 'threads', 'time (s)', 'baskets/s', 'speedup',
+    'allocations', 'allocs per basket'))
+
+# The speedup is relative to the first row
+reference_time = None
+for n_threads, layout, precision in [
+        (t, l, p) for t in THREADS for l in LAYOUTS for p in PRECISIONS]:
+    numba.set_num_threads(n_threads)
+
+    schedule = model.scheduling.create_schedule(
+        data=data,
+        M=M,
+        n_q_i_steps=vi_settings.n_q_i_steps,
+        n_chunks_per_thread=misc_settings.n_chunks_per_thread,
+        deterministic_counts_phi=misc_settings.deterministic_counts_phi,
+        n_threads=n_threads,
+    )
+
+    local_dtype = np.dtype(precision)
+    if misc_settings.stream_q_z:
+        n_rows_thread = np.max(model.data.unique_purchases_per_customer(data))
+        theta_q_z = np.empty((n_threads * n_rows_thread, M), dtype=local_dtype)
+        counts_phi_thread = np.zeros((n_threads, data.dim_j, M))
+    else:
+        theta_q_z = np.empty((data.total_unique_purchases, M), dtype=local_dtype)
+        counts_phi_thread = np.zeros((0, data.dim_j, M))
+
+    # The first local step compiles the functions, and is not timed
+    times = []
+    allocations = []
+    for repeat in range(N_REPEAT + 1):
+
+        # Every local step starts from the same state
+        q = type(q_start)(*(np.copy(a) for a in q_start))
+        q = q._replace(entropy_q_z=q.entropy_q_z.astype(local_dtype))
+        if layout == 'interleaved':
+            q = model.state.interleave_basket_state(q)
+        tallies = model.optimization.create_tallies(data=data)
+
+        stats_before = numba.core.runtime.rtsys.get_allocation_stats()
+        model.optimization.local_step(
+            q=q,
+            theta_q_z=theta_q_z,
+            counts_phi_thread=counts_phi_thread,
+            stream_q_z=misc_settings.stream_q_z,
+            tallies=tallies,
+            schedule=schedule,
+            data=data,
+            is_fixed=is_fixed,
+            vi_settings=vi_settings,
+            M=M,
+        )
+        stats_after = numba.core.runtime.rtsys.get_allocation_stats()
+
+        if repeat > 0:
+            times.append(tallies['local_step_time'])
+            allocations.append(stats_after.alloc - stats_before.alloc)
+
+    local_step_time = np.median(times)
+    if reference_time is None:
+        reference_time = local_step_time
+
+    print('{:>12} {:>10} {:>8} {:>12.3f} {:>14.0f} {:>10.2f} {:>16.0f} {:>18.2f}'.format(
+        layout,
+        precision,
+        n_threads,
+        local_step_time,
+        data.total_baskets / local_step_time,
+        reference_time / local_step_time,
+        np.median(allocations),
+        np.median(allocations) / data.total_baskets,
+    ))
@@ -1,6 +1,7 @@
 # Standard library modules
 from collections import namedtuple
 import argparse
+import json
 import os
 
 # External modules
@@ -9,6 +10,7 @@ import numpy as np
 # Own modules
 import model.data
 import model.fixed
+import model.ingest
 import model.initialization
 import model.optimization
 import model.prior
@@ -89,21 +91,58 @@ SettingsMisc = namedtuple(
 )
 misc_settings = SettingsMisc(**settings.MISC) # noqa
 
-# Load the (y_fused_ibn, x, h)-data
-y_fused_ibn = np.loadtxt(settings.Y_CSV, dtype=int, delimiter=',')
-x = np.loadtxt(settings.X_CSV, dtype=float, delimiter=',')
-h = np.asfortranarray(np.loadtxt(settings.H_CSV, dtype=float, delimiter=','))
+# Create namedtuple with the SVI settings
+SettingsSVI = namedtuple(
+    typename='SettingsSVI',
+    field_names=settings.SVI,
+)
+svi_settings = SettingsSVI(**settings.SVI) # noqa
+
+# Create namedtuple with the distributed settings
+SettingsDistributed = namedtuple(
+    typename='SettingsDistributed',
+    field_names=settings.DISTRIBUTED,
+)
+distributed_settings = SettingsDistributed(**settings.DISTRIBUTED) # noqa
 
 # Load the C_JM matrix with pseudo-counts from the LDA solution
 initial_c_jm = np.loadtxt(INIT_C_JM_FILE, dtype=float, delimiter=',')
 
-# Create a dataset, based on the (y_fused_ibn, x, h)-data
-data = model.data.create_dataset(
+# Folder of the saved dataset, created first if it does not exist. The
+# dataset only depends on the content of the data files and the options
+# below, such that it is shared by all runs on the same data (e.g. different
+# M, or the FULL and CTM models)
+DATASET_FOLDER = model.ingest.prepare_dataset(
+    y_csv=settings.Y_CSV,
+    x_csv=settings.X_CSV,
+    h_csv=settings.H_CSV,
+    cache_folder=settings.CACHE_FOLDER,
+    datasets_folder=settings.DATASET_FOLDER,
+    index_folder=settings.INDEX_FOLDER,
     emulate_lda_x=EMULATE_LDA_X,
-    y_fused_ibn=y_fused_ibn,
-    x=x,
-    h=h,
+    raw_ids=settings.RAW_IDS,
+    out_of_core_index=settings.OUT_OF_CORE_INDEX,
+    compact_data=settings.COMPACT_DATA,
+    float32_regressors=settings.FLOAT32_REGRESSORS,
 )
+ID_MAP_FOLDER = DATASET_FOLDER + '.id_map'
+
+# Load the dataset as read-only memory maps, shared with concurrent runs
+data = model.data.load_dataset(folder=DATASET_FOLDER)
+
+if settings.RAW_IDS:
+    # Keep the mapping from dense IDs to raw IDs with the output
+    model.ingest.save_id_map(
+        id_map=model.ingest.load_id_map(folder=ID_MAP_FOLDER),
+        folder=os.path.join(MODEL_OUTPUT_FOLDER, 'id_map'),
+    )
+
+# Report the memory footprint of the dataset
+footprint = model.data.memory_footprint(data)
+print('Dataset memory footprint (memory-mapped): {:.1f} MB'.format(sum(footprint.values()) / 1e6))
+for field, n_bytes in sorted(footprint.items(), key=lambda item: -item[1]):
+    if n_bytes >= 1e6:
+        print('    {}: {:.1f} MB'.format(field, n_bytes / 1e6))
 
 # Define fixed parameter values, based on the optimization settings
 is_fixed, fixed_values = model.fixed.create_fixed(
@@ -146,10 +185,9 @@ q = model.state.create_state(
     M=M,
 )
 
-np.savez_compressed(
-    file=os.path.join(MODEL_OUTPUT_FOLDER, 'data.npz'),
-    **data._asdict(),
-)
+# The dataset itself is not copied, only the location of the saved dataset
+with open(os.path.join(MODEL_OUTPUT_FOLDER, 'data.json'), 'w') as f:
+    json.dump({'dataset_folder': os.path.abspath(DATASET_FOLDER)}, f, indent=4)
 
 np.savez_compressed(
     file=os.path.join(MODEL_OUTPUT_FOLDER, 'prior.npz'),
@@ -172,6 +210,16 @@ np.savez_compressed(
     **misc_settings._asdict(),
 )
 
+np.savez_compressed(
+    file=os.path.join(MODEL_OUTPUT_FOLDER, 'svi_settings.npz'),
+    **svi_settings._asdict(),
+)
+
+np.savez_compressed(
+    file=os.path.join(MODEL_OUTPUT_FOLDER, 'distributed_settings.npz'),
+    **distributed_settings._asdict(),
+)
+
 # Model estimation using variational inference
 q, elbo_dict = model.optimization.routine(
     q=q,
@@ -185,4 +233,7 @@ q, elbo_dict = model.optimization.routine(
     n_save_per=N_SAVE_PER,
     misc_settings=misc_settings,
     vi_settings=vi_settings,
+    svi_settings=svi_settings,
+    distributed_settings=distributed_settings,
+    dataset_folder=DATASET_FOLDER,
 )
@@ -21,13 +21,53 @@ import lda
 import lda.utils
 
 # Own modules
+import model.data
+import model.ingest
 import settings
 
 assert lda.__version__ == '2.0.0', 'lda package should be 2.0.0'
 
+def _initialize_tokens(
+        lda_obj,
+        WS,
+        DS,
+        n_documents,
+        n_words,
+):
+    """Vectorized adaptation of the _initialize method for an LDA object.
+
+    Instead of a documents x words matrix, the tokens are given directly as
+    the word (WS) and document (DS) of each token, in the order produced by
+    lda.utils.matrix_to_lists: sorted by document, and per document by word.
+    As in _initialize, token n is assigned to topic n % n_topics.
+    """
+
+    n_topics = lda_obj.n_topics
+    n_tokens = len(WS)
+
+    lda_obj.WS = WS.astype(np.intc)
+    lda_obj.DS = DS.astype(np.intc)
+    lda_obj.ZS = ZS = (np.arange(n_tokens) % n_topics).astype(np.intc)
+
+    lda_obj.nzw_ = np.bincount(
+        ZS.astype(np.int64) * n_words + WS,
+        minlength=n_topics * n_words,
+    ).reshape(n_topics, n_words).astype(np.intc)
+    lda_obj.ndz_ = np.bincount(
+        DS.astype(np.int64) * n_topics + ZS,
+        minlength=n_documents * n_topics,
+    ).reshape(n_documents, n_topics).astype(np.intc)
+    lda_obj.nz_ = np.bincount(ZS, minlength=n_topics).astype(np.intc)
+
+    lda_obj.loglikelihoods_ = []
+
+
 def _fit_alt(
         lda_obj,
-        X,
+        WS,
+        DS,
+        n_documents,
+        n_words,
         output_folder,
         n_burn_in,
 ):
@@ -35,19 +75,30 @@ def _fit_alt(
 
     The change is that the MCMC draws are averaged and saved, instead of just
     storing the final MCMC draw. The first n_burn_in samples are skipped.
+    The LDA object is initialized from a token stream (see _initialize_tokens)
+    instead of a dense documents x words matrix.
 
     The average draw is stored as a J x M CSV of floats.
 
     Parameters
         lda_obj: The LDA object.
-        X: Data as expected by the _fit method of the LDA object.
+        WS: Word (product) of each token (purchase).
+        DS: Document (basket) of each token (purchase).
+        n_documents: Number of documents (baskets).
+        n_words: Number of words (products).
         output_folder: Folder where the average draws are stored
-        save_every_nth: Saves the average over the last n-draws.
+        n_burn_in: Number of draws that are skipped in the average.
     """
 
     random_state = lda.utils.check_random_state(lda_obj.random_state)
     rands = lda_obj._rands.copy()
-    lda_obj._initialize(X)
+    _initialize_tokens(
+        lda_obj=lda_obj,
+        WS=WS,
+        DS=DS,
+        n_documents=n_documents,
+        n_words=n_words,
+    )
 
     # ULSDPB ADDITION: START
 
@@ -85,13 +136,13 @@ def _fit_alt(
 
             assert np.isclose(
                 np.sum(sum_nzw_),
-                np.sum(X) * (lda_obj.n_iter - n_burn_in)
+                len(WS) * (lda_obj.n_iter - n_burn_in)
             )
 
             average_c_jm = sum_nzw_.T / (lda_obj.n_iter - n_burn_in)
             assert np.isclose(
                 np.sum(average_c_jm),
-                np.sum(X)
+                len(WS)
             )
 
             np.savetxt(
@@ -143,19 +194,34 @@ M_OUTPUT_FOLDER = os.path.join(settings.OUTPUT_FOLDER, 'M' + str(M))
 if not os.path.exists(M_OUTPUT_FOLDER):
     os.makedirs(M_OUTPUT_FOLDER)
 
-# Load purchase data
-y = np.loadtxt(settings.Y_CSV, dtype=int, delimiter=',')
+# Load the purchase data from the same prepared dataset as estimate.py, such
+# that the products follow the same (remapped, if settings.RAW_IDS) IDs. The
+# purchases in data.y are sorted per basket, and per basket by product
+DATASET_FOLDER = model.ingest.prepare_dataset(
+    y_csv=settings.Y_CSV,
+    x_csv=settings.X_CSV,
+    h_csv=settings.H_CSV,
+    cache_folder=settings.CACHE_FOLDER,
+    datasets_folder=settings.DATASET_FOLDER,
+    index_folder=settings.INDEX_FOLDER,
+    emulate_lda_x=False,
+    raw_ids=settings.RAW_IDS,
+    out_of_core_index=settings.OUT_OF_CORE_INDEX,
+    compact_data=settings.COMPACT_DATA,
+    float32_regressors=settings.FLOAT32_REGRESSORS,
+)
+data = model.data.load_dataset(folder=DATASET_FOLDER)
 
 # Get dimensions
-total_baskets = len(np.unique(y[:, 1]))
-dim_j = len(np.unique(y[:, 2]))
-
-# Convert to conventional purchase matrix
-purchases = np.zeros((total_baskets, dim_j), dtype=np.int64)
-
-ib = 0
-for i, ib, y_ibn in y:
-    purchases[ib, y_ibn] += 1
+total_baskets = data.total_baskets
+dim_j = data.dim_j
+
+# Tokens for the LDA model: the product and basket of each purchase
+products_per_purchase = np.asarray(data.y)
+baskets_per_purchase = np.repeat(
+    np.arange(total_baskets),
+    np.asarray(data.ib_to_ibn_ub) - data.ib_to_ibn_lb,
+)
 
 # Create LDA object
 lda_object = lda.LDA(
@@ -172,7 +238,10 @@ t_start = time.time()
 
 _fit_alt(
     lda_obj=lda_object,
-    X=purchases,
+    WS=products_per_purchase,
+    DS=baskets_per_purchase,
+    n_documents=total_baskets,
+    n_words=dim_j,
     output_folder=M_OUTPUT_FOLDER,
     n_burn_in=N_BURN,
 )
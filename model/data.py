@@ -5,26 +5,57 @@ Description:
 Functions:
     create_dataset: creates a dataset for the CTM model using
     the (y_fused_ibn, x, h)-data as input.
+
+    create_dataset_from_index: creates a dataset for the CTM model using
+    a PurchaseIndex (sorted purchases and CSR-style offsets) and the
+    (x, h)-data as input.
+
+    compact_dataset: converts a dataset to a compact layout, with 32-bit
+    integer IDs and counts and optionally 32-bit floating point regressors.
+
+    memory_footprint: returns the number of bytes used per field of a dataset.
+
+    unique_purchases_per_customer: returns the number of entries of y_unique
+    per customer.
+
+    subset_indices: returns the baskets and the entries of y_unique of a
+    subset of the customers.
+
+    subset_dataset: returns the dataset of a subset of the customers.
+
+    append_to_dataset: appends new baskets of existing customers and new
+    customers to a dataset.
+
+    save_dataset: saves a dataset as a folder of uncompressed .npy arrays.
+
+    load_dataset: loads a dataset saved by save_dataset, as read-only memory
+    maps by default.
 """
 
 # Standard library modules
 from collections import namedtuple
+import json
+import os
+import shutil
 
 # External modules
 import numpy as np
 
 
+OUTER_CHUNK_ROWS = 1 << 16
+
+
 Data = namedtuple(
     'Data',
     (
         # data
         'y',
+        'y_unique', # y with the repeated products per basket collapsed
+        'multiplicity', # number of purchases per entry of y_unique
         'x',
         'h',
-        'x_outer',
         'x_outer_sum_first',
         'x_outer_sum_not_first',
-        'h_outer',
         'h_outer_sum_first',
         'h_outer_sum_not_first',
         'h_per_basket',
@@ -42,11 +73,14 @@ Data = namedtuple(
         'total_customers',
         'total_baskets',
         'total_purchases',
-        # maps from i->ib and from ib->ibn
+        'total_unique_purchases',
+        # maps from i->ib, from ib->ibn and from ib->iu (y_unique)
         'i_to_ib_lb',
         'i_to_ib_ub',
         'ib_to_ibn_lb',
         'ib_to_ibn_ub',
+        'ib_to_iu_lb',
+        'ib_to_iu_ub',
         # indicators
         'ib_first',
         'ib_not_first',
@@ -56,6 +90,54 @@ Data = namedtuple(
 )
 
 
+PurchaseIndex = namedtuple(
+    'PurchaseIndex',
+    (
+        'y', # products, sorted per basket
+        'n_per_product',
+        # maps from i->ib and from ib->ibn
+        'i_to_ib_lb',
+        'i_to_ib_ub',
+        'ib_to_ibn_lb',
+        'ib_to_ibn_ub',
+    )
+)
+
+
+def _sum_outer(a, weights):
+    # Computes sum_r weights[r] * outer(a[r], a[r]) in blocks of rows, such
+    # that the per-row outer products are never stored
+    result = np.zeros((a.shape[1], a.shape[1]))
+    for lb in range(0, a.shape[0], OUTER_CHUNK_ROWS):
+        a_chunk = np.asarray(a[lb:lb + OUTER_CHUNK_ROWS], dtype=float)
+        weights_chunk = weights[lb:lb + OUTER_CHUNK_ROWS, np.newaxis]
+        result += a_chunk.T @ (a_chunk * weights_chunk)
+    return result
+
+
+def _collapse_purchases(y, ib_to_ibn_lb):
+    # Collapses repeated products within a basket (adjacent, as y is sorted
+    # per basket) to (product, multiplicity) pairs
+    total_purchases = len(y)
+    is_new_iu = np.empty(total_purchases, dtype=bool)
+    is_new_iu[0] = True
+    for lb in range(1, total_purchases, OUTER_CHUNK_ROWS):
+        ub = min(lb + OUTER_CHUNK_ROWS, total_purchases)
+        np.not_equal(y[lb:ub], y[lb - 1:ub - 1], out=is_new_iu[lb:ub])
+    is_new_iu[ib_to_ibn_lb] = True
+
+    iu_to_ibn_lb = np.flatnonzero(is_new_iu)
+    total_unique_purchases = len(iu_to_ibn_lb)
+
+    y_unique = np.asarray(y[iu_to_ibn_lb])
+    multiplicity = np.diff(np.append(iu_to_ibn_lb, total_purchases))
+
+    ib_to_iu_lb = np.searchsorted(iu_to_ibn_lb, ib_to_ibn_lb)
+    ib_to_iu_ub = np.append(ib_to_iu_lb[1:], total_unique_purchases)
+
+    return y_unique, multiplicity, ib_to_iu_lb, ib_to_iu_ub
+
+
 def create_dataset(
         emulate_lda_x, # boolean, set to true if we collapse to LDA-X
         y_fused_ibn,
@@ -64,159 +146,157 @@ def create_dataset(
 ):
 
     # Get the (i, ib, y_ibn) vectors from the purchase data
-    i_vec = np.copy(y_fused_ibn[:, 0]) # customer IDs
-    ib_vec = np.copy(y_fused_ibn[:, 1]) # basket IDs  
-    y = np.copy(y_fused_ibn[:, 2]) # Product IDs
+    i_vec = np.array(y_fused_ibn[:, 0], dtype=int) # customer IDs
+    ib_vec = np.array(y_fused_ibn[:, 1], dtype=int) # basket IDs
+    y = np.array(y_fused_ibn[:, 2], dtype=int) # Product IDs
 
     if emulate_lda_x:
         # Set basket IDs to customer IDs, collapse to LDA-X
-        ib_vec[:] = np.copy(i_vec)
-        x = np.zeros((len(np.unique(ib_vec)), 1)) # Create an empty x vector, no trip-specific variables 
-
-    # Assert that the customer ID's and basket ID's are sorted in ascendingo order
-    assert np.all(i_vec[1:] - i_vec[:-1] >= 0) 
-    assert np.all(ib_vec[1:] - ib_vec[:-1] >= 0) # baskets per customer should be chronologically sorted 
+        ib_vec[:] = i_vec
 
-    # Various dimensions
-    total_customers = len(np.unique(i_vec)) 
-    total_baskets = len(np.unique(ib_vec))
     total_purchases = len(y)
 
-    dim_i = total_customers
-    dim_j = len(np.unique(y)) # unique products 
-    dim_x = x.shape[1] # number of columns of x vector 
-    dim_h = h.shape[1] # number of columns of h vector 
+    # Positions where a new customer/basket starts in the purchase data
+    is_new_i = np.empty(total_purchases, dtype=bool)
+    is_new_i[0] = True
+    np.not_equal(i_vec[1:], i_vec[:-1], out=is_new_i[1:])
+
+    is_new_ib = np.empty(total_purchases, dtype=bool)
+    is_new_ib[0] = True
+    np.not_equal(ib_vec[1:], ib_vec[:-1], out=is_new_ib[1:])
+
+    # Assert that the customer ID's and basket ID's are sorted in ascending
+    # order, and that they are contiguous (no missing values)
+    assert i_vec[0] == 0 and np.all(np.diff(i_vec) >= 0)
+    assert ib_vec[0] == 0 and np.all(np.diff(ib_vec) >= 0) # baskets per customer should be chronologically sorted
+    assert np.all(np.diff(i_vec[is_new_i]) == 1)
+    assert np.all(np.diff(ib_vec[is_new_ib]) == 1)
+
+    # A basket belongs to a single customer
+    assert np.all(is_new_ib[is_new_i])
 
-    # Assert that customer, basket, and product IDs are contiguous (no missing or duplicate values)
-    assert np.all(np.isin(np.arange(dim_i), i_vec)) 
-    assert np.all(np.isin(np.arange(total_baskets), ib_vec))
-    assert np.all(np.isin(np.arange(dim_j), y))
+    # ib_to_ibn_lb, ib_to_ibn_ub
+    ib_to_ibn_lb = np.flatnonzero(is_new_ib)
+    ib_to_ibn_ub = np.append(ib_to_ibn_lb[1:], total_purchases)
+
+    # i_to_ib_lb, i_to_ib_ub
+    i_to_ib_lb = np.flatnonzero(is_new_i[ib_to_ibn_lb])
+    i_to_ib_ub = np.append(i_to_ib_lb[1:], len(ib_to_ibn_lb))
 
     # n_per_product. Calculate the number of purchases per product
-    n_per_product = np.zeros(dim_j, dtype=int)
-    for y_ibn in y:
-        n_per_product[y_ibn] += 1
+    n_per_product = np.bincount(y)
+
+    # Sort the purchases per basket, the baskets themselves are already sorted
+    y = y[np.lexsort((y, ib_vec))]
 
-    # n_per_customer. Calculcating number of purchases per customer.  
-    # lb, ub arrays are computed to determine the lower and upper bounds of purchase indices for each customer. 
-    # these arrays help in calculating the number of purchases per customer.
-    i_to_ibn_lb = np.zeros(total_customers, dtype=int)
-    i_to_ibn_ub = np.zeros(total_customers, dtype=int)
+    index = PurchaseIndex(
+        y=y,
+        n_per_product=n_per_product,
+        i_to_ib_lb=i_to_ib_lb,
+        i_to_ib_ub=i_to_ib_ub,
+        ib_to_ibn_lb=ib_to_ibn_lb,
+        ib_to_ibn_ub=ib_to_ibn_ub,
+    )
 
-    previous_i = i_vec[0]
-    for ibn, i in enumerate(i_vec):
-        if i != previous_i:
-            i_to_ibn_ub[previous_i] = ibn
-            i_to_ibn_lb[i] = ibn
-            previous_i = i
+    return create_dataset_from_index(
+        emulate_lda_x=emulate_lda_x,
+        index=index,
+        x=x,
+        h=h,
+    )
 
-    i_to_ibn_ub[-1] = total_purchases
 
-    n_per_customer = i_to_ibn_ub - i_to_ibn_lb # number of purchases of each customer 
+def create_dataset_from_index(
+        emulate_lda_x, # boolean, set to true if the index was built for LDA-X
+        index,
+        x,
+        h,
+):
+    """Creates a dataset from a PurchaseIndex and the (x, h)-data.
 
-    # dim_b, dim_b_min_1. Amount of products per basket of a customer. 
-    dim_b = np.zeros(total_customers, dtype=int)
+    The arrays of the index are used as they are, such that the purchase
+    stream can stay a (read-only) memory map of an index created by
+    model.ingest.load_purchase_index.
+    """
 
-    for i in range(total_customers):
-        dim_b[i] = len(np.unique(ib_vec[i_to_ibn_lb[i]:i_to_ibn_ub[i]]))
+    y = index.y
+    n_per_product = index.n_per_product
+    i_to_ib_lb = index.i_to_ib_lb
+    i_to_ib_ub = index.i_to_ib_ub
+    ib_to_ibn_lb = index.ib_to_ibn_lb
+    ib_to_ibn_ub = index.ib_to_ibn_ub
 
-    dim_b_min_1 = dim_b.astype(float) - 1.0
+    # Various dimensions
+    total_purchases = len(y)
+    total_customers = len(i_to_ib_lb)
+    total_baskets = len(ib_to_ibn_lb)
 
-    # ib_to_ibn_lb, ib_to_ibn_ub, n_per_basket, dim_n
-    # Calculate the lower and upper bounds of purchase indices for each basket
-    ib_to_ibn_lb = np.zeros(total_baskets, dtype=int)
-    ib_to_ibn_ub = np.zeros(total_baskets, dtype=int)
+    if emulate_lda_x:
+        x = np.zeros((total_customers, 1)) # Create an empty x vector, no trip-specific variables
 
-    previous_ib = ib_vec[0]
-    for ibn, ib in enumerate(ib_vec):
-        if ib != previous_ib:
-            ib_to_ibn_ub[previous_ib] = ibn
-            ib_to_ibn_lb[ib] = ibn
-            previous_ib = ib
+    dim_i = total_customers
+    dim_j = len(n_per_product) # unique products
+    dim_x = x.shape[1] # number of columns of x vector
+    dim_h = h.shape[1] # number of columns of h vector
 
-    ib_to_ibn_ub[-1] = total_purchases
+    # Assert that product IDs are contiguous (no missing values)
+    assert np.all(n_per_product > 0)
 
-    dim_n = (ib_to_ibn_ub - ib_to_ibn_lb).astype(dtype=float)
+    # dim_b, dim_b_min_1. Number of baskets per customer
+    dim_b = np.asarray(i_to_ib_ub - i_to_ib_lb)
+    dim_b_min_1 = dim_b.astype(float) - 1.0
 
-    # Sort the purchases per basket
-    for ib in range(total_baskets):
-        y[ib_to_ibn_lb[ib]:ib_to_ibn_ub[ib]] = np.sort(
-            y[ib_to_ibn_lb[ib]:ib_to_ibn_ub[ib]]
-        )
+    dim_n = np.asarray(ib_to_ibn_ub - ib_to_ibn_lb).astype(dtype=float)
 
-    # i_to_ib_lb, i_to_ib_ub
-    i_to_ib_lb = np.zeros(total_customers, dtype=int)
-    i_to_ib_lb[0] = 0
-    i_to_ib_lb[1:] = np.cumsum(dim_b)[:-1]
-    i_to_ib_ub = np.cumsum(dim_b)
+    # n_per_customer. Number of purchases per customer
+    n_per_customer = np.asarray(
+        ib_to_ibn_ub[i_to_ib_ub - 1] - ib_to_ibn_lb[i_to_ib_lb]
+    )
 
     # ib_first, ib_not_first, ib_last, ib_not_last
-    # Calculate indicators for first and last baskets
-    ib_first = np.zeros(total_baskets, dtype=bool) 
-    ib_not_first = np.zeros(total_baskets, dtype=bool) 
+    ib_first = np.zeros(total_baskets, dtype=bool)
+    ib_first[i_to_ib_lb] = True
+    ib_not_first = ~ib_first
 
     ib_last = np.zeros(total_baskets, dtype=bool)
-    ib_not_last = np.zeros(total_baskets, dtype=bool)
-
-    ib = 0
-    for i in range(dim_i):
-        for b in range(dim_b[i]):
-            if b == 0:
-                ib_first[ib] = True # ib_first are the first baskets 
-                ib_not_first[ib] = False
-            else:
-                ib_first[ib] = False
-                ib_not_first[ib] = True # ib_not_first are all not first baskets 
-
-            if b == (dim_b[i] - 1):
-                ib_last[ib] = True # ib_last are all last baskets 
-                ib_not_last[ib] = False 
-            else:
-                ib_last[ib] = False 
-                ib_not_last[ib] = True # ib_not_last are all not last baskets 
-            ib += 1
-
-    # x_outer, x_outer_sum_first, x_outer_sum_not_first (baskets)
-    x_outer = np.zeros((total_baskets, dim_x, dim_x))
-    for ib in range(total_baskets):
-        x_outer[ib] = np.outer(x[ib], x[ib])
-    x_outer_sum_first = np.sum(x_outer[ib_first], axis=0) 
-    x_outer_sum_not_first = np.sum(x_outer[ib_not_first], axis=0)
-
-    # h_outer, h_outer_sum_first, h_outer_sum_not_first (baskets)
-    h_outer = np.zeros((total_customers, dim_h, dim_h))
-    for i in range(total_customers):
-        h_outer[i] = np.outer(h[i], h[i])
-    h_outer_sum_first = np.sum(h_outer, axis=0)
-    h_outer_sum_not_first = np.sum(
-        h_outer * (dim_b[:, np.newaxis, np.newaxis] - 1.0),
-        axis=0,
-    )
+    ib_last[i_to_ib_ub - 1] = True
+    ib_not_last = ~ib_last
+
+    # x_outer_sum_first, x_outer_sum_not_first (baskets)
+    x_outer_sum_first = _sum_outer(x, ib_first)
+    x_outer_sum_not_first = _sum_outer(x, ib_not_first)
+
+    # h_outer_sum_first, h_outer_sum_not_first (baskets)
+    h_outer_sum_first = _sum_outer(h, np.ones(total_customers))
+    h_outer_sum_not_first = _sum_outer(h, dim_b_min_1)
 
     # Create the h_per_basket matrix to relate customer-specific variables to each basket
-    h_per_basket = np.zeros((total_baskets, dim_h))
-    ib = 0
-    for i in range(total_customers):
-        for b in range(dim_b[i]):
-            h_per_basket[ib] = h[i]
-            ib += 1
+    h_per_basket = np.ascontiguousarray(np.repeat(h, dim_b, axis=0))
+
+    # y_unique, multiplicity, ib_to_iu_lb, ib_to_iu_ub
+    y_unique, multiplicity, ib_to_iu_lb, ib_to_iu_ub = _collapse_purchases(
+        y=y,
+        ib_to_ibn_lb=ib_to_ibn_lb,
+    )
+
+    assert x.shape[0] == total_baskets
+    assert h.shape[0] == total_customers
 
     # Emulate LDA-X specific conditions
     if emulate_lda_x:
-        assert x.shape == (total_customers, 1) # assures x has total_customers rows and 1 column 
-        assert np.allclose(x, 0.0) # ensures all x values are close to zero, meaning no trip-specific variables 
+        assert x.shape == (total_customers, 1) # assures x has total_customers rows and 1 column
+        assert np.allclose(x, 0.0) # ensures all x values are close to zero, meaning no trip-specific variables
         assert total_customers == total_baskets # each customer only has one basket, as in LDA-X
-        assert np.all(i_vec == ib_vec) # verifies that each basket is associated with its corresponding customer
 
     data = Data(
         # data
         y=y,
+        y_unique=y_unique,
+        multiplicity=multiplicity,
         x=x,
         h=h,
-        x_outer=x_outer,
         x_outer_sum_first=x_outer_sum_first,
         x_outer_sum_not_first=x_outer_sum_not_first,
-        h_outer=h_outer,
         h_outer_sum_first=h_outer_sum_first,
         h_outer_sum_not_first=h_outer_sum_not_first,
         h_per_basket=h_per_basket,
@@ -234,11 +314,450 @@ def create_dataset(
         total_customers=total_customers,
         total_baskets=total_baskets,
         total_purchases=total_purchases,
-        # maps from i->ib and from ib->ibn
+        total_unique_purchases=len(y_unique),
+        # maps from i->ib, from ib->ibn and from ib->iu (y_unique)
+        i_to_ib_lb=i_to_ib_lb,
+        i_to_ib_ub=i_to_ib_ub,
+        ib_to_ibn_lb=ib_to_ibn_lb,
+        ib_to_ibn_ub=ib_to_ibn_ub,
+        ib_to_iu_lb=ib_to_iu_lb,
+        ib_to_iu_ub=ib_to_iu_ub,
+        # indicators
+        ib_first=ib_first,
+        ib_not_first=ib_not_first,
+        ib_last=ib_last,
+        ib_not_last=ib_not_last,
+    )
+
+    return data
+
+
+def _smallest_int_dtype(max_value):
+    # 32-bit integers when all values fit, 64-bit integers otherwise
+    if max_value <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+def compact_dataset(
+        data,
+        float32_regressors=False,
+):
+    """Converts a dataset to a compact layout.
+
+    IDs, offsets and counts are stored as 32-bit integers when they fit,
+    and dim_n is stored as an integer count instead of a float. With
+    float32_regressors, x, h and the derived per-basket/per-customer arrays
+    are stored as 32-bit floats. The sums x_outer_sum_* and h_outer_sum_*
+    are computed before the conversion and stay 64-bit floats.
+
+    Arrays that are memory-mapped (see create_dataset_from_index) are kept
+    as they are, such that they are never loaded into memory.
+    """
+
+    purchase_dtype = _smallest_int_dtype(data.total_purchases)
+    basket_dtype = _smallest_int_dtype(data.total_baskets)
+    product_dtype = _smallest_int_dtype(data.dim_j)
+
+    dtypes = {
+        'y': product_dtype,
+        'y_unique': product_dtype,
+        'multiplicity': purchase_dtype,
+        'dim_b': basket_dtype,
+        'dim_n': purchase_dtype,
+        'n_per_customer': purchase_dtype,
+        'n_per_product': purchase_dtype,
+        'i_to_ib_lb': basket_dtype,
+        'i_to_ib_ub': basket_dtype,
+        'ib_to_ibn_lb': purchase_dtype,
+        'ib_to_ibn_ub': purchase_dtype,
+        'ib_to_iu_lb': purchase_dtype,
+        'ib_to_iu_ub': purchase_dtype,
+    }
+
+    if float32_regressors:
+        dtypes.update({
+            'x': np.float32,
+            'h': np.float32,
+            'h_per_basket': np.float32,
+        })
+
+    compact = {}
+    for field, dtype in dtypes.items():
+        value = getattr(data, field)
+        if isinstance(value, np.memmap):
+            continue
+        # Keep the memory order of the array, h is stored in column-major order
+        compact[field] = value.astype(dtype, order='K', copy=False)
+
+    return data._replace(**compact)
+
+
+def memory_footprint(data):
+    """Returns a dictionary with the number of bytes used per field."""
+
+    return {
+        field: np.asarray(value).nbytes
+        for field, value in data._asdict().items()
+    }
+
+
+def unique_purchases_per_customer(data):
+    """Returns the number of entries of y_unique per customer."""
+
+    return (
+        data.ib_to_iu_ub[data.i_to_ib_ub - 1].astype(np.int64)
+        -
+        data.ib_to_iu_lb[data.i_to_ib_lb]
+    )
+
+
+def _concatenate_ranges(lb, n):
+    # The indices lb[k], ..., lb[k] + n[k] - 1 of all ranges k, in order
+    n = np.asarray(n, dtype=np.int64)
+    start = np.cumsum(n) - n
+    return (
+        np.arange(np.sum(n), dtype=np.int64)
+        + np.repeat(np.asarray(lb, dtype=np.int64) - start, n)
+    )
+
+
+def subset_indices(
+        data,
+        customers,
+):
+    """Returns the baskets and the entries of y_unique of a subset of the
+    customers (sorted IDs) in data, in order.
+    """
+
+    baskets = _concatenate_ranges(
+        data.i_to_ib_lb[customers], data.dim_b[customers])
+    unique_purchases = _concatenate_ranges(
+        data.ib_to_iu_lb[baskets],
+        data.ib_to_iu_ub[baskets] - data.ib_to_iu_lb[baskets],
+    )
+
+    return baskets, unique_purchases
+
+
+def subset_dataset(
+        data,
+        customers,
+):
+    """Returns the dataset of a subset of the customers.
+
+    Parameters
+        data: The dataset.
+        customers: The sorted IDs of the customers in the subset, which are
+            the customers 0, 1, ... of the returned dataset.
+
+    Also returns the baskets and the entries of y_unique of the subset in
+    data, to gather and scatter the per-basket and per-purchase fields of a
+    variational state (see model.state.subset_state). The counts, sums and
+    indicators are those of the subset, and the integer and floating point
+    types of data are kept.
+    """
+
+    customers = np.asarray(customers)
+    dim_b = np.asarray(data.dim_b[customers])
+    baskets, unique_purchases = subset_indices(
+        data=data,
+        customers=customers,
+    )
+    n_per_basket = data.ib_to_ibn_ub[baskets] - data.ib_to_ibn_lb[baskets]
+    n_unique_per_basket = data.ib_to_iu_ub[baskets] - data.ib_to_iu_lb[baskets]
+    purchases = _concatenate_ranges(data.ib_to_ibn_lb[baskets], n_per_basket)
+
+    total_customers = len(customers)
+    total_baskets = len(baskets)
+
+    y = np.asarray(data.y[purchases])
+    y_unique = np.asarray(data.y_unique[unique_purchases])
+    x = np.asarray(data.x[baskets])
+    h = np.asarray(data.h[customers])
+    dim_b_min_1 = dim_b.astype(float) - 1.0
+
+    # maps from i->ib, from ib->ibn and from ib->iu (y_unique)
+    i_to_ib_ub = np.cumsum(dim_b).astype(data.i_to_ib_ub.dtype)
+    i_to_ib_lb = i_to_ib_ub - dim_b.astype(i_to_ib_ub.dtype)
+    ib_to_ibn_ub = np.cumsum(n_per_basket).astype(data.ib_to_ibn_ub.dtype)
+    ib_to_ibn_lb = ib_to_ibn_ub - n_per_basket.astype(ib_to_ibn_ub.dtype)
+    ib_to_iu_ub = np.cumsum(n_unique_per_basket).astype(data.ib_to_iu_ub.dtype)
+    ib_to_iu_lb = ib_to_iu_ub - n_unique_per_basket.astype(ib_to_iu_ub.dtype)
+
+    # ib_first, ib_not_first, ib_last, ib_not_last
+    ib_first = np.asarray(data.ib_first[baskets])
+    ib_last = np.asarray(data.ib_last[baskets])
+
+    subset = data._replace(
+        # data
+        y=y,
+        y_unique=y_unique,
+        multiplicity=np.asarray(data.multiplicity[unique_purchases]),
+        x=x,
+        h=h,
+        x_outer_sum_first=_sum_outer(x, ib_first),
+        x_outer_sum_not_first=_sum_outer(x, ~ib_first),
+        h_outer_sum_first=_sum_outer(h, np.ones(total_customers)),
+        h_outer_sum_not_first=_sum_outer(h, dim_b_min_1),
+        h_per_basket=np.asarray(data.h_per_basket[baskets]),
+        # dimensions
+        dim_i=total_customers,
+        dim_b=dim_b,
+        dim_b_min_1=dim_b_min_1,
+        dim_n=np.asarray(data.dim_n[baskets]),
+        # counts
+        n_per_customer=np.asarray(data.n_per_customer[customers]),
+        n_per_product=np.bincount(y, minlength=data.dim_j).astype(
+            data.n_per_product.dtype),
+        total_customers=total_customers,
+        total_baskets=total_baskets,
+        total_purchases=len(y),
+        total_unique_purchases=len(y_unique),
+        # maps from i->ib, from ib->ibn and from ib->iu (y_unique)
+        i_to_ib_lb=i_to_ib_lb,
+        i_to_ib_ub=i_to_ib_ub,
+        ib_to_ibn_lb=ib_to_ibn_lb,
+        ib_to_ibn_ub=ib_to_ibn_ub,
+        ib_to_iu_lb=ib_to_iu_lb,
+        ib_to_iu_ub=ib_to_iu_ub,
+        # indicators
+        ib_first=ib_first,
+        ib_not_first=~ib_first,
+        ib_last=ib_last,
+        ib_not_last=~ib_last,
+    )
+
+    return subset, baskets, unique_purchases
+
+
+def _int_dtype_like(array, max_value):
+    # Keeps the (compact) integer type of an array, unless max_value no
+    # longer fits in it
+    return np.promote_types(array.dtype, _smallest_int_dtype(max_value))
+
+
+def append_to_dataset(
+        data,
+        y_fused_ibn,
+        x,
+        h,
+):
+    """Appends new baskets and new customers to a dataset.
+
+    Parameters
+        data: The existing dataset, e.g. loaded with load_dataset.
+        y_fused_ibn: Rows of (customer_id, basket_id, product_id) of the new
+            purchases. Customers 0..dim_i-1 are existing customers, new
+            customers are numbered dim_i, dim_i+1, ... The basket IDs only
+            have to order the new baskets of a customer chronologically, the
+            new baskets of an existing customer follow its existing baskets.
+            New products are numbered dim_j, dim_j+1, ...
+        x: The basket-specific variables of the new baskets, in the order of
+            (customer_id, basket_id).
+        h: The customer-specific variables of the new customers.
+
+    The counts, maps and indicators are updated from the new data only, and
+    the x_outer/h_outer sums are updated with the outer products of the new
+    baskets and customers. Only the new purchases are collapsed to
+    y_unique. The per-basket and per-purchase arrays are merged
+    with a single copy of the existing arrays. Note that in LDA-X datasets a
+    customer has a single basket, such that only new customers can be added.
+    Returns a new dataset, which can be saved with save_dataset.
+    """
+
+    i_vec = np.array(y_fused_ibn[:, 0], dtype=int) # customer IDs
+    ib_vec = np.array(y_fused_ibn[:, 1], dtype=int) # basket IDs
+    y_new = np.array(y_fused_ibn[:, 2], dtype=int) # Product IDs
+
+    # Sort the new purchases by customer and basket, and per basket by product
+    order = np.lexsort((y_new, ib_vec, i_vec))
+    i_vec = i_vec[order]
+    ib_vec = ib_vec[order]
+    y_new = y_new[order]
+
+    n_new_purchases = len(y_new)
+    n_new_customers = h.shape[0]
+
+    is_new_ib = np.empty(n_new_purchases, dtype=bool)
+    is_new_ib[0] = True
+    is_new_ib[1:] = (i_vec[1:] != i_vec[:-1]) | (ib_vec[1:] != ib_vec[:-1])
+    new_ib_to_ibn_lb = np.flatnonzero(is_new_ib)
+    n_new_baskets = len(new_ib_to_ibn_lb)
+
+    new_dim_n = np.diff(np.append(new_ib_to_ibn_lb, n_new_purchases))
+    new_i = i_vec[new_ib_to_ibn_lb] # customer of each new basket
+
+    # Dimensions
+    dim_i = data.dim_i + n_new_customers
+    dim_x = data.dim_x
+    dim_h = data.dim_h
+    total_customers = dim_i
+    total_baskets = data.total_baskets + n_new_baskets
+    total_purchases = data.total_purchases + n_new_purchases
+
+    assert i_vec[0] >= 0 and i_vec[-1] < dim_i
+    assert x.shape == (n_new_baskets, dim_x)
+    assert h.shape == (n_new_customers, dim_h)
+
+    # dim_b, dim_b_min_1, n_per_customer
+    new_dim_b = np.bincount(new_i, minlength=dim_i)
+    is_new_customer = np.arange(dim_i) >= data.dim_i
+    assert np.all(new_dim_b[is_new_customer] > 0) # new customers have purchases
+
+    dim_b = np.append(data.dim_b, np.zeros(n_new_customers, dtype=int)) + new_dim_b
+    dim_b = dim_b.astype(_int_dtype_like(data.dim_b, total_baskets))
+    dim_b_min_1 = dim_b.astype(float) - 1.0
+
+    n_per_customer = (
+        np.append(data.n_per_customer, np.zeros(n_new_customers, dtype=int))
+        +
+        np.bincount(i_vec, minlength=dim_i)
+    ).astype(_int_dtype_like(data.n_per_customer, total_purchases))
+
+    # n_per_product. New products extend the existing products
+    n_per_product = np.bincount(y_new, minlength=data.dim_j)
+    n_per_product[:data.dim_j] += data.n_per_product
+    n_per_product = n_per_product.astype(
+        _int_dtype_like(data.n_per_product, total_purchases))
+    dim_j = len(n_per_product)
+    assert np.all(n_per_product > 0)
+
+    # The existing basket before which a new basket is inserted. The new
+    # baskets of an existing customer follow its last basket, the baskets
+    # of new customers are added at the end
+    insert_ib = np.append(
+        data.i_to_ib_ub,
+        np.full(n_new_customers, data.total_baskets),
+    )[new_i]
+    insert_ibn = np.append(data.ib_to_ibn_lb, data.total_purchases)[insert_ib]
+
+    # y, dim_n
+    y = np.insert(data.y, np.repeat(insert_ibn, new_dim_n), y_new)
+    y = y.astype(_int_dtype_like(data.y, dim_j))
+    dim_n = np.insert(data.dim_n, insert_ib, new_dim_n)
+
+    # i_to_ib_lb, i_to_ib_ub, ib_to_ibn_lb, ib_to_ibn_ub
+    i_to_ib_ub = np.cumsum(dim_b).astype(
+        _int_dtype_like(data.i_to_ib_ub, total_baskets))
+    i_to_ib_lb = i_to_ib_ub - dim_b
+    ib_to_ibn_ub = np.cumsum(dim_n, dtype=int).astype(
+        _int_dtype_like(data.ib_to_ibn_ub, total_purchases))
+    ib_to_ibn_lb = ib_to_ibn_ub - dim_n.astype(ib_to_ibn_ub.dtype)
+
+    # y_unique, multiplicity, ib_to_iu_lb, ib_to_iu_ub. Only the new
+    # purchases are collapsed, and inserted before the entries of y_unique
+    # of the insertion baskets
+    (
+        new_y_unique,
+        new_multiplicity,
+        new_ib_to_iu_lb,
+        new_ib_to_iu_ub,
+    ) = _collapse_purchases(
+        y=y_new,
+        ib_to_ibn_lb=new_ib_to_ibn_lb,
+    )
+    new_n_unique = new_ib_to_iu_ub - new_ib_to_iu_lb
+    insert_iu = np.repeat(
+        np.append(data.ib_to_iu_lb, data.total_unique_purchases)[insert_ib],
+        new_n_unique,
+    )
+
+    y_unique = np.insert(data.y_unique, insert_iu, new_y_unique)
+    y_unique = y_unique.astype(y.dtype)
+    multiplicity = np.insert(data.multiplicity, insert_iu, new_multiplicity)
+    multiplicity = multiplicity.astype(
+        _int_dtype_like(data.multiplicity, total_purchases))
+
+    n_unique = np.insert(
+        np.asarray(data.ib_to_iu_ub) - data.ib_to_iu_lb,
+        insert_ib,
+        new_n_unique,
+    )
+    ib_to_iu_ub = np.cumsum(n_unique, dtype=int).astype(ib_to_ibn_ub.dtype)
+    ib_to_iu_lb = ib_to_iu_ub - n_unique.astype(ib_to_iu_ub.dtype)
+
+    # ib_first, ib_not_first, ib_last, ib_not_last. A new basket is first if
+    # it is the first basket of a new customer, and last if it is the last
+    # new basket of a customer
+    is_customer_start = np.ones(n_new_baskets, dtype=bool)
+    is_customer_start[1:] = new_i[1:] != new_i[:-1]
+    is_customer_end = np.ones(n_new_baskets, dtype=bool)
+    is_customer_end[:-1] = new_i[1:] != new_i[:-1]
+    new_ib_first = is_customer_start & is_new_customer[new_i]
+
+    ib_first = np.insert(data.ib_first, insert_ib, new_ib_first)
+    ib_not_first = ~ib_first
+
+    # The last basket of an existing customer with new baskets is no longer last
+    ib_last = np.array(data.ib_last)
+    existing_updated = np.flatnonzero(new_dim_b[:data.dim_i])
+    ib_last[data.i_to_ib_ub[existing_updated] - 1] = False
+    ib_last = np.insert(ib_last, insert_ib, is_customer_end)
+    ib_not_last = ~ib_last
+
+    # x, h, h_per_basket
+    x = np.asarray(x, dtype=data.x.dtype)
+    h = np.asarray(h, dtype=data.h.dtype)
+    new_h_per_basket = np.where(
+        is_new_customer[new_i, np.newaxis],
+        h[np.maximum(new_i - data.dim_i, 0)],
+        data.h[np.minimum(new_i, data.dim_i - 1)],
+    )
+    h_per_basket = np.insert(
+        data.h_per_basket, insert_ib, new_h_per_basket, axis=0)
+    x_all = np.insert(data.x, insert_ib, x, axis=0)
+    h_all = np.concatenate((data.h, h))
+    if data.h.flags.f_contiguous:
+        h_all = np.asfortranarray(h_all)
+
+    # x_outer_sum_first, x_outer_sum_not_first, from the new baskets
+    x_outer_sum_first = data.x_outer_sum_first + _sum_outer(x, new_ib_first)
+    x_outer_sum_not_first = (
+        data.x_outer_sum_not_first + _sum_outer(x, ~new_ib_first)
+    )
+
+    # h_outer_sum_first, h_outer_sum_not_first, from the customers with new
+    # baskets. A new customer adds one first and dim_b - 1 other baskets
+    updated = np.flatnonzero(new_dim_b)
+    h_updated = h_all[updated]
+    h_outer_sum_first = data.h_outer_sum_first + _sum_outer(
+        h_updated, is_new_customer[updated].astype(float))
+    h_outer_sum_not_first = data.h_outer_sum_not_first + _sum_outer(
+        h_updated, new_dim_b[updated] - is_new_customer[updated])
+
+    return data._replace(
+        # data
+        y=y,
+        y_unique=y_unique,
+        multiplicity=multiplicity,
+        x=x_all,
+        h=h_all,
+        x_outer_sum_first=x_outer_sum_first,
+        x_outer_sum_not_first=x_outer_sum_not_first,
+        h_outer_sum_first=h_outer_sum_first,
+        h_outer_sum_not_first=h_outer_sum_not_first,
+        h_per_basket=h_per_basket,
+        # dimensions
+        dim_j=dim_j,
+        dim_i=dim_i,
+        dim_b=dim_b,
+        dim_b_min_1=dim_b_min_1,
+        dim_n=dim_n,
+        # counts
+        n_per_customer=n_per_customer,
+        n_per_product=n_per_product,
+        total_customers=total_customers,
+        total_baskets=total_baskets,
+        total_purchases=total_purchases,
+        total_unique_purchases=len(y_unique),
+        # maps from i->ib, from ib->ibn and from ib->iu (y_unique)
         i_to_ib_lb=i_to_ib_lb,
         i_to_ib_ub=i_to_ib_ub,
         ib_to_ibn_lb=ib_to_ibn_lb,
         ib_to_ibn_ub=ib_to_ibn_ub,
+        ib_to_iu_lb=ib_to_iu_lb,
+        ib_to_iu_ub=ib_to_iu_ub,
         # indicators
         ib_first=ib_first,
         ib_not_first=ib_not_first,
@@ -246,4 +765,61 @@ def create_dataset(
         ib_not_last=ib_not_last,
     )
 
-    return data
\ No newline at end of file
+
+def save_dataset(
+        data,
+        folder,
+):
+    """Saves a dataset as a folder with a .npy file per array and a
+    metadata.json file with the scalar fields.
+
+    The folder is written under a temporary name and renamed when complete.
+    If the folder already exists, e.g. because a concurrent run saved the
+    same dataset first, the existing folder is kept.
+    """
+
+    tmp_folder = '{}.{}.tmp'.format(folder, os.getpid())
+    os.makedirs(tmp_folder)
+
+    metadata = {
+        'arrays': [],
+        'scalars': {},
+    }
+    for field, value in data._asdict().items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_folder, field + '.npy'), value)
+            metadata['arrays'].append(field)
+        else:
+            metadata['scalars'][field] = int(value)
+
+    with open(os.path.join(tmp_folder, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=4)
+
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        if not os.path.exists(os.path.join(folder, 'metadata.json')):
+            raise
+        shutil.rmtree(tmp_folder)
+
+
+def load_dataset(
+        folder,
+        mmap_mode='r',
+):
+    """Loads a dataset saved by save_dataset.
+
+    With mmap_mode='r' all arrays are read-only memory maps, such that
+    concurrent runs on the same dataset share a single copy through the
+    page cache. The arrays can be passed to the numba kernels as they are.
+    """
+
+    with open(os.path.join(folder, 'metadata.json'), 'r') as f:
+        metadata = json.load(f)
+
+    fields = dict(metadata['scalars'])
+    for field in metadata['arrays']:
+        fields[field] = np.load(
+            os.path.join(folder, field + '.npy'), mmap_mode=mmap_mode)
+
+    return Data(**fields)
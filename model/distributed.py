@@ -0,0 +1,341 @@
+"""
+Description:
+    Contains the coordinator of the distributed mode of the optimization
+    routine for the ULSDPB model.
+
+    In the distributed mode, the customers are divided into shards with an
+    equal estimated cost (see model.scheduling.create_shards), and the local
+    step of each shard runs in a worker process (see model.worker), on this
+    machine or on other machines. The workers connect to the coordinator over
+    a socket (multiprocessing.connection), and load the saved dataset (see
+    model.data.save_dataset) as read-only memory maps, such that the workers
+    on one machine share a single copy through the page cache.
+
+    A worker keeps the local parameters and q(z) of its shard. It returns the
+    sums over its shard that the updates of the global parameters need (the
+    sufficient statistics, e.g. counts_phi and the regression terms X'eps),
+    which the coordinator sums over the workers. The global parameters are
+    only updated by the coordinator (see
+    model.optimization.distributed_iteration), and sent back to the workers
+    with the next request.
+
+    The messages are pickled, so a process that connects with the
+    authentication key can run code on the coordinator and the workers. The
+    coordinator therefore generates a new key per run, which the local
+    workers get through the environment variable AUTHKEY_ENV, and which the
+    workers on other machines need as well (see model.worker).
+
+Functions:
+    global_fields: returns the fields of the state of global parameters.
+
+    start_workers: starts the local workers and waits until all workers are
+    connected.
+
+    setup_workers: sends its shard of the customers and of the state to each
+    worker.
+
+    request: sends a request to all workers and returns their replies.
+
+    sum_replies: sums the replies of the workers.
+
+    gather_state: copies the local parameters of all workers into a state.
+
+    stop_workers: stops the workers.
+"""
+
+# Standard library modules
+from collections import namedtuple
+import multiprocessing.connection
+import os
+import secrets
+import subprocess
+import sys
+
+# Own modules
+import model.data
+import model.scheduling
+import model.state
+
+
+# The environment variable with the authentication key of the workers, in
+# hexadecimal
+AUTHKEY_ENV = 'ULSDPB_AUTHKEY'
+
+# The fields of the state per global parameter, which are sent to the
+# workers after the parameter is updated
+PARAMETER_FIELDS = {
+    'phi': ('eta_q_phi', 'log_phi', 'negative_kl_q_p_phi'),
+    'tau_alpha': (
+        'eta_q_tau_alpha', 'log_tau_alpha', 'tau_alpha',
+        'negative_kl_q_p_tau_alpha'),
+    'mu_kappa': (
+        'eta_q_mu_kappa', 'mu_kappa', 'mu_kappa_outer',
+        'negative_kl_q_p_mu_kappa'),
+    'lambda_kappa': (
+        'eta_q_lambda_kappa', 'lambda_kappa', 'log_det_lambda_kappa',
+        'negative_kl_q_p_lambda_kappa'),
+    'beta': ('eta_q_beta', 'beta', 'beta_outer', 'negative_kl_q_p_beta'),
+    'gamma': ('eta_q_gamma', 'gamma', 'gamma_outer', 'negative_kl_q_p_gamma'),
+    'rho': ('eta_q_rho', 'rho', 'rho_outer', 'negative_kl_q_p_rho'),
+    'delta': ('eta_q_delta', 'delta', 'delta_sq', 'negative_kl_q_p_delta'),
+    'delta_kappa': (
+        'eta_q_delta_kappa', 'delta_kappa', 'delta_kappa_sq',
+        'negative_kl_q_p_delta_kappa'),
+    'delta_beta': (
+        'eta_q_delta_beta', 'delta_beta', 'delta_beta_sq',
+        'negative_kl_q_p_delta_beta'),
+    'delta_gamma': (
+        'eta_q_delta_gamma', 'delta_gamma', 'delta_gamma_sq',
+        'negative_kl_q_p_delta_gamma'),
+}
+
+
+Worker = namedtuple(
+    typename='Worker',
+    field_names=[
+        'connection',
+        # The sorted IDs of the customers of the worker, and their baskets and
+        # entries of y_unique (see model.data.subset_indices)
+        'customers',
+        'baskets',
+        'unique_purchases',
+    ]
+)
+
+
+def global_fields(
+        q,
+        parameters=tuple(PARAMETER_FIELDS),
+):
+    """Returns a dict with the fields of q of the given global parameters,
+    all by default. The fields that are None, e.g. the natural parameters of
+    a fixed parameter, are left out.
+    """
+
+    return {
+        field: getattr(q, field)
+        for parameter in parameters
+        for field in PARAMETER_FIELDS[parameter]
+        if getattr(q, field) is not None
+    }
+
+
+def start_workers(distributed_settings):
+    """Starts distributed_settings.n_local_workers worker processes on this
+    machine, and waits until distributed_settings.n_workers workers are
+    connected. The other workers are started on other machines with
+    python -m model.worker -ADDRESS host:port
+    with the authentication key of this run, which is printed if there are
+    such workers, in the environment variable AUTHKEY_ENV (or entered at the
+    prompt of the worker).
+
+    Returns the connections to the workers and the local worker processes.
+    """
+
+    # A new authentication key per run
+    authkey = secrets.token_bytes(32)
+
+    listener = multiprocessing.connection.Listener(
+        address=(distributed_settings.host, distributed_settings.port),
+        authkey=authkey,
+    )
+    address = '{}:{}'.format(*listener.address)
+
+    # The local workers get the key through the environment, not the command
+    # line, and share the CPUs of this machine
+    env = dict(os.environ)
+    env[AUTHKEY_ENV] = authkey.hex()
+    if distributed_settings.n_threads_per_worker > 0:
+        env['NUMBA_NUM_THREADS'] = str(distributed_settings.n_threads_per_worker)
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'model.worker', '-ADDRESS', address],
+            env=env,
+        )
+        for _ in range(distributed_settings.n_local_workers)
+    ]
+
+    print('Waiting for {} workers ({} local) on {}'.format(
+        distributed_settings.n_workers,
+        distributed_settings.n_local_workers,
+        address,
+    ))
+    if distributed_settings.n_workers > distributed_settings.n_local_workers:
+        print('Authentication key of the other workers ({}): {}'.format(
+            AUTHKEY_ENV,
+            authkey.hex(),
+        ))
+    connections = [
+        listener.accept() for _ in range(distributed_settings.n_workers)
+    ]
+    listener.close()
+
+    return connections, processes
+
+
+def setup_workers(
+        connections,
+        q,
+        data,
+        dataset_folder,
+        prior,
+        is_fixed,
+        vi_settings,
+        misc_settings,
+        M,
+):
+    """Divides the customers into a shard per worker, and sends the shard and
+    its variational state (see model.state.subset_state) to each worker,
+    which loads its shard of the dataset from dataset_folder.
+
+    Returns the workers.
+    """
+
+    shards = model.scheduling.create_shards(
+        data=data,
+        M=M,
+        n_q_i_steps=vi_settings.n_q_i_steps,
+        n_shards=len(connections),
+    )
+    assert len(shards) == len(connections), \
+        'There are more workers than customers'
+
+    workers = []
+    for connection, customers in zip(connections, shards):
+        baskets, unique_purchases = model.data.subset_indices(
+            data=data,
+            customers=customers,
+        )
+        connection.send((
+            'setup',
+            {
+                'dataset_folder': os.path.abspath(dataset_folder),
+                'customers': customers,
+                'q': model.state.subset_state(
+                    q=q,
+                    customers=customers,
+                    baskets=baskets,
+                    unique_purchases=unique_purchases,
+                ),
+                'prior': prior,
+                'is_fixed': is_fixed,
+                # The settings are sent as dicts, as their namedtuple types
+                # are defined in the main script
+                'vi_settings': vi_settings._asdict(),
+                'misc_settings': misc_settings._asdict(),
+                'M': M,
+            },
+        ))
+        workers.append(Worker(
+            connection=connection,
+            customers=customers,
+            baskets=baskets,
+            unique_purchases=unique_purchases,
+        ))
+
+    _receive(workers=workers)
+
+    print('Workers: {}, customers per worker: {}'.format(
+        len(workers),
+        ' '.join(str(len(worker.customers)) for worker in workers),
+    ))
+
+    return workers
+
+
+def _receive(workers):
+    # The replies of all workers, in order
+    replies = []
+    for k, worker in enumerate(workers):
+        status, reply = worker.connection.recv()
+        if status == 'error':
+            raise RuntimeError('Worker {} failed:\n{}'.format(k, reply))
+        replies.append(reply)
+
+    return replies
+
+
+def request(
+        workers,
+        command,
+        **kwargs
+):
+    """Sends a request to all workers, which handle it in parallel (see
+    model.worker.serve), and returns their replies in the order of the
+    workers.
+    """
+
+    for worker in workers:
+        worker.connection.send((command, kwargs))
+
+    return _receive(workers=workers)
+
+
+def sum_replies(replies):
+    """Sums the replies of the workers: arrays and numbers, or (named) tuples
+    of them, which are summed per element. The replies are summed in the
+    order of the workers, such that the result does not depend on the order
+    in which the workers finish.
+    """
+
+    if isinstance(replies[0], tuple):
+        summed = [
+            sum_replies([reply[k] for reply in replies])
+            for k in range(len(replies[0]))
+        ]
+        if hasattr(replies[0], '_make'):
+            return replies[0]._make(summed)
+        return tuple(summed)
+
+    total = replies[0]
+    for reply in replies[1:]:
+        total = total + reply
+
+    return total
+
+
+def gather_state(
+        workers,
+        q,
+        theta_q_z=None,
+):
+    """Copies the local parameters of all workers into q, in place (see
+    model.state.update_from_subset_state), and q(z) of all purchases into
+    theta_q_z if it is not None.
+    """
+
+    replies = request(
+        workers=workers,
+        command='gather',
+        return_theta_q_z=theta_q_z is not None,
+    )
+
+    for worker, (q_shard, theta_q_z_shard) in zip(workers, replies):
+        model.state.update_from_subset_state(
+            q=q,
+            q_subset=q_shard,
+            customers=worker.customers,
+            baskets=worker.baskets,
+            unique_purchases=worker.unique_purchases,
+        )
+        if theta_q_z is not None:
+            theta_q_z[worker.unique_purchases] = theta_q_z_shard
+
+
+def stop_workers(
+        workers,
+        processes,
+):
+    """Stops the workers, and waits until the local worker processes have
+    finished.
+    """
+
+    request(
+        workers=workers,
+        command='stop',
+    )
+    for worker in workers:
+        worker.connection.close()
+    for process in processes:
+        process.wait()
@@ -4,6 +4,12 @@ Description:
 
 Functions:
     compute_elbo_container: computes the ELBO components for the ULSDPB model and returns them as an ELBO_Container.
+
+    calc_elbo_sums: computes the sums over the customers, baskets and
+    purchases of the local parameters that enter the ELBO.
+
+    compute_elbo_container_from_sums: computes the ELBO components from these
+    sums and the global parameters.
 """
 
 # Standard library modules
@@ -53,6 +59,24 @@ ELBO_Container = namedtuple(
     ]
 )
 
+# The sums of the local parameters that enter the ELBO, which are summed
+# over the workers in the distributed mode (see model.distributed)
+ELBO_Sums = namedtuple(
+    'ELBO_Sums',
+    [
+        # z
+        'sum_counts_basket_mu_q_alpha',
+        'sum_n_log_theta_denom_approx',
+        'entropy_q_z',
+        # alpha
+        'entropy_q_alpha',
+        # kappa
+        'sum_kappa',
+        'sum_kappa_outer',
+        'entropy_q_kappa',
+    ]
+)
+
 LOG_2PI = np.log(2*np.pi) 
 
 
@@ -63,6 +87,46 @@ def compute_elbo_container(
         total_customers,
         total_baskets,
 ):
+    return compute_elbo_container_from_sums(
+        q=q,
+        elbo_sums=calc_elbo_sums(
+            q=q,
+            n_purchases_per_basket=n_purchases_per_basket,
+        ),
+        M=M,
+        total_customers=total_customers,
+        total_baskets=total_baskets,
+    )
+
+
+def calc_elbo_sums(
+        q,
+        n_purchases_per_basket,
+):
+    return ELBO_Sums(
+        sum_counts_basket_mu_q_alpha=np.sum(q.counts_basket * q.mu_q_alpha),
+        sum_n_log_theta_denom_approx=(
+            n_purchases_per_basket @ q.log_theta_denom_approx),
+        entropy_q_z=np.sum(q.entropy_q_z, dtype=float),
+        entropy_q_alpha=np.sum(q.entropy_q_alpha),
+        sum_kappa=np.sum(q.kappa, axis=0),
+        sum_kappa_outer=np.sum(q.kappa_outer, axis=0),
+        entropy_q_kappa=np.sum(q.entropy_q_kappa),
+    )
+
+
+def compute_elbo_container_from_sums(
+        q,
+        elbo_sums,
+        M,
+        total_customers,
+        total_baskets,
+):
+    """Computes the ELBO components from the sums of the local parameters
+    (see calc_elbo_sums), and the global parameters, counts_phi and
+    sum_ib_eps_alpha_sq in q.
+    """
+
     # y
     # Expected value of the log probability of the observed data
     ev_q_log_p_y = np.sum(q.log_phi * q.counts_phi) 
@@ -70,12 +134,12 @@ def compute_elbo_container(
     # z
     # Expected value of the log probability of the latent variable
     ev_q_log_p_z = (
-        np.sum(q.counts_basket * q.mu_q_alpha)
+        elbo_sums.sum_counts_basket_mu_q_alpha
         -
-        n_purchases_per_basket @ q.log_theta_denom_approx
+        elbo_sums.sum_n_log_theta_denom_approx
     )
     # Entropy of the variational distribution over
-    entropy_q_z = np.sum(q.entropy_q_z)
+    entropy_q_z = elbo_sums.entropy_q_z
 
     # alpha
     ev_q_log_p_alpha = 0.5 * (
@@ -83,13 +147,13 @@ def compute_elbo_container(
         + total_baskets * np.sum(q.log_tau_alpha)
         - q.tau_alpha @ q.sum_ib_eps_alpha_sq
     )
-    entropy_q_alpha = np.sum(q.entropy_q_alpha)
+    entropy_q_alpha = elbo_sums.entropy_q_alpha
 
     # kappa
-    sum_i_ev_q_kappa = np.sum(q.kappa, axis=0)
+    sum_i_ev_q_kappa = elbo_sums.sum_kappa
     sum_i_ev_q_eps_kappa_outer = (
         total_customers * q.mu_kappa_outer
-        + np.sum(q.kappa_outer, axis=0)
+        + elbo_sums.sum_kappa_outer
         - np.outer(sum_i_ev_q_kappa, q.mu_kappa)
         - np.outer(q.mu_kappa, sum_i_ev_q_kappa)
     )
@@ -99,7 +163,7 @@ def compute_elbo_container(
         + total_customers * q.log_det_lambda_kappa
         - np.sum(q.lambda_kappa * sum_i_ev_q_eps_kappa_outer)
     )
-    entropy_q_kappa = np.sum(q.entropy_q_kappa)
+    entropy_q_kappa = elbo_sums.entropy_q_kappa
 
     # phi
     ev_q_log_p_minus_log_q_phi = np.sum(q.negative_kl_q_p_phi)
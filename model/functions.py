@@ -4,6 +4,10 @@ Description:
     Functions can be found in the appendix of the paper 
 """
 
+# Standard library modules
+from collections import namedtuple
+import time
+
 # External modules
 import numpy as np
 import numba 
@@ -20,6 +24,26 @@ from model import settings
 
 LOG_2PI_E = np.log(2*np.pi*np.e)
 
+# Below this normalizer, q(z_ibn) is computed with log-sum-exp
+MIN_NORMALIZER_Q_Z = 1e-250
+
+
+def as_float64(a):
+    """Returns the array a as float64, without a copy if it already is.
+
+    Used for the regressors in data, which may be stored as float32 (see
+    model.data.compact_dataset), before a matrix product with the float64
+    model parameters.
+    """
+    return np.asarray(a, dtype=np.float64)
+
+
+@numba.extending.overload(as_float64)
+def _as_float64_overload(a):
+    if a.dtype == numba.types.float64:
+        return lambda a: a
+    return lambda a: a.astype(np.float64)
+
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # eps_alpha # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -47,23 +71,23 @@ def calc_ev_q_eps_alpha(
         ev_q_kappa * ev_q_delta_kappa
         +
         # x from first shopping trip 
-        (data.x[data.ib_first] @ ev_q_beta.T) * ev_q_delta_beta 
+        (as_float64(data.x[data.ib_first]) @ ev_q_beta.T) * ev_q_delta_beta 
         +
-        (data.h @ ev_q_gamma.T) * ev_q_delta_gamma
+        (as_float64(data.h) @ ev_q_gamma.T) * ev_q_delta_gamma
     )
 
     # Model error of alpha for not first shopping trips
     ev_q_eps_alpha[data.ib_not_first] = - (
         (mu_q_alpha[data.ib_not_last] @ ev_q_rho.T)
         +
-        (data.x[data.ib_not_first] @ ev_q_beta.T)
+        (as_float64(data.x[data.ib_not_first]) @ ev_q_beta.T)
     )
 
     # Model with distinction between shopping trips 
     ib = 0
     # Every customer with characteristics 
     for i in range(data.dim_i):
-        ev_q_gamma_h_i = ev_q_gamma @ data.h[i]
+        ev_q_gamma_h_i = ev_q_gamma @ as_float64(data.h[i])
         # Every shopping trip with characteristics 
         for b in range(data.dim_b[i]):
             if b != 0:
@@ -97,9 +121,9 @@ def _calc_ev_q_eps_alpha_loop_ib(
                     +
                     ev_q_kappa[i] * ev_q_delta_kappa
                     +
-                    ev_q_beta @ data.x[ib] * ev_q_delta_beta
+                    ev_q_beta @ as_float64(data.x[ib]) * ev_q_delta_beta
                     +
-                    ev_q_gamma @ data.h[i] * ev_q_delta_gamma
+                    ev_q_gamma @ as_float64(data.h[i]) * ev_q_delta_gamma
                 )
             else:
                 mu_ib = (
@@ -107,9 +131,9 @@ def _calc_ev_q_eps_alpha_loop_ib(
                     +
                     ev_q_kappa[i]
                     +
-                    ev_q_beta @ data.x[ib]
+                    ev_q_beta @ as_float64(data.x[ib])
                     +
-                    ev_q_gamma @ data.h[i]
+                    ev_q_gamma @ as_float64(data.h[i])
                 )
 
             ev_q_eps_alpha[ib] = mu_q_alpha[ib] - mu_ib
@@ -237,18 +261,18 @@ def calc_ev_q_sum_ib_eps_alpha_sq(
     ev_q_gamma_h_i = np.zeros(dim_m)
     for i in range(data.dim_i):
 
-        ev_q_gamma_h_i[:] = ev_q_gamma @ data.h[i]
+        ev_q_gamma_h_i[:] = ev_q_gamma @ as_float64(data.h[i])
 
         for b in range(data.dim_b[i]):
             if b == 0:
                 s1 = ev_q_delta
                 s2 = ev_q_kappa[i] * ev_q_delta_kappa
-                s3 = ev_q_beta @ data.x[ib] * ev_q_delta_beta
+                s3 = ev_q_beta @ as_float64(data.x[ib]) * ev_q_delta_beta
                 s4 = ev_q_gamma_h_i * ev_q_delta_gamma
             else:
                 s1 = ev_q_rho @ mu_q_alpha[ib - 1]
                 s2 = ev_q_kappa[i]
-                s3 = ev_q_beta @ data.x[ib]
+                s3 = ev_q_beta @ as_float64(data.x[ib])
                 s4 = ev_q_gamma_h_i
 
             ev_q_mu_ib = s1 + s2 + s3 + s4
@@ -301,18 +325,22 @@ def _calc_ev_q_eps_alpha_sq(
     for i in range(data.dim_i):
 
         ev_q_gamma_h_i[:] = ev_q_gamma @ data.h[i]
+
+        # The outer products are computed here, and not stored in data
+        h_outer_i = np.outer(data.h[i], data.h[i])
         sum_per_m_ev_q_gamma_outer_h_outer = np.zeros(dim_m)
         for m in range(dim_m):
             sum_per_m_ev_q_gamma_outer_h_outer[m] = np.sum(
-                ev_q_gamma_outer[m] * data.h_outer[i]
+                ev_q_gamma_outer[m] * h_outer_i
             )
 
         for b in range(data.dim_b[i]):
 
+            x_outer_ib = np.outer(data.x[ib], data.x[ib])
             sum_per_m_ev_q_beta_outer_x_ib_outer = np.zeros(dim_m)
             for m in range(dim_m):
                 sum_per_m_ev_q_beta_outer_x_ib_outer[m] = np.sum(
-                    ev_q_beta_outer[m] * data.x_outer[ib]
+                    ev_q_beta_outer[m] * x_outer_ib
                 )
 
             if b == 0:
@@ -395,7 +423,16 @@ def ev_q_log_theta_denom_ji(mu_q, sigma_sq_q):
     so effectively we create a lowerbound on the ELBO.
     """
 
-    return misc.log_sum_exp(v=mu_q + 0.5 * sigma_sq_q)
+    # log-sum-exp of mu_q + 0.5 * sigma_sq_q, without a temporary array
+    max_v = mu_q[0] + 0.5 * sigma_sq_q[0]
+    for m in range(1, len(mu_q)):
+        max_v = max(max_v, mu_q[m] + 0.5 * sigma_sq_q[m])
+
+    sum_exp = 0.0
+    for m in range(len(mu_q)):
+        sum_exp += np.exp(mu_q[m] + 0.5 * sigma_sq_q[m] - max_v)
+
+    return max_v + np.log(sum_exp)
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -403,14 +440,56 @@ def ev_q_log_theta_denom_ji(mu_q, sigma_sq_q):
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
+# Work arrays of length M of a thread in the local step, such that the
+# updates of a basket do not allocate memory (see create_local_scratch)
+LocalScratch = namedtuple(
+    typename='LocalScratch',
+    field_names=[
+        # update_q_z_ib
+        'exp_mu_q_alpha_ib',
+        # update_q_alpha_ib_ji
+        'ev_q_mu_ib',
+        'cleaned_ev_q_eps_alpha_ib_next',
+        'ev_q_tau_cleaned_rho',
+        'ev_q_theta_nominator_ib',
+        'gradient',
+        'candidate',
+        'prior_precision_ib',
+        # update_q_kappa_i_solution
+        'ev_q_mb_vector',
+    ]
+)
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def create_local_scratch(dim_m):
+    """
+    Allocates the work arrays of a thread in the local step. They are
+    allocated once per thread in update_q_local, and passed down to the
+    updates of the customers and baskets.
+    """
+
+    return LocalScratch(
+        exp_mu_q_alpha_ib=np.empty(dim_m),
+        ev_q_mu_ib=np.empty(dim_m),
+        cleaned_ev_q_eps_alpha_ib_next=np.empty(dim_m),
+        ev_q_tau_cleaned_rho=np.empty(dim_m),
+        ev_q_theta_nominator_ib=np.empty(dim_m),
+        gradient=np.empty(dim_m),
+        candidate=np.empty(dim_m),
+        prior_precision_ib=np.empty(dim_m),
+        ev_q_mb_vector=np.empty(dim_m),
+    )
+
+
 @numba.jit(**settings.NUMBA_OPTIONS, parallel=True)
 def update_q_local(
         # # variables to be updated
         # z
         theta_q_z,
+        ev_q_counts_phi_thread,
         ev_q_counts_basket,
         ev_q_entropy_q_z,
-        ev_q_counts_phi,
         # alpha
         mu_q_alpha,
         sigma_sq_q_alpha,
@@ -445,11 +524,41 @@ def update_q_local(
         # settings
         vi_settings,
         is_fixed,
-        # efficient inverse
-        U_T_mmul_L_inv,
-        v,
-        log_det_C,
+        # q(kappa_i) covariance per number of baskets
+        cov_q_kappa,
+        log_det_cov_q_kappa,
+        cov_q_kappa_index,
+        # schedule (see model.scheduling)
+        customers,
+        chunk_lb,
+        chunk_ub,
+        thread_chunk_lb,
+        thread_chunk_ub,
+        stream_q_z,
+        # diagnostics
+        n_steps_used,
+        elbo_gain_q_i,
+        thread_busy_time,
 ):
+    """
+    Updates q(z), q(alpha) and q(kappa) of the customers in the chunks of the
+    schedule, where thread t updates the chunks thread_chunk_lb[t]:
+    thread_chunk_ub[t]. The measured time of the chunks of thread t is added
+    to thread_busy_time[t].
+
+    If stream_q_z, theta_q_z only holds the q(z) of the customer that a
+    thread is updating: thread t uses rows t * n_rows:(t + 1) * n_rows of
+    theta_q_z, with n_rows the largest number of entries of y_unique of a
+    customer. After the update of a customer, its q(z) is added to
+    ev_q_counts_phi_thread[t], and ev_q_counts_phi is the sum over the
+    threads. Otherwise, theta_q_z holds the q(z) of all purchases, and
+    ev_q_counts_phi is computed from it after the local step (see
+    calc_ev_q_counts_phi_sorted and calc_ev_q_counts_phi_partial).
+
+    Each thread allocates its work arrays once (see LocalScratch), so the
+    updates of the customers do not allocate memory, except for the Newton
+    directions of q(alpha_ib) if q_alpha_method is 'newton'.
+    """
 
     ev_q_lambda_kappa_mmult_ev_q_mu_kappa = ev_q_lambda_kappa @ ev_q_mu_kappa
     ev_q_sum_m_tau_alpha_m_rho_outer_m = np.zeros((dim_m, dim_m))
@@ -463,59 +572,154 @@ def update_q_local(
 
     is_updated_mu_q = np.empty(data.total_baskets, dtype=np.bool_)
 
-    for i in numba.prange(data.dim_i):
+    exp_ev_q_log_phi, max_ev_q_log_phi = calc_exp_ev_q_log_phi(ev_q_log_phi)
+
+    n_threads = len(thread_chunk_lb)
+    n_rows_thread = theta_q_z.shape[0] // n_threads
+
+    # Each thread updates a block of chunks of customers, where each chunk
+    # has about the same cost
+    for t in numba.prange(n_threads):
+        scratch = create_local_scratch(dim_m)
+        for c in range(thread_chunk_lb[t], thread_chunk_ub[t]):
+            with numba.objmode(chunk_start='float64'):
+                chunk_start = time.perf_counter()
+            for k in range(chunk_lb[c], chunk_ub[c]):
+                i = customers[k]
+
+                # Rows of theta_q_z of the purchases of customer i
+                iu_lb_i = data.ib_to_iu_lb[data.i_to_ib_lb[i]]
+                iu_ub_i = data.ib_to_iu_ub[data.i_to_ib_ub[i] - 1]
+                theta_q_z_offset = 0
+                if stream_q_z:
+                    theta_q_z_offset = iu_lb_i - t * n_rows_thread
+
+                n_steps_i, elbo_gain_i = update_q_i(
+                    i=i,
+                    # # variables to be updated
+                    # z
+                    theta_q_z=theta_q_z,
+                    theta_q_z_offset=theta_q_z_offset,
+                    ev_q_counts_basket=ev_q_counts_basket,
+                    ev_q_entropy_q_z=ev_q_entropy_q_z,
+                    # alpha
+                    mu_q_alpha=mu_q_alpha,
+                    sigma_sq_q_alpha=sigma_sq_q_alpha,
+                    ss_mu_q=ss_mu_q,
+                    ss_log_sigma_q=ss_log_sigma_q,
+                    ev_q_alpha_sq=ev_q_alpha_sq,
+                    ev_q_log_theta_denom_approx=ev_q_log_theta_denom_approx,
+                    ev_q_entropy_q_alpha=ev_q_entropy_q_alpha,
+                    # alpha diagnostics
+                    updated_mu_q=updated_mu_q,
+                    updated_sigma_sq_q=updated_sigma_sq_q,
+                    updated_both=updated_both,
+                    # kappa
+                    ev_q_kappa=ev_q_kappa,
+                    ev_q_kappa_sq=ev_q_kappa_sq,
+                    ev_q_kappa_outer=ev_q_kappa_outer,
+                    ev_q_entropy_q_kappa=ev_q_entropy_q_kappa,
+                    # mix
+                    ev_q_eps_alpha=ev_q_eps_alpha,
+                    # others
+                    ev_q_log_phi=ev_q_log_phi,
+                    exp_ev_q_log_phi=exp_ev_q_log_phi,
+                    max_ev_q_log_phi=max_ev_q_log_phi,
+                    ev_q_tau_alpha=ev_q_tau_alpha,
+                    ev_q_lambda_kappa_mmult_ev_q_mu_kappa=ev_q_lambda_kappa_mmult_ev_q_mu_kappa,
+                    ev_q_rho=ev_q_rho,
+                    ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
+                    ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+                    ev_q_delta_kappa=ev_q_delta_kappa,
+                    ev_q_delta_kappa_sq=ev_q_delta_kappa_sq,
+                    dim_m=dim_m,
+                    # data
+                    data=data,
+                    # settings
+                    vi_settings=vi_settings,
+                    is_fixed=is_fixed,
+                    # q(kappa_i) covariance per number of baskets
+                    cov_q_kappa=cov_q_kappa,
+                    log_det_cov_q_kappa=log_det_cov_q_kappa,
+                    cov_q_kappa_index=cov_q_kappa_index,
+                    is_updated_mu_q=is_updated_mu_q,
+                    scratch=scratch,
+                )
+                n_steps_used[i] = n_steps_i
+                elbo_gain_q_i[i] = elbo_gain_i
 
-        update_q_i(
-            i=i,
-            # # variables to be updated
-            # z
-            theta_q_z=theta_q_z,
-            ev_q_counts_basket=ev_q_counts_basket,
-            ev_q_entropy_q_z=ev_q_entropy_q_z,
-            # alpha
-            mu_q_alpha=mu_q_alpha,
-            sigma_sq_q_alpha=sigma_sq_q_alpha,
-            ss_mu_q=ss_mu_q,
-            ss_log_sigma_q=ss_log_sigma_q,
-            ev_q_alpha_sq=ev_q_alpha_sq,
-            ev_q_log_theta_denom_approx=ev_q_log_theta_denom_approx,
-            ev_q_entropy_q_alpha=ev_q_entropy_q_alpha,
-            # alpha diagnostics
-            updated_mu_q=updated_mu_q,
-            updated_sigma_sq_q=updated_sigma_sq_q,
-            updated_both=updated_both,
-            # kappa
-            ev_q_kappa=ev_q_kappa,
-            ev_q_kappa_sq=ev_q_kappa_sq,
-            ev_q_kappa_outer=ev_q_kappa_outer,
-            ev_q_entropy_q_kappa=ev_q_entropy_q_kappa,
-            # mix
-            ev_q_eps_alpha=ev_q_eps_alpha,
-            # others
-            ev_q_log_phi=ev_q_log_phi,
-            ev_q_tau_alpha=ev_q_tau_alpha,
-            ev_q_lambda_kappa_mmult_ev_q_mu_kappa=ev_q_lambda_kappa_mmult_ev_q_mu_kappa,
-            ev_q_rho=ev_q_rho,
-            ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
-            ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
-            ev_q_delta_kappa=ev_q_delta_kappa,
-            ev_q_delta_kappa_sq=ev_q_delta_kappa_sq,
-            dim_m=dim_m,
-            # data
-            data=data,
-            # settings
-            vi_settings=vi_settings,
-            is_fixed=is_fixed,
-            # efficient inverse
-            U_T_mmul_L_inv=U_T_mmul_L_inv,
-            v=v,
-            log_det_C=log_det_C,
-            is_updated_mu_q=is_updated_mu_q,
-        )
+                if stream_q_z and not is_fixed.z:
+                    for u in range(iu_lb_i, iu_ub_i):
+                        j = data.y_unique[u]
+                        for m in range(dim_m):
+                            ev_q_counts_phi_thread[t, j, m] += (
+                                data.multiplicity[u] * theta_q_z[u - theta_q_z_offset, m]
+                            )
+            with numba.objmode(chunk_end='float64'):
+                chunk_end = time.perf_counter()
+            thread_busy_time[t] += chunk_end - chunk_start
+
+
+@numba.jit(**settings.NUMBA_OPTIONS, parallel=True)
+def calc_ev_q_counts_phi_partial(
+        ev_q_counts_phi,
+        theta_q_z,
+        y_unique,
+        multiplicity,
+        n_blocks,
+):
+    """
+    Computes ev_q_counts_phi[j] = sum_{u: y_unique[u] = j} multiplicity[u] *
+    theta_q_z[u].
+
+    The purchases are split into n_blocks contiguous blocks, each summed into
+    its own J x M buffer, after which the buffers are summed per product. The
+    result depends on n_blocks through the order of the summation.
+    """
+
+    dim_j, dim_m = ev_q_counts_phi.shape
+    n_purchases = len(y_unique)
+    partial_counts_phi = np.zeros((n_blocks, dim_j, dim_m))
+
+    for b in numba.prange(n_blocks):
+        for u in range(b * n_purchases // n_blocks, (b + 1) * n_purchases // n_blocks):
+            for m in range(dim_m):
+                partial_counts_phi[b, y_unique[u], m] += multiplicity[u] * theta_q_z[u, m]
+
+    for j in numba.prange(dim_j):
+        for m in range(dim_m):
+            ev_q_counts_phi[j, m] = 0.0
+            for b in range(n_blocks):
+                ev_q_counts_phi[j, m] += partial_counts_phi[b, j, m]
+
+
+@numba.jit(**settings.NUMBA_OPTIONS, parallel=True)
+def calc_ev_q_counts_phi_sorted(
+        ev_q_counts_phi,
+        theta_q_z,
+        multiplicity,
+        purchases_by_product,
+        product_lb,
+        product_ub,
+):
+    """
+    Computes ev_q_counts_phi[j] = sum_{u: y_unique[u] = j} multiplicity[u] *
+    theta_q_z[u].
+
+    The purchases of product j are purchases_by_product[product_lb[j]:
+    product_ub[j]], in increasing order. Every row is summed in the order of
+    the purchases, so the result does not depend on the number of threads.
+    """
 
-    ev_q_counts_phi[:] = 0.0
-    for n in range(data.ib_to_ibn_ub[-1]):
-        ev_q_counts_phi[data.y[n]] += theta_q_z[n]
+    dim_m = ev_q_counts_phi.shape[1]
+
+    for j in numba.prange(len(product_lb)):
+        for m in range(dim_m):
+            ev_q_counts_phi[j, m] = 0.0
+        for k in range(product_lb[j], product_ub[j]):
+            u = purchases_by_product[k]
+            for m in range(dim_m):
+                ev_q_counts_phi[j, m] += multiplicity[u] * theta_q_z[u, m]
 
 
 @numba.jit(**settings.NUMBA_OPTIONS)
@@ -524,6 +728,7 @@ def update_q_i(
         # # variables to be updated
         # z
         theta_q_z,
+        theta_q_z_offset,
         ev_q_counts_basket,
         ev_q_entropy_q_z,
         # alpha
@@ -547,6 +752,8 @@ def update_q_i(
         ev_q_eps_alpha,
         # others
         ev_q_log_phi,
+        exp_ev_q_log_phi,
+        max_ev_q_log_phi,
         ev_q_tau_alpha,
         ev_q_lambda_kappa_mmult_ev_q_mu_kappa,
         ev_q_rho,
@@ -560,11 +767,12 @@ def update_q_i(
         # settings
         vi_settings,
         is_fixed,
-        # efficient inverse
-        U_T_mmul_L_inv,
-        v,
-        log_det_C,
+        # q(kappa_i) covariance per number of baskets
+        cov_q_kappa,
+        log_det_cov_q_kappa,
+        cov_q_kappa_index,
         is_updated_mu_q,
+        scratch,
 ):
 
     i_to_ib_lb_i = data.i_to_ib_lb[i]
@@ -572,9 +780,16 @@ def update_q_i(
 
     is_updated_mu_q[i_to_ib_lb_i:i_to_ib_ub_i] = False
 
+    # Number of consecutive sub-iterations without a gain in the ELBO
+    n_quiet_steps = 0
+    n_steps = 0
+    total_elbo_gain = 0.0
+
     for step in range(vi_settings.n_q_i_steps):
 
         is_first_step = (step == 0)
+        n_steps += 1
+        elbo_gain = 0.0
 
         for ib in range(i_to_ib_lb_i, i_to_ib_ub_i):
 
@@ -585,15 +800,20 @@ def update_q_i(
                     ib=ib,
                     # variables to be updated
                     theta_q_z=theta_q_z,
+                    theta_q_z_offset=theta_q_z_offset,
                     ev_q_counts_basket=ev_q_counts_basket,
                     ev_q_entropy_q_z=ev_q_entropy_q_z,
                     # others
                     mu_q_alpha=mu_q_alpha,
                     ev_q_log_phi=ev_q_log_phi,
+                    exp_ev_q_log_phi=exp_ev_q_log_phi,
+                    max_ev_q_log_phi=max_ev_q_log_phi,
                     # data
-                    y=data.y,
-                    ib_to_ibn_lb_ib=data.ib_to_ibn_lb[ib],
-                    ib_to_ibn_ub_ib=data.ib_to_ibn_ub[ib],
+                    y_unique=data.y_unique,
+                    multiplicity=data.multiplicity,
+                    ib_to_iu_lb_ib=data.ib_to_iu_lb[ib],
+                    ib_to_iu_ub_ib=data.ib_to_iu_ub[ib],
+                    exp_mu_q_alpha_ib=scratch.exp_mu_q_alpha_ib,
                 )
 
             if not is_fixed.alpha:
@@ -601,6 +821,7 @@ def update_q_i(
                 (
                     updated_mu_q_ib,
                     updated_sigma_sq_q_ib,
+                    elbo_gain_ib,
                 ) = update_q_alpha_ib_ji(
                     ib=ib,
                     # variables to be updated
@@ -626,6 +847,7 @@ def update_q_i(
                     updated_mu_q=updated_mu_q,
                     updated_sigma_sq_q=updated_sigma_sq_q,
                     updated_both=updated_both,
+                    scratch=scratch,
                 )
 
                 if updated_mu_q_ib:
@@ -633,6 +855,8 @@ def update_q_i(
                 else:
                     is_updated_mu_q[ib] = False
 
+                elbo_gain += elbo_gain_ib
+
         # q(kappa_i) only has to be updated if at least one mu_q_alpha_ib is updated for this customer
         if (not is_fixed.kappa) and (is_first_step or np.any(is_updated_mu_q[i_to_ib_lb_i:i_to_ib_ub_i])):
 
@@ -652,46 +876,184 @@ def update_q_i(
                 M=dim_m,
                 i_to_ib_lb_i=i_to_ib_lb_i,
                 i_to_ib_ub_i=i_to_ib_ub_i,
-                # efficient inverse
-                U_T_mmul_L_inv=U_T_mmul_L_inv,
-                v=v,
-                log_det_C=log_det_C,
+                # q(kappa_i) covariance for the number of baskets of i
+                cov_q_i=cov_q_kappa[cov_q_kappa_index[i_to_ib_ub_i - i_to_ib_lb_i]],
+                log_det_cov_q_i=log_det_cov_q_kappa[cov_q_kappa_index[i_to_ib_ub_i - i_to_ib_lb_i]],
+                ev_q_mb_vector=scratch.ev_q_mb_vector,
             )
 
+        total_elbo_gain += elbo_gain
+
+        # Stop early if the q(alpha_ib) proposals of this customer did not
+        # increase the ELBO by more than q_i_tol for q_i_patience steps
+        if elbo_gain > vi_settings.q_i_tol:
+            n_quiet_steps = 0
+        else:
+            n_quiet_steps += 1
+            if n_quiet_steps == vi_settings.q_i_patience:
+                break
+
+    return n_steps, total_elbo_gain
+
 # Update q(z_ibn) (B.5)
 @numba.jit(**settings.NUMBA_OPTIONS)
 def update_q_z_ib(
         ib,
         # variables to be updated
         theta_q_z,
+        theta_q_z_offset,
         ev_q_counts_basket,
         ev_q_entropy_q_z,
         # others
         mu_q_alpha,
         ev_q_log_phi,
+        exp_ev_q_log_phi,
+        max_ev_q_log_phi,
         # data
-        y,
-        ib_to_ibn_lb_ib,
-        ib_to_ibn_ub_ib,
+        y_unique,
+        multiplicity,
+        ib_to_iu_lb_ib,
+        ib_to_iu_ub_ib,
+        # work array of length M
+        exp_mu_q_alpha_ib,
 ):
+    """
+    The repeated purchases of a product in a basket have the same q(z_ibn),
+    so q(z) is computed once per unique product u of the basket
+    (data.y_unique), and counts_basket and the entropy are weighted by the
+    number of purchases multiplicity[u]. theta_q_z[u - theta_q_z_offset] is
+    the q(z_ibn) of these purchases, ev_q_entropy_q_z[u] is their total
+    entropy.
+
+    theta_q_z[u] is proportional to exp(mu_q_alpha[ib]) * exp(ev_q_log_phi[j])
+    for j = y_unique[u]. With exp_ev_q_log_phi[j] = exp(ev_q_log_phi[j] -
+    max_ev_q_log_phi[j]), computed once per iteration (see
+    calc_exp_ev_q_log_phi), and exp(mu_q_alpha[ib]) computed once per basket,
+    this only takes M multiplications per product. The entropy follows from
+    the normalizer Z:
+
+        entropy = log Z - sum_m theta_q_z[u, m] * (mu_q_alpha[ib, m] + ev_q_log_phi[j, m])
+
+    If Z underflows, the log-sum-exp computation is used instead.
+    """
+
+    dim_m = mu_q_alpha.shape[1]
+    mu_q_alpha_ib = mu_q_alpha[ib]
+    max_mu_q_alpha_ib = np.max(mu_q_alpha_ib)
+    for m in range(dim_m):
+        exp_mu_q_alpha_ib[m] = np.exp(mu_q_alpha_ib[m] - max_mu_q_alpha_ib)
+
+    ev_q_counts_basket[ib] = 0.0
+
+    for u in range(ib_to_iu_lb_ib, ib_to_iu_ub_ib):
+
+        j = y_unique[u]
+        r = u - theta_q_z_offset
+
+        # Update q(z_ibn). The normalizer is summed in float64, such that it
+        # does not underflow when theta_q_z is stored as float32
+        normalizer = 0.0
+        for m in range(dim_m):
+            normalizer += exp_mu_q_alpha_ib[m] * exp_ev_q_log_phi[j, m]
+
+        if normalizer > MIN_NORMALIZER_Q_Z:
+
+            inv_normalizer = 1.0 / normalizer
+            ev_log_nominator = 0.0
+            for m in range(dim_m):
+                theta_q_z[r, m] = (
+                    exp_mu_q_alpha_ib[m] * exp_ev_q_log_phi[j, m]
+                ) * inv_normalizer
+                ev_log_nominator += theta_q_z[r, m] * (
+                    mu_q_alpha_ib[m] + ev_q_log_phi[j, m]
+                )
+
+            entropy_q_z_u = max(
+                np.log(normalizer) + max_mu_q_alpha_ib + max_ev_q_log_phi[j]
+                - ev_log_nominator,
+                0.0,
+            )
+
+        else:
 
-    for n in range(ib_to_ibn_lb_ib, ib_to_ibn_ub_ib):
+            # log-sum-exp of the log nominators mu_q_alpha_ib + ev_q_log_phi[j]
+            max_log_nominator = -np.inf
+            for m in range(dim_m):
+                max_log_nominator = max(
+                    max_log_nominator, mu_q_alpha_ib[m] + ev_q_log_phi[j, m]
+                )
+            sum_exp = 0.0
+            for m in range(dim_m):
+                sum_exp += np.exp(
+                    mu_q_alpha_ib[m] + ev_q_log_phi[j, m] - max_log_nominator
+                )
+            log_theta_q_z_ibn_denom = max_log_nominator + np.log(sum_exp)
 
-        # Update q(z_ibn)
-        log_theta_q_z_ibn_nom = mu_q_alpha[ib] + ev_q_log_phi[y[n]] # nominator 
-        log_theta_q_z_ibn_denom = misc.log_sum_exp(log_theta_q_z_ibn_nom) # denominator 
-        theta_q_z[n] = np.exp(log_theta_q_z_ibn_nom - log_theta_q_z_ibn_denom)
+            entropy_q_z_u = 0.0
+            for m in range(dim_m):
+                log_theta_q_z_ibnm = (
+                    mu_q_alpha_ib[m] + ev_q_log_phi[j, m] - log_theta_q_z_ibn_denom
+                )
+                theta_q_z[r, m] = np.exp(log_theta_q_z_ibnm)
+                entropy_q_z_u -= log_theta_q_z_ibnm * theta_q_z[r, m]
 
         # Update q(z_ibn) caches
         # Note: ev_q_counts_phi is updated outside of this function
-        ev_q_entropy_q_z[n] = -np.sum(
-            (log_theta_q_z_ibn_nom - log_theta_q_z_ibn_denom) * theta_q_z[n]
-        )
+        ev_q_entropy_q_z[u] = multiplicity[u] * entropy_q_z_u
+        for m in range(dim_m):
+            ev_q_counts_basket[ib, m] += multiplicity[u] * theta_q_z[r, m]
 
-    ev_q_counts_basket[ib] = np.sum(
-        theta_q_z[ib_to_ibn_lb_ib:ib_to_ibn_ub_ib],
-        axis=0,
-    )
+
+@numba.jit(**settings.NUMBA_OPTIONS, parallel=True)
+def calc_theta_q_z(
+        theta_q_z,
+        mu_q_alpha,
+        ev_q_log_phi,
+        y_unique,
+        ib_to_iu_lb,
+        ib_to_iu_ub,
+):
+    """
+    Computes q(z_ibn) of all entries of y_unique from mu_q_alpha and
+    ev_q_log_phi, into theta_q_z of any floating point type (e.g. a float32
+    memory map).
+
+    Used to export q(z) when it is not kept during the optimization (see
+    update_q_local). As q(z_ib) is computed before the last q(alpha_ib)
+    update of a basket, the result can differ slightly from the q(z) that
+    was used for counts_basket.
+    """
+
+    dim_m = mu_q_alpha.shape[1]
+
+    for ib in numba.prange(len(ib_to_iu_lb)):
+        for u in range(ib_to_iu_lb[ib], ib_to_iu_ub[ib]):
+            log_theta_q_z_ibn_nom = mu_q_alpha[ib] + ev_q_log_phi[y_unique[u]]
+            log_theta_q_z_ibn_denom = misc.log_sum_exp(log_theta_q_z_ibn_nom)
+            for m in range(dim_m):
+                theta_q_z[u, m] = np.exp(
+                    log_theta_q_z_ibn_nom[m] - log_theta_q_z_ibn_denom
+                )
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def calc_exp_ev_q_log_phi(ev_q_log_phi):
+    """
+    Returns exp(ev_q_log_phi[j] - max_ev_q_log_phi[j]), with the floating
+    point type of ev_q_log_phi, and max_ev_q_log_phi, the maximum of
+    ev_q_log_phi[j] per product j (see update_q_z_ib).
+    """
+
+    dim_j, dim_m = ev_q_log_phi.shape
+    exp_ev_q_log_phi = np.empty_like(ev_q_log_phi)
+    max_ev_q_log_phi = np.empty(dim_j)
+
+    for j in range(dim_j):
+        max_ev_q_log_phi[j] = np.max(ev_q_log_phi[j])
+        for m in range(dim_m):
+            exp_ev_q_log_phi[j, m] = np.exp(ev_q_log_phi[j, m] - max_ev_q_log_phi[j])
+
+    return exp_ev_q_log_phi, max_ev_q_log_phi
 
 # The process of updating mu and sigma for alpha 
 @numba.jit(**settings.NUMBA_OPTIONS)
@@ -721,19 +1083,32 @@ def update_q_alpha_ib_ji(
         updated_mu_q,
         updated_sigma_sq_q,
         updated_both,
+        # work arrays (see LocalScratch)
+        scratch,
 ):
-    ev_q_mu_ib = mu_q_alpha[ib] - ev_q_eps_alpha[ib]
+    ev_q_mu_ib = scratch.ev_q_mu_ib
+    cleaned_ev_q_eps_alpha_ib_next = scratch.cleaned_ev_q_eps_alpha_ib_next
+    ev_q_tau_cleaned_rho = scratch.ev_q_tau_cleaned_rho
+
+    for m in range(dim_m):
+        ev_q_mu_ib[m] = mu_q_alpha[ib, m] - ev_q_eps_alpha[ib, m]
 
     if ib_not_last[ib]:
-        cleaned_ev_q_eps_alpha_ib_next = (
-            ev_q_eps_alpha[ib + 1] + ev_q_rho @ mu_q_alpha[ib]
-        )
+        for m in range(dim_m):
+            ev_q_rho_mu_q_ib_m = 0.0
+            for k in range(dim_m):
+                ev_q_rho_mu_q_ib_m += ev_q_rho[m, k] * mu_q_alpha[ib, k]
+            cleaned_ev_q_eps_alpha_ib_next[m] = (
+                ev_q_eps_alpha[ib + 1, m] + ev_q_rho_mu_q_ib_m
+            )
     else:
-        cleaned_ev_q_eps_alpha_ib_next = np.zeros(dim_m)
+        cleaned_ev_q_eps_alpha_ib_next[:] = 0.0
 
-    ev_q_tau_cleaned_rho = (
-        (ev_q_tau_alpha * cleaned_ev_q_eps_alpha_ib_next) @ ev_q_rho
-    )
+    ev_q_tau_cleaned_rho[:] = 0.0
+    for m in range(dim_m):
+        tau_cleaned_m = ev_q_tau_alpha[m] * cleaned_ev_q_eps_alpha_ib_next[m]
+        for k in range(dim_m):
+            ev_q_tau_cleaned_rho[k] += tau_cleaned_m * ev_q_rho[m, k]
 
     pre_update_elbo = elbo_propto_q_alpha_ib_cached_ji(
         mu_q_alpha_ib=mu_q_alpha[ib],
@@ -752,11 +1127,10 @@ def update_q_alpha_ib_ji(
 
     current_elbo = pre_update_elbo
 
-    # Update mu_q_ib
+    # Update mu_q_ib, which also sets scratch.ev_q_theta_nominator_ib
     (
         updated_mu_q_ib,
         current_elbo,
-        ev_q_theta_nominator_ib,
     ) = update_q_alpha_ib_ji_mu(
         ib=ib,
         # variables to be updated
@@ -777,41 +1151,68 @@ def update_q_alpha_ib_ji(
         ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
         ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
         ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
+        dim_m=dim_m,
         dim_n=dim_n,
         ib_not_last=ib_not_last,
         vi_settings=vi_settings,
+        scratch=scratch,
     )
 
     if updated_mu_q_ib:
         updated_mu_q[ib] += 1
 
     # Update sigma_sq_q_ib
-    (
-        updated_sigma_sq_q_ib,
-        current_elbo,
-    ) = update_q_alpha_ib_ji_sigma_sq(
-        ib=ib,
-        # variables to be updated
-        sigma_sq_q_alpha=sigma_sq_q_alpha,
-        ss_log_sigma_q=ss_log_sigma_q,
-        ev_q_alpha_sq=ev_q_alpha_sq,
-        ev_q_entropy_q_alpha=ev_q_entropy_q_alpha,
-        ev_q_log_theta_denom_approx=ev_q_log_theta_denom_approx,
-        # other
-        mu_q_alpha=mu_q_alpha,
-        ev_q_theta_nominator_ib=ev_q_theta_nominator_ib,
-        current_elbo=current_elbo,
-        ev_q_mu_ib=ev_q_mu_ib,
-        ev_q_counts_basket=ev_q_counts_basket,
-        ev_q_tau_alpha=ev_q_tau_alpha,
-        ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
-        ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
-        ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
-        dim_m=dim_m,
-        dim_n=dim_n,
-        ib_not_last=ib_not_last,
-        vi_settings=vi_settings,
-    )
+    if vi_settings.sigma_sq_fixed_point:
+        (
+            updated_sigma_sq_q_ib,
+            current_elbo,
+        ) = update_q_alpha_ib_ji_sigma_sq_fixed_point(
+            ib=ib,
+            # variables to be updated
+            sigma_sq_q_alpha=sigma_sq_q_alpha,
+            ev_q_alpha_sq=ev_q_alpha_sq,
+            ev_q_entropy_q_alpha=ev_q_entropy_q_alpha,
+            ev_q_log_theta_denom_approx=ev_q_log_theta_denom_approx,
+            # other
+            mu_q_alpha=mu_q_alpha,
+            ev_q_theta_nominator_ib=scratch.ev_q_theta_nominator_ib,
+            current_elbo=current_elbo,
+            ev_q_tau_alpha=ev_q_tau_alpha,
+            ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+            dim_m=dim_m,
+            dim_n=dim_n,
+            ib_not_last=ib_not_last,
+            vi_settings=vi_settings,
+            scratch=scratch,
+        )
+    else:
+        (
+            updated_sigma_sq_q_ib,
+            current_elbo,
+        ) = update_q_alpha_ib_ji_sigma_sq(
+            ib=ib,
+            # variables to be updated
+            sigma_sq_q_alpha=sigma_sq_q_alpha,
+            ss_log_sigma_q=ss_log_sigma_q,
+            ev_q_alpha_sq=ev_q_alpha_sq,
+            ev_q_entropy_q_alpha=ev_q_entropy_q_alpha,
+            ev_q_log_theta_denom_approx=ev_q_log_theta_denom_approx,
+            # other
+            mu_q_alpha=mu_q_alpha,
+            ev_q_theta_nominator_ib=scratch.ev_q_theta_nominator_ib,
+            current_elbo=current_elbo,
+            ev_q_mu_ib=ev_q_mu_ib,
+            ev_q_counts_basket=ev_q_counts_basket,
+            ev_q_tau_alpha=ev_q_tau_alpha,
+            ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
+            ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+            ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
+            dim_m=dim_m,
+            dim_n=dim_n,
+            ib_not_last=ib_not_last,
+            vi_settings=vi_settings,
+            scratch=scratch,
+        )
 
     if updated_sigma_sq_q_ib:
         updated_sigma_sq_q[ib] += 1
@@ -819,7 +1220,7 @@ def update_q_alpha_ib_ji(
     if updated_mu_q_ib and updated_sigma_sq_q_ib:
         updated_both[ib] += 1
 
-    return updated_mu_q_ib, updated_sigma_sq_q_ib
+    return updated_mu_q_ib, updated_sigma_sq_q_ib, current_elbo - pre_update_elbo
 
 
 @numba.jit(**settings.NUMBA_OPTIONS)
@@ -837,27 +1238,29 @@ def elbo_propto_q_alpha_ib_cached_ji(
         ib_not_last_ib,
         ev_q_tau_cleaned_rho,
 ):
+    # The inner products are written as loops, which do not allocate
+    dim_m = len(mu_q_alpha_ib)
 
-    ev_q_log_p_alpha_ib_propto_q_alpha_ib = (
-        - 0.5 * ev_q_tau_alpha @ (sigma_sq_q_alpha_ib + mu_q_alpha_ib**2)
-        +
-        (ev_q_tau_alpha * ev_q_mu_ib) @ mu_q_alpha_ib
-    )
-
-    ev_q_log_p_z_ib_propto_q_alpha_ib = (
-        ev_q_counts_basket_ib @ mu_q_alpha_ib
-        -
-        n_ib * ev_q_log_theta_denom_approx_ib
-    )
+    ev_q_log_p_alpha_ib_propto_q_alpha_ib = 0.0
+    ev_q_log_p_z_ib_propto_q_alpha_ib = - n_ib * ev_q_log_theta_denom_approx_ib
+    for m in range(dim_m):
+        ev_q_log_p_alpha_ib_propto_q_alpha_ib += ev_q_tau_alpha[m] * (
+            - 0.5 * (sigma_sq_q_alpha_ib[m] + mu_q_alpha_ib[m]**2)
+            + ev_q_mu_ib[m] * mu_q_alpha_ib[m]
+        )
+        ev_q_log_p_z_ib_propto_q_alpha_ib += ev_q_counts_basket_ib[m] * mu_q_alpha_ib[m]
 
+    ev_q_log_p_alpha_ib_next_q_alpha_ib = 0.0
     if ib_not_last_ib:
-        ev_q_log_p_alpha_ib_next_q_alpha_ib = (
-            - 0.5 * ev_q_sum_m_tau_alpha_m_diag_rho_outer_m @ sigma_sq_q_alpha_ib
-            - 0.5 * mu_q_alpha_ib.T @ ev_q_sum_m_tau_alpha_m_rho_outer_m @ mu_q_alpha_ib
-            + ev_q_tau_cleaned_rho @ mu_q_alpha_ib
-        )
-    else:
-        ev_q_log_p_alpha_ib_next_q_alpha_ib = 0.0
+        for m in range(dim_m):
+            rho_outer_mu_q_m = 0.0
+            for k in range(dim_m):
+                rho_outer_mu_q_m += ev_q_sum_m_tau_alpha_m_rho_outer_m[m, k] * mu_q_alpha_ib[k]
+            ev_q_log_p_alpha_ib_next_q_alpha_ib += (
+                - 0.5 * ev_q_sum_m_tau_alpha_m_diag_rho_outer_m[m] * sigma_sq_q_alpha_ib[m]
+                - 0.5 * mu_q_alpha_ib[m] * rho_outer_mu_q_m
+                + ev_q_tau_cleaned_rho[m] * mu_q_alpha_ib[m]
+            )
 
     current_elbo = (
         ev_q_log_p_alpha_ib_propto_q_alpha_ib
@@ -893,16 +1296,23 @@ def update_q_alpha_ib_ji_mu(
         ev_q_sum_m_tau_alpha_m_rho_outer_m,
         ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
         ev_q_tau_cleaned_rho,
+        dim_m,
         dim_n,
         ib_not_last,
         vi_settings,
+        # work arrays (see LocalScratch)
+        scratch,
 ):
     # Compute gradient
-    ev_q_theta_nominator_ib = np.exp(
-        mu_q_alpha[ib] + 0.5 * sigma_sq_q_alpha[ib]
-    )
+    ev_q_theta_nominator_ib = scratch.ev_q_theta_nominator_ib
+    for m in range(dim_m):
+        ev_q_theta_nominator_ib[m] = np.exp(
+            mu_q_alpha[ib, m] + 0.5 * sigma_sq_q_alpha[ib, m]
+        )
 
-    gradient_mu_q_ib = grad_mu_q_alpha_ib_cached_ji(
+    gradient_mu_q_ib = scratch.gradient
+    grad_mu_q_alpha_ib_cached_ji(
+        gradient_mu_q_ib=gradient_mu_q_ib,
         mu_q_alpha_ib=mu_q_alpha[ib],
         ev_q_theta_nominator_ib=ev_q_theta_nominator_ib,
         ev_q_mu_ib=ev_q_mu_ib,
@@ -914,58 +1324,100 @@ def update_q_alpha_ib_ji_mu(
         ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
     )
 
-    # Create candidates
-    candidate_mu_q = mu_q_alpha[ib] + ss_mu_q[ib] * gradient_mu_q_ib
+    is_newton = vi_settings.q_alpha_method == 'newton'
 
-    candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_ji(
-        mu_q=candidate_mu_q,
-        sigma_sq_q=sigma_sq_q_alpha[ib],
-    )
+    if is_newton:
+        # Newton direction, the step is halved until the ELBO increases
+        direction_mu_q_ib = np.linalg.solve(
+            -hess_mu_q_alpha_ib_cached_ji(
+                ev_q_theta_nominator_ib=ev_q_theta_nominator_ib,
+                ev_q_tau_alpha=ev_q_tau_alpha,
+                ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
+                n_ib=dim_n[ib],
+                is_not_last_ib=ib_not_last[ib],
+            ),
+            gradient_mu_q_ib,
+        )
+        step_size = 1.0
+        n_proposals = vi_settings.newton_max_halvings + 1
 
-    candidate_elbo = elbo_propto_q_alpha_ib_cached_ji(
-        mu_q_alpha_ib=candidate_mu_q,
-        sigma_sq_q_alpha_ib=sigma_sq_q_alpha[ib],
-        ev_q_log_theta_denom_approx_ib=candidate_ev_q_log_theta_denom_approx_ib,
-        entropy_q_alpha_ib=ev_q_entropy_q_alpha[ib],
-        ev_q_mu_ib=ev_q_mu_ib,
-        ev_q_counts_basket_ib=ev_q_counts_basket[ib],
-        ev_q_tau_alpha=ev_q_tau_alpha,
-        ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
-        ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
-        n_ib=dim_n[ib],
-        ib_not_last_ib=ib_not_last[ib],
-        ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
-    )
+        # No proposal if the predicted increase of the ELBO is too small
+        if 0.5 * gradient_mu_q_ib @ direction_mu_q_ib <= vi_settings.min_elbo_diff:
+            n_proposals = 0
+    else:
+        direction_mu_q_ib = gradient_mu_q_ib
+        step_size = ss_mu_q[ib]
+        n_proposals = 1
+
+    updated_mu_q_ib = False
+    candidate_mu_q = scratch.candidate
+    candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_approx[ib]
+    candidate_elbo = current_elbo
 
-    if candidate_elbo - current_elbo > vi_settings.min_elbo_diff:
+    for _ in range(n_proposals):
 
-        updated_mu_q_ib = True
+        # Create candidates
+        for m in range(dim_m):
+            candidate_mu_q[m] = mu_q_alpha[ib, m] + step_size * direction_mu_q_ib[m]
 
-        # Update mu_q_ib
-        mu_q_alpha[ib] = candidate_mu_q
+        candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_ji(
+            mu_q=candidate_mu_q,
+            sigma_sq_q=sigma_sq_q_alpha[ib],
+        )
 
-        # Update mu_q_ib caches
-        ev_q_alpha_sq[ib] = sigma_sq_q_alpha[ib] + candidate_mu_q**2
-        ev_q_log_theta_denom_approx[ib] = candidate_ev_q_log_theta_denom_approx_ib
+        candidate_elbo = elbo_propto_q_alpha_ib_cached_ji(
+            mu_q_alpha_ib=candidate_mu_q,
+            sigma_sq_q_alpha_ib=sigma_sq_q_alpha[ib],
+            ev_q_log_theta_denom_approx_ib=candidate_ev_q_log_theta_denom_approx_ib,
+            entropy_q_alpha_ib=ev_q_entropy_q_alpha[ib],
+            ev_q_mu_ib=ev_q_mu_ib,
+            ev_q_counts_basket_ib=ev_q_counts_basket[ib],
+            ev_q_tau_alpha=ev_q_tau_alpha,
+            ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
+            ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+            n_ib=dim_n[ib],
+            ib_not_last_ib=ib_not_last[ib],
+            ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
+        )
+
+        if candidate_elbo - current_elbo > vi_settings.min_elbo_diff:
+            updated_mu_q_ib = True
+            break
 
-        ev_q_theta_nominator_ib = np.exp(candidate_mu_q + 0.5 * sigma_sq_q_alpha[ib])
+        step_size *= 0.5
+
+    if updated_mu_q_ib:
+
+        # Update mu_q_ib and its caches
+        ev_q_log_theta_denom_approx[ib] = candidate_ev_q_log_theta_denom_approx_ib
+        for m in range(dim_m):
+            mu_q_alpha[ib, m] = candidate_mu_q[m]
+            ev_q_alpha_sq[ib, m] = sigma_sq_q_alpha[ib, m] + candidate_mu_q[m]**2
+            ev_q_theta_nominator_ib[m] = np.exp(
+                candidate_mu_q[m] + 0.5 * sigma_sq_q_alpha[ib, m]
+            )
 
-        # eps_alpha_ib
-        ev_q_eps_alpha[ib] = candidate_mu_q - ev_q_mu_ib
+            # eps_alpha_ib
+            ev_q_eps_alpha[ib, m] = candidate_mu_q[m] - ev_q_mu_ib[m]
 
         if ib_not_last[ib]:
-            ev_q_eps_alpha[ib + 1] = cleaned_ev_q_eps_alpha_ib_next - ev_q_rho @ candidate_mu_q
+            for m in range(dim_m):
+                ev_q_rho_mu_q_ib_m = 0.0
+                for k in range(dim_m):
+                    ev_q_rho_mu_q_ib_m += ev_q_rho[m, k] * candidate_mu_q[k]
+                ev_q_eps_alpha[ib + 1, m] = (
+                    cleaned_ev_q_eps_alpha_ib_next[m] - ev_q_rho_mu_q_ib_m
+                )
 
         current_elbo = candidate_elbo
 
         # Increase the step size
-        ss_mu_q[ib] = min(
-            ss_mu_q[ib] * vi_settings.ss_factor,
-            vi_settings.ss_max
-        )
-    else:
-
-        updated_mu_q_ib = False
+        if not is_newton:
+            ss_mu_q[ib] = min(
+                ss_mu_q[ib] * vi_settings.ss_factor,
+                vi_settings.ss_max
+            )
+    elif not is_newton:
 
         # Decrease the step size
         ss_mu_q[ib] = max(
@@ -973,11 +1425,12 @@ def update_q_alpha_ib_ji_mu(
             vi_settings.ss_min
         )
 
-    return updated_mu_q_ib, current_elbo, ev_q_theta_nominator_ib
+    return updated_mu_q_ib, current_elbo
 
 
 @numba.jit(**settings.NUMBA_OPTIONS)
 def grad_mu_q_alpha_ib_cached_ji(
+        gradient_mu_q_ib,
         mu_q_alpha_ib,
         ev_q_theta_nominator_ib,
         ev_q_mu_ib,
@@ -988,37 +1441,100 @@ def grad_mu_q_alpha_ib_cached_ji(
         is_not_last_ib,
         ev_q_tau_cleaned_rho,
 ):
-    grad_mu_q_alpha_ib_log_p_alpha_ib = (
-        ev_q_tau_alpha * (ev_q_mu_ib - mu_q_alpha_ib)
-    )
+    """Writes the gradient with respect to mu_q_alpha_ib into gradient_mu_q_ib."""
 
-    grad_mu_q_alpha_ib_log_p_z_ib = (
-        ev_q_counts_basket_ib
-        -
-        n_ib * ev_q_theta_nominator_ib / np.sum(ev_q_theta_nominator_ib)
-    )
+    dim_m = len(mu_q_alpha_ib)
+    sum_theta_nominator_ib = np.sum(ev_q_theta_nominator_ib)
 
-    if is_not_last_ib:
-        grad_mu_q_alpha_ib_log_p_alpha_ib_next = (
-            - ev_q_sum_m_tau_alpha_m_rho_outer_m @ mu_q_alpha_ib
-            + ev_q_tau_cleaned_rho
+    for m in range(dim_m):
+        grad_mu_q_alpha_ib_log_p_alpha_ib = (
+            ev_q_tau_alpha[m] * (ev_q_mu_ib[m] - mu_q_alpha_ib[m])
         )
 
-        gradient_mu_q_ib = (
-            grad_mu_q_alpha_ib_log_p_alpha_ib
-            +
-            grad_mu_q_alpha_ib_log_p_z_ib
-            +
-            grad_mu_q_alpha_ib_log_p_alpha_ib_next
+        grad_mu_q_alpha_ib_log_p_z_ib = (
+            ev_q_counts_basket_ib[m]
+            -
+            n_ib * ev_q_theta_nominator_ib[m] / sum_theta_nominator_ib
         )
-    else:
-        gradient_mu_q_ib = (
+
+        gradient_mu_q_ib[m] = (
             grad_mu_q_alpha_ib_log_p_alpha_ib
             +
             grad_mu_q_alpha_ib_log_p_z_ib
         )
 
-    return gradient_mu_q_ib
+        if is_not_last_ib:
+            rho_outer_mu_q_m = 0.0
+            for k in range(dim_m):
+                rho_outer_mu_q_m += ev_q_sum_m_tau_alpha_m_rho_outer_m[m, k] * mu_q_alpha_ib[k]
+
+            gradient_mu_q_ib[m] += - rho_outer_mu_q_m + ev_q_tau_cleaned_rho[m]
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def hess_mu_q_alpha_ib_cached_ji(
+        ev_q_theta_nominator_ib,
+        ev_q_tau_alpha,
+        ev_q_sum_m_tau_alpha_m_rho_outer_m,
+        n_ib,
+        is_not_last_ib,
+):
+    """
+    Hessian of the ELBO with respect to mu_q_alpha_ib (see
+    grad_mu_q_alpha_ib_cached_ji). With p the softmax of mu_q_alpha_ib +
+    0.5 * sigma_sq_q_alpha_ib, it is
+
+        - diag(tau_alpha) - n_ib * (diag(p) - p p^T) - sum_m tau_alpha_m rho_m rho_m^T
+
+    where the last term only applies if ib is not the last basket. It is
+    negative definite.
+    """
+
+    p = ev_q_theta_nominator_ib / np.sum(ev_q_theta_nominator_ib)
+
+    hessian = n_ib * np.outer(p, p) - np.diag(ev_q_tau_alpha + n_ib * p)
+
+    if is_not_last_ib:
+        hessian -= ev_q_sum_m_tau_alpha_m_rho_outer_m
+
+    return hessian
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def hess_log_sigma_q_alpha_ib_cached_ji(
+        sigma_sq_q_alpha_ib,
+        ev_q_theta_nominator_ib,
+        ev_q_tau_alpha,
+        ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+        n_ib,
+        is_not_last_ib,
+):
+    """
+    Hessian of the ELBO with respect to log sigma_q_alpha_ib. With s =
+    sigma_sq_q_alpha_ib, p the softmax of mu_q_alpha_ib + 0.5 * s and a =
+    tau_alpha (+ diag(sum_m tau_alpha_m rho_m rho_m^T) if ib is not the last
+    basket), the gradient is 1 - a * s - n_ib * p * s, and the Hessian is
+
+        n_ib * (p s)(p s)^T - diag(2 * a * s + n_ib * p * s**2 + 2 * n_ib * p * s)
+
+    As the ELBO is concave in log sigma_q_alpha_ib, it is negative definite.
+    """
+
+    p = ev_q_theta_nominator_ib / np.sum(ev_q_theta_nominator_ib)
+
+    a = ev_q_tau_alpha.copy()
+    if is_not_last_ib:
+        a += ev_q_sum_m_tau_alpha_m_diag_rho_outer_m
+
+    p_s = p * sigma_sq_q_alpha_ib
+
+    return n_ib * np.outer(p_s, p_s) - np.diag(
+        2 * a * sigma_sq_q_alpha_ib
+        +
+        n_ib * p_s * sigma_sq_q_alpha_ib
+        +
+        2 * n_ib * p_s
+    )
 
 
 @numba.jit(**settings.NUMBA_OPTIONS)
@@ -1044,9 +1560,13 @@ def update_q_alpha_ib_ji_sigma_sq(
         dim_n,
         ib_not_last,
         vi_settings,
+        # work arrays (see LocalScratch)
+        scratch,
 ):
 
-    gradient_sigma_sq_q_ib = grad_sigma_sq_q_alpha_ib_cached_ji(
+    gradient_log_sigma_q = scratch.gradient
+    grad_sigma_sq_q_alpha_ib_cached_ji(
+        gradient_sigma_sq_q_ib=gradient_log_sigma_q,
         sigma_sq_q_alpha_ib=sigma_sq_q_alpha[ib],
         ev_q_theta_nominator_ib=ev_q_theta_nominator_ib,
         ev_q_tau_ib=ev_q_tau_alpha,
@@ -1055,63 +1575,102 @@ def update_q_alpha_ib_ji_sigma_sq(
         is_not_last_ib=ib_not_last[ib],
     )
 
-    gradient_log_sigma_q = (
-        2 * sigma_sq_q_alpha[ib] * gradient_sigma_sq_q_ib
-    )
+    # Gradient with respect to log sigma_q_alpha_ib
+    for m in range(dim_m):
+        gradient_log_sigma_q[m] *= 2 * sigma_sq_q_alpha[ib, m]
 
-    cand_log_sigma_q = (
-        0.5 * np.log(sigma_sq_q_alpha[ib])
-        +
-        ss_log_sigma_q[ib] * gradient_log_sigma_q
-    )
-    candidate_sigma_sq_q = np.exp(2 * cand_log_sigma_q)
+    is_newton = vi_settings.q_alpha_method == 'newton'
 
-    candidate_entropy_q_alpha_ib = (
-        0.5 * dim_m * LOG_2PI_E + np.sum(cand_log_sigma_q)
-    )
+    if is_newton:
+        # Newton direction, the step is halved until the ELBO increases
+        direction_log_sigma_q = np.linalg.solve(
+            -hess_log_sigma_q_alpha_ib_cached_ji(
+                sigma_sq_q_alpha_ib=sigma_sq_q_alpha[ib],
+                ev_q_theta_nominator_ib=ev_q_theta_nominator_ib,
+                ev_q_tau_alpha=ev_q_tau_alpha,
+                ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+                n_ib=dim_n[ib],
+                is_not_last_ib=ib_not_last[ib],
+            ),
+            gradient_log_sigma_q,
+        )
+        step_size = 1.0
+        n_proposals = vi_settings.newton_max_halvings + 1
 
-    candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_ji(
-        mu_q=mu_q_alpha[ib],
-        sigma_sq_q=candidate_sigma_sq_q,
-    )
+        # No proposal if the predicted increase of the ELBO is too small
+        if 0.5 * gradient_log_sigma_q @ direction_log_sigma_q <= vi_settings.min_elbo_diff:
+            n_proposals = 0
+    else:
+        direction_log_sigma_q = gradient_log_sigma_q
+        step_size = ss_log_sigma_q[ib]
+        n_proposals = 1
 
-    candidate_elbo = elbo_propto_q_alpha_ib_cached_ji(
-        mu_q_alpha_ib=mu_q_alpha[ib],
-        sigma_sq_q_alpha_ib=candidate_sigma_sq_q,
-        ev_q_log_theta_denom_approx_ib=candidate_ev_q_log_theta_denom_approx_ib,
-        entropy_q_alpha_ib=candidate_entropy_q_alpha_ib,
-        ev_q_mu_ib=ev_q_mu_ib,
-        ev_q_counts_basket_ib=ev_q_counts_basket[ib],
-        ev_q_tau_alpha=ev_q_tau_alpha,
-        ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
-        ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
-        n_ib=dim_n[ib],
-        ib_not_last_ib=ib_not_last[ib],
-        ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
-    )
+    updated_sigma_sq_q_ib = False
+    candidate_sigma_sq_q = scratch.candidate
+    candidate_entropy_q_alpha_ib = ev_q_entropy_q_alpha[ib]
+    candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_approx[ib]
+    candidate_elbo = current_elbo
+
+    for _ in range(n_proposals):
+
+        sum_cand_log_sigma_q = 0.0
+        for m in range(dim_m):
+            cand_log_sigma_q_m = (
+                0.5 * np.log(sigma_sq_q_alpha[ib, m])
+                +
+                step_size * direction_log_sigma_q[m]
+            )
+            candidate_sigma_sq_q[m] = np.exp(2 * cand_log_sigma_q_m)
+            sum_cand_log_sigma_q += cand_log_sigma_q_m
+
+        candidate_entropy_q_alpha_ib = (
+            0.5 * dim_m * LOG_2PI_E + sum_cand_log_sigma_q
+        )
+
+        candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_ji(
+            mu_q=mu_q_alpha[ib],
+            sigma_sq_q=candidate_sigma_sq_q,
+        )
+
+        candidate_elbo = elbo_propto_q_alpha_ib_cached_ji(
+            mu_q_alpha_ib=mu_q_alpha[ib],
+            sigma_sq_q_alpha_ib=candidate_sigma_sq_q,
+            ev_q_log_theta_denom_approx_ib=candidate_ev_q_log_theta_denom_approx_ib,
+            entropy_q_alpha_ib=candidate_entropy_q_alpha_ib,
+            ev_q_mu_ib=ev_q_mu_ib,
+            ev_q_counts_basket_ib=ev_q_counts_basket[ib],
+            ev_q_tau_alpha=ev_q_tau_alpha,
+            ev_q_sum_m_tau_alpha_m_rho_outer_m=ev_q_sum_m_tau_alpha_m_rho_outer_m,
+            ev_q_sum_m_tau_alpha_m_diag_rho_outer_m=ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+            n_ib=dim_n[ib],
+            ib_not_last_ib=ib_not_last[ib],
+            ev_q_tau_cleaned_rho=ev_q_tau_cleaned_rho,
+        )
 
-    if candidate_elbo - current_elbo > vi_settings.min_elbo_diff:
+        if candidate_elbo - current_elbo > vi_settings.min_elbo_diff:
+            updated_sigma_sq_q_ib = True
+            break
 
-        updated_sigma_sq_q_ib = True
+        step_size *= 0.5
 
-        # Update q(alpha_ib)
-        sigma_sq_q_alpha[ib] = candidate_sigma_sq_q
+    if updated_sigma_sq_q_ib:
 
-        # Update q(alpha_ib) caches
-        ev_q_alpha_sq[ib] = candidate_sigma_sq_q + mu_q_alpha[ib]**2
+        # Update q(alpha_ib) and its caches
+        for m in range(dim_m):
+            sigma_sq_q_alpha[ib, m] = candidate_sigma_sq_q[m]
+            ev_q_alpha_sq[ib, m] = candidate_sigma_sq_q[m] + mu_q_alpha[ib, m]**2
         ev_q_log_theta_denom_approx[ib] = candidate_ev_q_log_theta_denom_approx_ib
         ev_q_entropy_q_alpha[ib] = candidate_entropy_q_alpha_ib
 
         current_elbo = candidate_elbo
 
         # Increase the step size
-        ss_log_sigma_q[ib] = min(
-            ss_log_sigma_q[ib] * vi_settings.ss_factor,
-            vi_settings.ss_max
-        )
-    else:
-
-        updated_sigma_sq_q_ib = False
+        if not is_newton:
+            ss_log_sigma_q[ib] = min(
+                ss_log_sigma_q[ib] * vi_settings.ss_factor,
+                vi_settings.ss_max
+            )
+    elif not is_newton:
 
         # Decrease the step size
         ss_log_sigma_q[ib] = max(
@@ -1122,8 +1681,137 @@ def update_q_alpha_ib_ji_sigma_sq(
     return updated_sigma_sq_q_ib, current_elbo
 
 
+@numba.jit(**settings.NUMBA_OPTIONS)
+def update_q_alpha_ib_ji_sigma_sq_fixed_point(
+        ib,
+        # variables to be updated
+        sigma_sq_q_alpha,
+        ev_q_alpha_sq,
+        ev_q_entropy_q_alpha,
+        ev_q_log_theta_denom_approx,
+        # other
+        mu_q_alpha,
+        ev_q_theta_nominator_ib,
+        current_elbo,
+        ev_q_tau_alpha,
+        ev_q_sum_m_tau_alpha_m_diag_rho_outer_m,
+        dim_m,
+        dim_n,
+        ib_not_last,
+        vi_settings,
+        # work arrays (see LocalScratch)
+        scratch,
+):
+    """
+    Damped fixed-point update of sigma_sq_q_alpha_ib.
+
+    The gradient with respect to sigma_sq_q_alpha_ib (see
+    grad_sigma_sq_q_alpha_ib_cached_ji) is zero at
+
+        1 / sigma_sq_q_alpha_ib = a + n_ib * p
+
+    with a = tau_alpha (+ diag(sum_m tau_alpha_m rho_m rho_m^T) if ib is not
+    the last basket) and p the softmax of mu_q_alpha_ib + 0.5 *
+    sigma_sq_q_alpha_ib. log sigma_q_alpha_ib is moved a fraction
+    sigma_sq_damping towards this point, with p at the current
+    sigma_sq_q_alpha_ib. The update is accepted if it increases the ELBO,
+    otherwise the fraction is halved at most sigma_sq_max_halvings times.
+
+    Only the terms of the ELBO that depend on sigma_sq_q_alpha_ib are
+    evaluated (see elbo_propto_sigma_sq_q_alpha_ib), which takes O(M)
+    operations instead of the O(M^2) of elbo_propto_q_alpha_ib_cached_ji.
+    """
+
+    n_ib = dim_n[ib]
+    sum_theta_nominator_ib = np.sum(ev_q_theta_nominator_ib)
+
+    # a in prior_precision_ib, the full step of log sigma_sq_q_alpha_ib in
+    # gradient
+    a = scratch.prior_precision_ib
+    step_log_sigma_sq_q = scratch.gradient
+    for m in range(dim_m):
+        a[m] = ev_q_tau_alpha[m]
+        if ib_not_last[ib]:
+            a[m] += ev_q_sum_m_tau_alpha_m_diag_rho_outer_m[m]
+        step_log_sigma_sq_q[m] = (
+            - np.log(a[m] + n_ib * ev_q_theta_nominator_ib[m] / sum_theta_nominator_ib)
+            - np.log(sigma_sq_q_alpha[ib, m])
+        )
+
+    current_elbo_sigma_sq = elbo_propto_sigma_sq_q_alpha_ib(
+        sigma_sq_q_alpha_ib=sigma_sq_q_alpha[ib],
+        ev_q_log_theta_denom_approx_ib=ev_q_log_theta_denom_approx[ib],
+        a=a,
+        n_ib=n_ib,
+    )
+
+    candidate_sigma_sq_q = scratch.candidate
+    damping = vi_settings.sigma_sq_damping
+
+    for _ in range(vi_settings.sigma_sq_max_halvings + 1):
+
+        for m in range(dim_m):
+            candidate_sigma_sq_q[m] = np.exp(
+                np.log(sigma_sq_q_alpha[ib, m]) + damping * step_log_sigma_sq_q[m]
+            )
+
+        candidate_ev_q_log_theta_denom_approx_ib = ev_q_log_theta_denom_ji(
+            mu_q=mu_q_alpha[ib],
+            sigma_sq_q=candidate_sigma_sq_q,
+        )
+
+        elbo_diff = elbo_propto_sigma_sq_q_alpha_ib(
+            sigma_sq_q_alpha_ib=candidate_sigma_sq_q,
+            ev_q_log_theta_denom_approx_ib=candidate_ev_q_log_theta_denom_approx_ib,
+            a=a,
+            n_ib=n_ib,
+        ) - current_elbo_sigma_sq
+
+        if elbo_diff > vi_settings.min_elbo_diff:
+
+            # Update q(alpha_ib) and its caches
+            sum_log_sigma_sq_q = 0.0
+            for m in range(dim_m):
+                sigma_sq_q_alpha[ib, m] = candidate_sigma_sq_q[m]
+                ev_q_alpha_sq[ib, m] = candidate_sigma_sq_q[m] + mu_q_alpha[ib, m]**2
+                sum_log_sigma_sq_q += np.log(candidate_sigma_sq_q[m])
+            ev_q_log_theta_denom_approx[ib] = candidate_ev_q_log_theta_denom_approx_ib
+            ev_q_entropy_q_alpha[ib] = (
+                0.5 * dim_m * LOG_2PI_E + 0.5 * sum_log_sigma_sq_q
+            )
+
+            return True, current_elbo + elbo_diff
+
+        damping *= 0.5
+
+    return False, current_elbo
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def elbo_propto_sigma_sq_q_alpha_ib(
+        sigma_sq_q_alpha_ib,
+        ev_q_log_theta_denom_approx_ib,
+        a,
+        n_ib,
+):
+    """
+    The terms of the ELBO that depend on sigma_sq_q_alpha_ib, up to a
+    constant (see elbo_propto_q_alpha_ib_cached_ji).
+    """
+
+    elbo = - n_ib * ev_q_log_theta_denom_approx_ib
+    for m in range(len(sigma_sq_q_alpha_ib)):
+        elbo += (
+            - 0.5 * a[m] * sigma_sq_q_alpha_ib[m]
+            + 0.5 * np.log(sigma_sq_q_alpha_ib[m])
+        )
+
+    return elbo
+
+
 @numba.jit(**settings.NUMBA_OPTIONS)
 def grad_sigma_sq_q_alpha_ib_cached_ji(
+        gradient_sigma_sq_q_ib,
         sigma_sq_q_alpha_ib,
         ev_q_theta_nominator_ib,
         ev_q_tau_ib,
@@ -1131,29 +1819,21 @@ def grad_sigma_sq_q_alpha_ib_cached_ji(
         n_ib,
         is_not_last_ib,
 ):
-    grad_sigma_sq_q_alpha_ib_log_p_alpha_ib = -0.5 * ev_q_tau_ib
+    """Writes the gradient with respect to sigma_sq_q_alpha_ib into
+    gradient_sigma_sq_q_ib."""
 
-    grad_sigma_sq_q_alpha_ib_log_p_z_ib = (
-        - 0.5 * n_ib * ev_q_theta_nominator_ib / np.sum(ev_q_theta_nominator_ib)
-    )
+    sum_theta_nominator_ib = np.sum(ev_q_theta_nominator_ib)
 
-    grad_sigma_sq_q_alpha_ib_entropy_q_alpha_ib = 0.5 * sigma_sq_q_alpha_ib**-1
+    for m in range(len(sigma_sq_q_alpha_ib)):
+        grad_sigma_sq_q_alpha_ib_log_p_alpha_ib = -0.5 * ev_q_tau_ib[m]
 
-    if is_not_last_ib:
-        grad_sigma_sq_q_alpha_ib_log_p_alpha_ib_next = (
-            -0.5 * ev_q_sum_m_tau_alpha_m_diag_rho_outer_m
-        )
-        gradient_sigma_sq_q_alpha_ib = (
-            grad_sigma_sq_q_alpha_ib_log_p_alpha_ib
-            +
-            grad_sigma_sq_q_alpha_ib_log_p_z_ib
-            +
-            grad_sigma_sq_q_alpha_ib_entropy_q_alpha_ib
-            +
-            grad_sigma_sq_q_alpha_ib_log_p_alpha_ib_next
+        grad_sigma_sq_q_alpha_ib_log_p_z_ib = (
+            - 0.5 * n_ib * ev_q_theta_nominator_ib[m] / sum_theta_nominator_ib
         )
-    else:
-        gradient_sigma_sq_q_alpha_ib = (
+
+        grad_sigma_sq_q_alpha_ib_entropy_q_alpha_ib = 0.5 * sigma_sq_q_alpha_ib[m]**-1
+
+        gradient_sigma_sq_q_ib[m] = (
             grad_sigma_sq_q_alpha_ib_log_p_alpha_ib
             +
             grad_sigma_sq_q_alpha_ib_log_p_z_ib
@@ -1161,7 +1841,54 @@ def grad_sigma_sq_q_alpha_ib_cached_ji(
             grad_sigma_sq_q_alpha_ib_entropy_q_alpha_ib
         )
 
-    return gradient_sigma_sq_q_alpha_ib
+        if is_not_last_ib:
+            gradient_sigma_sq_q_ib[m] += -0.5 * ev_q_sum_m_tau_alpha_m_diag_rho_outer_m[m]
+
+@numba.jit(**settings.NUMBA_OPTIONS, parallel=True)
+def calc_cov_q_kappa(
+        dim_b,
+        customers,
+        ev_q_delta_kappa_sq,
+        # efficient inverse
+        U_T_mmul_L_inv,
+        v,
+        log_det_C,
+):
+    """
+    Computes the covariance matrix of q(kappa_i) and its log-determinant for
+    each distinct number of baskets of the customers.
+
+    The covariance of q(kappa_i) only depends on the number of baskets b of
+    customer i, through s_i = ev_q_delta_kappa_sq + b - 1. Given the global
+    parameters, which do not change during the local step, it is computed
+    once per distinct b. The covariance of customer i is
+    cov_q_kappa[cov_q_kappa_index[dim_b[i]]].
+    """
+
+    dim_m = len(v)
+
+    cov_q_kappa_index = np.full(np.max(dim_b) + 1, -1, dtype=np.int64)
+    n_distinct = 0
+    for i in customers:
+        if cov_q_kappa_index[dim_b[i]] < 0:
+            cov_q_kappa_index[dim_b[i]] = n_distinct
+            n_distinct += 1
+
+    distinct_dim_b = np.empty(n_distinct, dtype=np.int64)
+    for b in range(len(cov_q_kappa_index)):
+        if cov_q_kappa_index[b] >= 0:
+            distinct_dim_b[cov_q_kappa_index[b]] = b
+
+    cov_q_kappa = np.empty((n_distinct, dim_m, dim_m))
+    log_det_cov_q_kappa = np.empty(n_distinct)
+
+    for k in numba.prange(n_distinct):
+        s_i = ev_q_delta_kappa_sq + distinct_dim_b[k] - 1
+        cov_q_kappa[k] = U_T_mmul_L_inv.T @ np.diag((v + s_i)**-1) @ U_T_mmul_L_inv
+        log_det_cov_q_kappa[k] = -(log_det_C + np.sum(np.log(v + s_i)))
+
+    return cov_q_kappa, log_det_cov_q_kappa, cov_q_kappa_index
+
 
 # Update q(k_i) (B.9)
 @numba.jit(**settings.NUMBA_OPTIONS)
@@ -1181,42 +1908,50 @@ def update_q_kappa_i_solution(
         M,
         i_to_ib_lb_i,
         i_to_ib_ub_i,
-        # efficient inverse
-        U_T_mmul_L_inv,
-        v,
-        log_det_C,
+        # q(kappa_i) covariance, see calc_cov_q_kappa
+        cov_q_i,
+        log_det_cov_q_i,
+        # work array of length M
+        ev_q_mb_vector,
 ):
-    # Remove q(kappa_i) dependency from eps_alpha_i
-    ev_q_eps_alpha[i_to_ib_lb_i] += ev_q_kappa[i] * ev_q_delta_kappa
-    ev_q_eps_alpha[(i_to_ib_lb_i + 1):i_to_ib_ub_i] += ev_q_kappa[i]
+    # Remove q(kappa_i) dependency from eps_alpha_i, and sum eps_alpha_i over
+    # all but the first basket in ev_q_mb_vector
+    ev_q_mb_vector[:] = 0.0
+    for m in range(M):
+        ev_q_eps_alpha[i_to_ib_lb_i, m] += ev_q_kappa[i, m] * ev_q_delta_kappa
+    for ib in range(i_to_ib_lb_i + 1, i_to_ib_ub_i):
+        for m in range(M):
+            ev_q_eps_alpha[ib, m] += ev_q_kappa[i, m]
+            ev_q_mb_vector[m] += ev_q_eps_alpha[ib, m]
 
-    ev_q_mb_vector = (
-        ev_q_lambda_kappa_mmult_ev_q_mu_kappa
-        +
-        ev_q_tau_alpha * (
-            ev_q_delta_kappa * ev_q_eps_alpha[i_to_ib_lb_i]
+    for m in range(M):
+        ev_q_mb_vector[m] = (
+            ev_q_lambda_kappa_mmult_ev_q_mu_kappa[m]
             +
-            np.sum(ev_q_eps_alpha[(i_to_ib_lb_i + 1):i_to_ib_ub_i], axis=0)
+            ev_q_tau_alpha[m] * (
+                ev_q_delta_kappa * ev_q_eps_alpha[i_to_ib_lb_i, m]
+                +
+                ev_q_mb_vector[m]
+            )
         )
-    )
-
-    s_i = ev_q_delta_kappa_sq + i_to_ib_ub_i - i_to_ib_lb_i - 1
-    cov_q_i = U_T_mmul_L_inv.T @ np.diag((v + s_i)**-1) @ U_T_mmul_L_inv
-    log_det_cov_q_i = -(log_det_C + np.sum(np.log(v + s_i)))
 
-    ev_q_kappa_i = cov_q_i @ ev_q_mb_vector
-    ev_q_kappa_outer_i = cov_q_i + np.outer(ev_q_kappa_i, ev_q_kappa_i)
-    ev_q_kappa_sq_i = np.diag(ev_q_kappa_outer_i)
-    ev_q_entropy_q_kappa_i = 0.5 * (M * LOG_2PI_E + log_det_cov_q_i)
+    for m in range(M):
+        ev_q_kappa[i, m] = 0.0
+        for k in range(M):
+            ev_q_kappa[i, m] += cov_q_i[m, k] * ev_q_mb_vector[k]
 
-    ev_q_kappa[i] = ev_q_kappa_i
-    ev_q_kappa_outer[i] = ev_q_kappa_outer_i
-    ev_q_kappa_sq[i] = ev_q_kappa_sq_i
-    ev_q_entropy_q_kappa[i] = ev_q_entropy_q_kappa_i
+    for m in range(M):
+        for k in range(M):
+            ev_q_kappa_outer[i, m, k] = cov_q_i[m, k] + ev_q_kappa[i, m] * ev_q_kappa[i, k]
+        ev_q_kappa_sq[i, m] = ev_q_kappa_outer[i, m, m]
+    ev_q_entropy_q_kappa[i] = 0.5 * (M * LOG_2PI_E + log_det_cov_q_i)
 
     # Add q(kappa_i) dependency to eps_alpha_i
-    ev_q_eps_alpha[i_to_ib_lb_i] -= ev_q_kappa[i] * ev_q_delta_kappa
-    ev_q_eps_alpha[(i_to_ib_lb_i + 1):i_to_ib_ub_i] -= ev_q_kappa[i]
+    for m in range(M):
+        ev_q_eps_alpha[i_to_ib_lb_i, m] -= ev_q_kappa[i, m] * ev_q_delta_kappa
+    for ib in range(i_to_ib_lb_i + 1, i_to_ib_ub_i):
+        for m in range(M):
+            ev_q_eps_alpha[ib, m] -= ev_q_kappa[i, m]
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -1455,36 +2190,61 @@ def _update_generic_rho_beta_gamma(
 
 
 @numba.jit(**settings.NUMBA_OPTIONS)
-def update_q_beta(
+def add_eps_alpha_beta(
+        ev_q_eps_alpha,
+        ev_q_beta,
+        ev_q_delta_beta,
+        x,
+        ib_first,
+        ib_not_first,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) x beta in ev_q_eps_alpha
+    x_first = as_float64(x[ib_first])
+    x_not_first = as_float64(x[ib_not_first])
+
+    ev_q_eps_alpha[ib_first] += sign * ((x_first @ ev_q_beta.T) * ev_q_delta_beta)
+    ev_q_eps_alpha[ib_not_first] += sign * (x_not_first @ ev_q_beta.T)
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def calc_ss_q_beta(
+        ev_q_eps_alpha,
+        ev_q_delta_beta,
+        x,
+        ib_first,
+        ib_not_first,
+):
+    # X'eps of the baskets, with x beta included in ev_q_eps_alpha
+    x_first = as_float64(x[ib_first])
+    x_not_first = as_float64(x[ib_not_first])
+
+    return (
+        (x_first.T @ ev_q_eps_alpha[ib_first]) * ev_q_delta_beta
+        +
+        x_not_first.T @ ev_q_eps_alpha[ib_not_first]
+    )
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def update_q_beta_ss(
         eta_q_beta,
         ev_q_beta,
         ev_q_beta_outer,
         negative_kl_q_p_beta,
-        ev_q_eps_alpha,
         ev_q_tau_alpha,
-        ev_q_delta_beta,
         ev_q_delta_beta_sq,
-        x,
+        ss_x_eps_alpha,
         x_outer_sum_first,
         x_outer_sum_not_first,
         prior,
-        ib_first,
-        ib_not_first,
 ):
-    ev_q_eps_alpha[ib_first] += (x[ib_first] @ ev_q_beta.T) * ev_q_delta_beta
-    ev_q_eps_alpha[ib_not_first] += x[ib_not_first] @ ev_q_beta.T
-
     ev_q_XT_X_no_prior_no_tau_alpha = (
         x_outer_sum_first * ev_q_delta_beta_sq
         +
         x_outer_sum_not_first
     )
 
-    ev_q_XT_Y_no_prior_no_tau_alpha = (
-        (x[ib_first].T @ ev_q_eps_alpha[ib_first]) * ev_q_delta_beta
-        +
-        x[ib_not_first].T @ ev_q_eps_alpha[ib_not_first]
-    )
     _update_generic_rho_beta_gamma(
         eta_q_param=eta_q_beta,
         ev_q_param=ev_q_beta,
@@ -1494,44 +2254,122 @@ def update_q_beta(
         prior_param_lambda=prior.beta_lambda,
         prior_param_a=prior.beta_a,
         ev_q_XT_X_from_p_alpha_no_tau_alpha=ev_q_XT_X_no_prior_no_tau_alpha,
-        ev_q_XT_Y_from_p_alpha_no_tau_alpha=ev_q_XT_Y_no_prior_no_tau_alpha,
+        ev_q_XT_Y_from_p_alpha_no_tau_alpha=ss_x_eps_alpha,
         ev_q_tau_alpha=ev_q_tau_alpha,
     )
 
-    ev_q_eps_alpha[ib_first] -= (x[ib_first] @ ev_q_beta.T) * ev_q_delta_beta
-    ev_q_eps_alpha[ib_not_first] -= x[ib_not_first] @ ev_q_beta.T
-
 
 @numba.jit(**settings.NUMBA_OPTIONS)
-def update_q_gamma(
-        eta_q_gamma,
-        ev_q_gamma,
-        ev_q_gamma_outer,
-        negative_kl_q_p_gamma,
+def update_q_beta(
+        eta_q_beta,
+        ev_q_beta,
+        ev_q_beta_outer,
+        negative_kl_q_p_beta,
         ev_q_eps_alpha,
         ev_q_tau_alpha,
-        ev_q_delta_gamma,
-        ev_q_delta_gamma_sq,
-        h_per_basket,
-        h_outer_sum_first,
-        h_outer_sum_not_first,
+        ev_q_delta_beta,
+        ev_q_delta_beta_sq,
+        x,
+        x_outer_sum_first,
+        x_outer_sum_not_first,
         prior,
         ib_first,
         ib_not_first,
 ):
-    ev_q_eps_alpha[ib_first] += (h_per_basket[ib_first] @ ev_q_gamma.T) * ev_q_delta_gamma
-    ev_q_eps_alpha[ib_not_first] += h_per_basket[ib_not_first] @ ev_q_gamma.T
+    add_eps_alpha_beta(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_beta=ev_q_beta,
+        ev_q_delta_beta=ev_q_delta_beta,
+        x=x,
+        ib_first=ib_first,
+        ib_not_first=ib_not_first,
+        sign=1.0,
+    )
 
-    ev_q_XT_X_from_p_alpha_no_tau_alpha = (
-        h_outer_sum_first * ev_q_delta_gamma_sq
-        +
-        h_outer_sum_not_first
+    update_q_beta_ss(
+        eta_q_beta=eta_q_beta,
+        ev_q_beta=ev_q_beta,
+        ev_q_beta_outer=ev_q_beta_outer,
+        negative_kl_q_p_beta=negative_kl_q_p_beta,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+        ev_q_delta_beta_sq=ev_q_delta_beta_sq,
+        ss_x_eps_alpha=calc_ss_q_beta(
+            ev_q_eps_alpha=ev_q_eps_alpha,
+            ev_q_delta_beta=ev_q_delta_beta,
+            x=x,
+            ib_first=ib_first,
+            ib_not_first=ib_not_first,
+        ),
+        x_outer_sum_first=x_outer_sum_first,
+        x_outer_sum_not_first=x_outer_sum_not_first,
+        prior=prior,
     )
 
-    ev_q_XT_Y_from_p_alpha_no_tau_alpha = (
-        (h_per_basket[ib_first].T @ ev_q_eps_alpha[ib_first]) * ev_q_delta_gamma
+    add_eps_alpha_beta(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_beta=ev_q_beta,
+        ev_q_delta_beta=ev_q_delta_beta,
+        x=x,
+        ib_first=ib_first,
+        ib_not_first=ib_not_first,
+        sign=-1.0,
+    )
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def add_eps_alpha_gamma(
+        ev_q_eps_alpha,
+        ev_q_gamma,
+        ev_q_delta_gamma,
+        h_per_basket,
+        ib_first,
+        ib_not_first,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) h gamma in ev_q_eps_alpha
+    h_first = as_float64(h_per_basket[ib_first])
+    h_not_first = as_float64(h_per_basket[ib_not_first])
+
+    ev_q_eps_alpha[ib_first] += sign * ((h_first @ ev_q_gamma.T) * ev_q_delta_gamma)
+    ev_q_eps_alpha[ib_not_first] += sign * (h_not_first @ ev_q_gamma.T)
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def calc_ss_q_gamma(
+        ev_q_eps_alpha,
+        ev_q_delta_gamma,
+        h_per_basket,
+        ib_first,
+        ib_not_first,
+):
+    # H'eps of the baskets, with h gamma included in ev_q_eps_alpha
+    h_first = as_float64(h_per_basket[ib_first])
+    h_not_first = as_float64(h_per_basket[ib_not_first])
+
+    return (
+        (h_first.T @ ev_q_eps_alpha[ib_first]) * ev_q_delta_gamma
         +
-        h_per_basket[ib_not_first].T @ ev_q_eps_alpha[ib_not_first]
+        h_not_first.T @ ev_q_eps_alpha[ib_not_first]
+    )
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def update_q_gamma_ss(
+        eta_q_gamma,
+        ev_q_gamma,
+        ev_q_gamma_outer,
+        negative_kl_q_p_gamma,
+        ev_q_tau_alpha,
+        ev_q_delta_gamma_sq,
+        ss_h_eps_alpha,
+        h_outer_sum_first,
+        h_outer_sum_not_first,
+        prior,
+):
+    ev_q_XT_X_from_p_alpha_no_tau_alpha = (
+        h_outer_sum_first * ev_q_delta_gamma_sq
+        +
+        h_outer_sum_not_first
     )
 
     _update_generic_rho_beta_gamma(
@@ -1543,41 +2381,116 @@ def update_q_gamma(
         prior_param_lambda=prior.gamma_lambda,
         prior_param_a=prior.gamma_a,
         ev_q_XT_X_from_p_alpha_no_tau_alpha=ev_q_XT_X_from_p_alpha_no_tau_alpha,
-        ev_q_XT_Y_from_p_alpha_no_tau_alpha=ev_q_XT_Y_from_p_alpha_no_tau_alpha,
+        ev_q_XT_Y_from_p_alpha_no_tau_alpha=ss_h_eps_alpha,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+    )
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def update_q_gamma(
+        eta_q_gamma,
+        ev_q_gamma,
+        ev_q_gamma_outer,
+        negative_kl_q_p_gamma,
+        ev_q_eps_alpha,
+        ev_q_tau_alpha,
+        ev_q_delta_gamma,
+        ev_q_delta_gamma_sq,
+        h_per_basket,
+        h_outer_sum_first,
+        h_outer_sum_not_first,
+        prior,
+        ib_first,
+        ib_not_first,
+):
+    add_eps_alpha_gamma(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_gamma=ev_q_gamma,
+        ev_q_delta_gamma=ev_q_delta_gamma,
+        h_per_basket=h_per_basket,
+        ib_first=ib_first,
+        ib_not_first=ib_not_first,
+        sign=1.0,
+    )
+
+    update_q_gamma_ss(
+        eta_q_gamma=eta_q_gamma,
+        ev_q_gamma=ev_q_gamma,
+        ev_q_gamma_outer=ev_q_gamma_outer,
+        negative_kl_q_p_gamma=negative_kl_q_p_gamma,
         ev_q_tau_alpha=ev_q_tau_alpha,
+        ev_q_delta_gamma_sq=ev_q_delta_gamma_sq,
+        ss_h_eps_alpha=calc_ss_q_gamma(
+            ev_q_eps_alpha=ev_q_eps_alpha,
+            ev_q_delta_gamma=ev_q_delta_gamma,
+            h_per_basket=h_per_basket,
+            ib_first=ib_first,
+            ib_not_first=ib_not_first,
+        ),
+        h_outer_sum_first=h_outer_sum_first,
+        h_outer_sum_not_first=h_outer_sum_not_first,
+        prior=prior,
     )
 
-    ev_q_eps_alpha[ib_first] -= (h_per_basket[ib_first] @ ev_q_gamma.T) * ev_q_delta_gamma
-    ev_q_eps_alpha[ib_not_first] -= h_per_basket[ib_not_first] @ ev_q_gamma.T
+    add_eps_alpha_gamma(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_gamma=ev_q_gamma,
+        ev_q_delta_gamma=ev_q_delta_gamma,
+        h_per_basket=h_per_basket,
+        ib_first=ib_first,
+        ib_not_first=ib_not_first,
+        sign=-1.0,
+    )
 
 
 @numba.jit(**settings.NUMBA_OPTIONS)
-def update_q_rho(
-        eta_q_rho,
+def add_eps_alpha_rho(
+        ev_q_eps_alpha,
         ev_q_rho,
-        ev_q_rho_outer,
-        negative_kl_q_p_rho,
+        mu_q_alpha,
+        ib_not_first,
+        ib_not_last,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) the previous alpha rho in
+    # ev_q_eps_alpha
+    ev_q_eps_alpha[ib_not_first] += sign * (mu_q_alpha[ib_not_last] @ ev_q_rho.T)
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def calc_ss_q_rho(
         ev_q_eps_alpha,
-        ev_q_tau_alpha,
         mu_q_alpha,
         sigma_sq_q_alpha,
-        prior,
         ib_not_first,
         ib_not_last,
 ):
-    ev_q_eps_alpha[ib_not_first] += mu_q_alpha[ib_not_last] @ ev_q_rho.T
-
+    # alpha'alpha and alpha'eps of the previous and next baskets, with alpha
+    # rho included in ev_q_eps_alpha
     ev_q_alpha_not_last_outer = (
         np.diag(np.sum(sigma_sq_q_alpha[ib_not_last], axis=0))
         +
         mu_q_alpha[ib_not_last].T @ mu_q_alpha[ib_not_last]
     )
-    ev_q_XT_X_from_p_alpha_no_tau_alpha = ev_q_alpha_not_last_outer
 
-    ev_q_XT_Y_from_p_alpha_no_tau_alpha = (
+    ev_q_alpha_not_last_eps_alpha = (
         mu_q_alpha[ib_not_last].T @ ev_q_eps_alpha[ib_not_first]
     )
 
+    return ev_q_alpha_not_last_outer, ev_q_alpha_not_last_eps_alpha
+
+
+@numba.jit(**settings.NUMBA_OPTIONS)
+def update_q_rho_ss(
+        eta_q_rho,
+        ev_q_rho,
+        ev_q_rho_outer,
+        negative_kl_q_p_rho,
+        ev_q_tau_alpha,
+        ss_alpha_outer,
+        ss_alpha_eps_alpha,
+        prior,
+):
     _update_generic_rho_beta_gamma(
         eta_q_param=eta_q_rho,
         ev_q_param=ev_q_rho,
@@ -1586,29 +2499,95 @@ def update_q_rho(
         prior_param_eta=prior.rho_eta,
         prior_param_lambda=prior.rho_lambda,
         prior_param_a=prior.rho_a,
-        ev_q_XT_X_from_p_alpha_no_tau_alpha=ev_q_XT_X_from_p_alpha_no_tau_alpha,
-        ev_q_XT_Y_from_p_alpha_no_tau_alpha=ev_q_XT_Y_from_p_alpha_no_tau_alpha,
+        ev_q_XT_X_from_p_alpha_no_tau_alpha=ss_alpha_outer,
+        ev_q_XT_Y_from_p_alpha_no_tau_alpha=ss_alpha_eps_alpha,
         ev_q_tau_alpha=ev_q_tau_alpha,
     )
 
-    ev_q_eps_alpha[ib_not_first] -= mu_q_alpha[ib_not_last] @ ev_q_rho.T
 
+@numba.jit(**settings.NUMBA_OPTIONS)
+def update_q_rho(
+        eta_q_rho,
+        ev_q_rho,
+        ev_q_rho_outer,
+        negative_kl_q_p_rho,
+        ev_q_eps_alpha,
+        ev_q_tau_alpha,
+        mu_q_alpha,
+        sigma_sq_q_alpha,
+        prior,
+        ib_not_first,
+        ib_not_last,
+):
+    add_eps_alpha_rho(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_rho=ev_q_rho,
+        mu_q_alpha=mu_q_alpha,
+        ib_not_first=ib_not_first,
+        ib_not_last=ib_not_last,
+        sign=1.0,
+    )
 
-def update_q_delta(
+    ss_alpha_outer, ss_alpha_eps_alpha = calc_ss_q_rho(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        mu_q_alpha=mu_q_alpha,
+        sigma_sq_q_alpha=sigma_sq_q_alpha,
+        ib_not_first=ib_not_first,
+        ib_not_last=ib_not_last,
+    )
+
+    update_q_rho_ss(
+        eta_q_rho=eta_q_rho,
+        ev_q_rho=ev_q_rho,
+        ev_q_rho_outer=ev_q_rho_outer,
+        negative_kl_q_p_rho=negative_kl_q_p_rho,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+        ss_alpha_outer=ss_alpha_outer,
+        ss_alpha_eps_alpha=ss_alpha_eps_alpha,
+        prior=prior,
+    )
+
+    add_eps_alpha_rho(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_rho=ev_q_rho,
+        mu_q_alpha=mu_q_alpha,
+        ib_not_first=ib_not_first,
+        ib_not_last=ib_not_last,
+        sign=-1.0,
+    )
+
+
+def add_eps_alpha_delta(
+        ev_q_eps_alpha,
+        ev_q_delta,
+        ib_first,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) delta in ev_q_eps_alpha
+    ev_q_eps_alpha[ib_first] += sign * ev_q_delta
+
+
+def calc_ss_q_delta(
+        ev_q_eps_alpha,
+        ib_first,
+):
+    # The sum of eps of the first baskets, with delta included in
+    # ev_q_eps_alpha
+    return np.sum(ev_q_eps_alpha[ib_first], axis=0)
+
+
+def update_q_delta_ss(
         eta_q_delta,
         ev_q_delta,
         ev_q_delta_sq,
         ev_q_negative_kl_q_p_delta,
-        ev_q_eps_alpha,
         ev_q_tau_alpha,
+        ss_eps_alpha_first,
         prior,
         dim_i,
-        ib_first,
 ):
 
-    ev_q_eps_alpha[ib_first] += ev_q_delta
-
-    eta_0_from_p_alpha = np.sum(ev_q_eps_alpha[ib_first], axis=0) * ev_q_tau_alpha
+    eta_0_from_p_alpha = ss_eps_alpha_first * ev_q_tau_alpha
     eta_1_from_p_alpha = -0.5 * dim_i * ev_q_tau_alpha
     eta_from_p_alpha = np.concatenate((eta_0_from_p_alpha, eta_1_from_p_alpha))
 
@@ -1624,28 +2603,87 @@ def update_q_delta(
         eta_p=prior.delta_eta,
     )
 
-    ev_q_eps_alpha[ib_first] -= ev_q_delta
 
+def update_q_delta(
+        eta_q_delta,
+        ev_q_delta,
+        ev_q_delta_sq,
+        ev_q_negative_kl_q_p_delta,
+        ev_q_eps_alpha,
+        ev_q_tau_alpha,
+        prior,
+        dim_i,
+        ib_first,
+):
 
-def update_q_delta_kappa(
-        eta_q_delta_kappa,
+    add_eps_alpha_delta(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_delta=ev_q_delta,
+        ib_first=ib_first,
+        sign=1.0,
+    )
+
+    update_q_delta_ss(
+        eta_q_delta=eta_q_delta,
+        ev_q_delta=ev_q_delta,
+        ev_q_delta_sq=ev_q_delta_sq,
+        ev_q_negative_kl_q_p_delta=ev_q_negative_kl_q_p_delta,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+        ss_eps_alpha_first=calc_ss_q_delta(
+            ev_q_eps_alpha=ev_q_eps_alpha,
+            ib_first=ib_first,
+        ),
+        prior=prior,
+        dim_i=dim_i,
+    )
+
+    add_eps_alpha_delta(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_delta=ev_q_delta,
+        ib_first=ib_first,
+        sign=-1.0,
+    )
+
+
+def add_eps_alpha_delta_kappa(
+        ev_q_eps_alpha,
+        ev_q_kappa,
         ev_q_delta_kappa,
-        ev_q_delta_kappa_sq,
-        ev_q_negative_kl_q_p_delta_kappa,
+        ib_first,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) kappa delta_kappa in
+    # ev_q_eps_alpha
+    ev_q_eps_alpha[ib_first] += sign * (ev_q_kappa * ev_q_delta_kappa)
+
+
+def calc_ss_q_delta_kappa(
         ev_q_eps_alpha,
         ev_q_kappa,
         ev_q_kappa_sq,
-        ev_q_tau_alpha,
-        prior,
         ib_first,
 ):
+    # The sums of kappa * eps of the first baskets, with kappa delta_kappa
+    # included in ev_q_eps_alpha, and of kappa^2
+    return (
+        np.sum(ev_q_kappa * ev_q_eps_alpha[ib_first], axis=0),
+        np.sum(ev_q_kappa_sq, axis=0),
+    )
 
-    ev_q_eps_alpha[ib_first] += ev_q_kappa * ev_q_delta_kappa
 
-    eta_0_from_p_alpha = ev_q_tau_alpha @ (
-        np.sum(ev_q_kappa * ev_q_eps_alpha[ib_first], axis=0)
-    )
-    eta_1_from_p_alpha = -0.5 * np.sum(ev_q_kappa_sq @ ev_q_tau_alpha)
+def update_q_delta_kappa_ss(
+        eta_q_delta_kappa,
+        ev_q_delta_kappa,
+        ev_q_delta_kappa_sq,
+        ev_q_negative_kl_q_p_delta_kappa,
+        ev_q_tau_alpha,
+        ss_kappa_eps_alpha_first,
+        ss_kappa_sq,
+        prior,
+):
+
+    eta_0_from_p_alpha = ev_q_tau_alpha @ ss_kappa_eps_alpha_first
+    eta_1_from_p_alpha = -0.5 * (ss_kappa_sq @ ev_q_tau_alpha)
     eta_from_p_alpha = np.array((eta_0_from_p_alpha, eta_1_from_p_alpha))
 
     eta_q_delta_kappa[:] = prior.delta_kappa_eta + eta_from_p_alpha
@@ -1660,32 +2698,97 @@ def update_q_delta_kappa(
         eta_p=prior.delta_kappa_eta,
     )
 
-    ev_q_eps_alpha[ib_first] -= ev_q_kappa * ev_q_delta_kappa
 
+def update_q_delta_kappa(
+        eta_q_delta_kappa,
+        ev_q_delta_kappa,
+        ev_q_delta_kappa_sq,
+        ev_q_negative_kl_q_p_delta_kappa,
+        ev_q_eps_alpha,
+        ev_q_kappa,
+        ev_q_kappa_sq,
+        ev_q_tau_alpha,
+        prior,
+        ib_first,
+):
 
-def update_q_delta_beta(
+    add_eps_alpha_delta_kappa(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_kappa=ev_q_kappa,
+        ev_q_delta_kappa=ev_q_delta_kappa,
+        ib_first=ib_first,
+        sign=1.0,
+    )
+
+    ss_kappa_eps_alpha_first, ss_kappa_sq = calc_ss_q_delta_kappa(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_kappa=ev_q_kappa,
+        ev_q_kappa_sq=ev_q_kappa_sq,
+        ib_first=ib_first,
+    )
+
+    update_q_delta_kappa_ss(
+        eta_q_delta_kappa=eta_q_delta_kappa,
+        ev_q_delta_kappa=ev_q_delta_kappa,
+        ev_q_delta_kappa_sq=ev_q_delta_kappa_sq,
+        ev_q_negative_kl_q_p_delta_kappa=ev_q_negative_kl_q_p_delta_kappa,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+        ss_kappa_eps_alpha_first=ss_kappa_eps_alpha_first,
+        ss_kappa_sq=ss_kappa_sq,
+        prior=prior,
+    )
+
+    add_eps_alpha_delta_kappa(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_kappa=ev_q_kappa,
+        ev_q_delta_kappa=ev_q_delta_kappa,
+        ib_first=ib_first,
+        sign=-1.0,
+    )
+
+
+def add_eps_alpha_delta_beta(
+        ev_q_eps_alpha,
+        ev_q_beta,
+        ev_q_delta_beta,
+        x,
+        ib_first,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) x beta delta_beta of the first
+    # baskets in ev_q_eps_alpha
+    ev_q_eps_alpha[ib_first] += sign * (x[ib_first] @ ev_q_beta.T * ev_q_delta_beta)
+
+
+def calc_ss_q_delta_beta(
+        ev_q_eps_alpha,
+        x,
+        ib_first,
+):
+    # X'eps of the first baskets, with x beta delta_beta included in
+    # ev_q_eps_alpha
+    return x[ib_first].T @ ev_q_eps_alpha[ib_first]
+
+
+def update_q_delta_beta_ss(
         eta_q_delta_beta,
         ev_q_delta_beta,
         ev_q_delta_beta_sq,
         ev_q_negative_kl_q_p_delta_beta,
-        ev_q_eps_alpha,
         ev_q_beta,
         ev_q_beta_outer,
         ev_q_tau_alpha,
+        ss_x_eps_alpha_first,
         dim_m,
         prior,
-        x,
         x_outer_sum_first,
-        ib_first,
 ):
 
-    ev_q_eps_alpha[ib_first] += x[ib_first] @ ev_q_beta.T * ev_q_delta_beta
-
     eta_0_from_p_alpha = 0.0
     eta_1_from_p_alpha = 0.0
     for m in range(dim_m):
         eta_0_from_p_alpha += ev_q_tau_alpha[m] * (
-            ev_q_beta[m].T @ x[ib_first].T @ ev_q_eps_alpha[ib_first, m]
+            ev_q_beta[m] @ ss_x_eps_alpha_first[:, m]
         )
         eta_1_from_p_alpha += -0.5 * ev_q_tau_alpha[m] * np.sum(
             ev_q_beta_outer[m] * x_outer_sum_first
@@ -1707,32 +2810,102 @@ def update_q_delta_beta(
         eta_p=prior.delta_beta_eta,
     )
 
-    ev_q_eps_alpha[ib_first] -= x[ib_first] @ ev_q_beta.T * ev_q_delta_beta
 
+def update_q_delta_beta(
+        eta_q_delta_beta,
+        ev_q_delta_beta,
+        ev_q_delta_beta_sq,
+        ev_q_negative_kl_q_p_delta_beta,
+        ev_q_eps_alpha,
+        ev_q_beta,
+        ev_q_beta_outer,
+        ev_q_tau_alpha,
+        dim_m,
+        prior,
+        x,
+        x_outer_sum_first,
+        ib_first,
+):
 
-def update_q_delta_gamma(
+    add_eps_alpha_delta_beta(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_beta=ev_q_beta,
+        ev_q_delta_beta=ev_q_delta_beta,
+        x=x,
+        ib_first=ib_first,
+        sign=1.0,
+    )
+
+    update_q_delta_beta_ss(
+        eta_q_delta_beta=eta_q_delta_beta,
+        ev_q_delta_beta=ev_q_delta_beta,
+        ev_q_delta_beta_sq=ev_q_delta_beta_sq,
+        ev_q_negative_kl_q_p_delta_beta=ev_q_negative_kl_q_p_delta_beta,
+        ev_q_beta=ev_q_beta,
+        ev_q_beta_outer=ev_q_beta_outer,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+        ss_x_eps_alpha_first=calc_ss_q_delta_beta(
+            ev_q_eps_alpha=ev_q_eps_alpha,
+            x=x,
+            ib_first=ib_first,
+        ),
+        dim_m=dim_m,
+        prior=prior,
+        x_outer_sum_first=x_outer_sum_first,
+    )
+
+    add_eps_alpha_delta_beta(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_beta=ev_q_beta,
+        ev_q_delta_beta=ev_q_delta_beta,
+        x=x,
+        ib_first=ib_first,
+        sign=-1.0,
+    )
+
+
+def add_eps_alpha_delta_gamma(
+        ev_q_eps_alpha,
+        ev_q_gamma,
+        ev_q_delta_gamma,
+        h,
+        ib_first,
+        sign,
+):
+    # Adds (sign = 1) or subtracts (sign = -1) h gamma delta_gamma of the
+    # first baskets in ev_q_eps_alpha
+    ev_q_eps_alpha[ib_first] += sign * (h @ ev_q_gamma.T * ev_q_delta_gamma)
+
+
+def calc_ss_q_delta_gamma(
+        ev_q_eps_alpha,
+        h,
+        ib_first,
+):
+    # H'eps of the first baskets, with h gamma delta_gamma included in
+    # ev_q_eps_alpha
+    return h.T @ ev_q_eps_alpha[ib_first]
+
+
+def update_q_delta_gamma_ss(
         eta_q_delta_gamma,
         ev_q_delta_gamma,
         ev_q_delta_gamma_sq,
         ev_q_negative_kl_q_p_delta_gamma,
-        ev_q_eps_alpha,
         ev_q_gamma,
         ev_q_gamma_outer,
         ev_q_tau_alpha,
+        ss_h_eps_alpha_first,
         dim_m,
         prior,
-        h,
         h_outer_sum_first,
-        ib_first,
 ):
 
-    ev_q_eps_alpha[ib_first] += h @ ev_q_gamma.T * ev_q_delta_gamma
-
     eta_0_from_p_alpha = 0.0
     eta_1_from_p_alpha = 0.0
     for m in range(dim_m):
         eta_0_from_p_alpha += ev_q_tau_alpha[m] * (
-            ev_q_gamma[m].T @ h.T @ ev_q_eps_alpha[ib_first, m]
+            ev_q_gamma[m] @ ss_h_eps_alpha_first[:, m]
         )
         eta_1_from_p_alpha += -0.5 * ev_q_tau_alpha[m] * np.sum(ev_q_gamma_outer[m] * h_outer_sum_first)
 
@@ -1750,4 +2923,55 @@ def update_q_delta_gamma(
         eta_p=prior.delta_gamma_eta,
     )
 
-    ev_q_eps_alpha[ib_first] -= h @ ev_q_gamma.T * ev_q_delta_gamma
+
+def update_q_delta_gamma(
+        eta_q_delta_gamma,
+        ev_q_delta_gamma,
+        ev_q_delta_gamma_sq,
+        ev_q_negative_kl_q_p_delta_gamma,
+        ev_q_eps_alpha,
+        ev_q_gamma,
+        ev_q_gamma_outer,
+        ev_q_tau_alpha,
+        dim_m,
+        prior,
+        h,
+        h_outer_sum_first,
+        ib_first,
+):
+
+    add_eps_alpha_delta_gamma(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_gamma=ev_q_gamma,
+        ev_q_delta_gamma=ev_q_delta_gamma,
+        h=h,
+        ib_first=ib_first,
+        sign=1.0,
+    )
+
+    update_q_delta_gamma_ss(
+        eta_q_delta_gamma=eta_q_delta_gamma,
+        ev_q_delta_gamma=ev_q_delta_gamma,
+        ev_q_delta_gamma_sq=ev_q_delta_gamma_sq,
+        ev_q_negative_kl_q_p_delta_gamma=ev_q_negative_kl_q_p_delta_gamma,
+        ev_q_gamma=ev_q_gamma,
+        ev_q_gamma_outer=ev_q_gamma_outer,
+        ev_q_tau_alpha=ev_q_tau_alpha,
+        ss_h_eps_alpha_first=calc_ss_q_delta_gamma(
+            ev_q_eps_alpha=ev_q_eps_alpha,
+            h=h,
+            ib_first=ib_first,
+        ),
+        dim_m=dim_m,
+        prior=prior,
+        h_outer_sum_first=h_outer_sum_first,
+    )
+
+    add_eps_alpha_delta_gamma(
+        ev_q_eps_alpha=ev_q_eps_alpha,
+        ev_q_gamma=ev_q_gamma,
+        ev_q_delta_gamma=ev_q_delta_gamma,
+        h=h,
+        ib_first=ib_first,
+        sign=-1.0,
+    )
@@ -0,0 +1,753 @@
+"""
+Description:
+    Contains the binary ingest cache for the (y_fused_ibn, x, h)-data.
+
+    Each CSV input is converted once into a typed .npy array. Next to each
+    array a small .json file records the size, modification time and SHA-256
+    hash of the CSV file it was created from. Later runs memory-map the .npy
+    array, and only rebuild it when the content of the CSV file has changed.
+
+    For purchase extracts that do not fit in memory, load_purchase_index
+    streams the y_fused_ibn CSV file in blocks of rows and writes the sorted
+    product stream and the CSR-style basket/customer offsets directly to
+    disk-backed .npy arrays.
+
+Functions:
+    load_inputs: loads the (y_fused_ibn, x, h)-data through the binary cache.
+
+    load_cached_csv: loads a single CSV file through the binary cache.
+
+    load_purchase_index: loads a PurchaseIndex of the y_fused_ibn CSV file,
+    (re)building it out-of-core when needed.
+
+    remap_ids: maps raw customer, basket and product IDs to dense IDs, and
+    sorts the purchases by (customer, basket).
+
+    save_id_map: saves the mapping between raw and dense IDs.
+
+    load_id_map: loads the mapping between raw and dense IDs.
+
+    dataset_key: returns a key for a saved dataset, based on the content of
+    the CSV files it is created from and the options used to create it.
+
+    prepare_dataset: returns the folder of the saved dataset of the CSV
+    files, creating and saving the dataset first if it does not exist.
+"""
+
+# Standard library modules
+from collections import namedtuple
+import hashlib
+import itertools
+import json
+import os
+
+# External modules
+import numpy as np
+
+# Own modules
+from model.data import Data, PurchaseIndex
+import model.data
+
+
+HASH_BLOCK_SIZE = 1 << 24
+INDEX_CHUNK_ROWS = 1 << 22
+
+
+# Raw ID of each dense ID. The raw customer and product IDs are sorted, such
+# that the dense ID of a raw ID is found with np.searchsorted. The raw basket
+# IDs are sorted per customer, in the order of the dense basket IDs.
+IdMap = namedtuple(
+    'IdMap',
+    (
+        'customer_raw',
+        'basket_raw',
+        'product_raw',
+    )
+)
+
+
+def _sha256_of_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _read_metadata(metadata_file):
+    if not os.path.exists(metadata_file):
+        return None
+    with open(metadata_file, 'r') as f:
+        return json.load(f)
+
+
+def _write_metadata(metadata_file, metadata):
+    # Write to a temporary file first, such that concurrent runs never read
+    # a partially written metadata file
+    tmp_file = '{}.{}.tmp'.format(metadata_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(tmp_file, metadata_file)
+
+
+def _is_cache_valid(csv_file, metadata_file, layout):
+    # The cache is valid when it was created from a CSV file with the same
+    # content, with the same layout of the cached arrays
+    metadata = _read_metadata(metadata_file)
+    if metadata is None or metadata['layout'] != layout:
+        return False
+
+    csv_stat = os.stat(csv_file)
+    if (
+            metadata['size'] != csv_stat.st_size
+            or metadata['mtime_ns'] != csv_stat.st_mtime_ns
+    ):
+        # The file was touched, only rebuild if the content has changed
+        if _sha256_of_file(csv_file) != metadata['sha256']:
+            return False
+        metadata['size'] = csv_stat.st_size
+        metadata['mtime_ns'] = csv_stat.st_mtime_ns
+        _write_metadata(metadata_file, metadata)
+
+    return True
+
+
+def _source_sha256(csv_file, cache_folder):
+    # SHA-256 hash of a CSV file, taken from the cache metadata or from the
+    # hash record of the file when the size and modification time of the
+    # file are unchanged. Otherwise the file is hashed once, and the hash is
+    # recorded (e.g. y_fused_ibn with OUT_OF_CORE_INDEX, which has no cached
+    # array)
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    csv_stat = os.stat(csv_file)
+
+    metadata_files = [
+        os.path.join(cache_folder, name + '.json'),
+        os.path.join(cache_folder, name + '.sha256.json'),
+    ]
+    for metadata_file in metadata_files:
+        metadata = _read_metadata(metadata_file)
+        if (
+                metadata is not None
+                and metadata['size'] == csv_stat.st_size
+                and metadata['mtime_ns'] == csv_stat.st_mtime_ns
+        ):
+            return metadata['sha256']
+
+    sha256 = _sha256_of_file(csv_file)
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+    _write_metadata(
+        metadata_files[1],
+        {
+            'source': os.path.abspath(csv_file),
+            'size': csv_stat.st_size,
+            'mtime_ns': csv_stat.st_mtime_ns,
+            'sha256': sha256,
+        },
+    )
+    return sha256
+
+
+def _convert_csv(csv_file, npy_file, dtype, fortran_order):
+    array = np.loadtxt(csv_file, dtype=dtype, delimiter=',')
+    if fortran_order:
+        array = np.asfortranarray(array)
+
+    tmp_file = '{}.{}.tmp.npy'.format(npy_file[:-len('.npy')], os.getpid())
+    np.save(tmp_file, array)
+    os.replace(tmp_file, npy_file)
+
+
+def load_cached_csv(
+        csv_file,
+        cache_folder,
+        dtype,
+        fortran_order=False,
+        mmap_mode='r',
+):
+    """Loads a CSV file of numbers through the binary cache.
+
+    The CSV file is (re)converted when no cached array exists, or when the
+    SHA-256 hash of the CSV file differs from the hash recorded in the cache.
+    The hash is only recomputed when the size or modification time of the
+    CSV file has changed since the last run.
+
+    Parameters
+        csv_file: Location of the comma separated input file.
+        cache_folder: Folder that holds the .npy/.json cache files.
+        dtype: Type of the array, as passed to np.loadtxt.
+        fortran_order: Store the array in column-major order.
+        mmap_mode: Memory-map mode used to load the cached .npy array.
+    """
+
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    npy_file = os.path.join(cache_folder, name + '.npy')
+    metadata_file = os.path.join(cache_folder, name + '.json')
+
+    layout = {
+        'dtype': np.dtype(dtype).str,
+        'fortran_order': fortran_order,
+    }
+
+    is_valid = (
+        os.path.exists(npy_file)
+        and _is_cache_valid(csv_file, metadata_file, layout)
+    )
+
+    if not is_valid:
+        print('Converting {} to {}'.format(csv_file, npy_file))
+        csv_stat = os.stat(csv_file)
+        sha256 = _sha256_of_file(csv_file)
+        _convert_csv(
+            csv_file=csv_file,
+            npy_file=npy_file,
+            dtype=dtype,
+            fortran_order=fortran_order,
+        )
+        _write_metadata(
+            metadata_file,
+            {
+                'source': os.path.abspath(csv_file),
+                'size': csv_stat.st_size,
+                'mtime_ns': csv_stat.st_mtime_ns,
+                'sha256': sha256,
+                'layout': layout,
+            },
+        )
+
+    return np.load(npy_file, mmap_mode=mmap_mode)
+
+
+def load_inputs(
+        y_csv,
+        x_csv,
+        h_csv,
+        cache_folder,
+        mmap_mode='r',
+):
+    """Loads the (y_fused_ibn, x, h)-data through the binary cache.
+
+    Returns the same arrays as loading the CSV files with np.loadtxt:
+    y_fused_ibn as integers, x as floats and h as floats in column-major
+    order. The arrays are read-only memory maps when mmap_mode='r'.
+    """
+
+    y_fused_ibn = load_cached_csv(
+        csv_file=y_csv,
+        cache_folder=cache_folder,
+        dtype=int,
+        mmap_mode=mmap_mode,
+    )
+    x = load_cached_csv(
+        csv_file=x_csv,
+        cache_folder=cache_folder,
+        dtype=float,
+        mmap_mode=mmap_mode,
+    )
+    h = load_cached_csv(
+        csv_file=h_csv,
+        cache_folder=cache_folder,
+        dtype=float,
+        fortran_order=True,
+        mmap_mode=mmap_mode,
+    )
+
+    return y_fused_ibn, x, h
+
+
+def _read_chunks(csv_file, chunk_rows):
+    # Yields blocks of at most chunk_rows rows of the y_fused_ibn CSV file
+    with open(csv_file, 'r') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                return
+            yield np.loadtxt(lines, dtype=int, delimiter=',', ndmin=2)
+
+
+def _scan_purchases(csv_file, emulate_lda_x, chunk_rows):
+    # First pass over the purchase data. Validates the order of the
+    # customer and basket IDs, and counts the purchases, baskets and
+    # customers, and the purchases per product
+    total_purchases = 0
+    total_baskets = 0
+    total_customers = 0
+    n_per_product = np.zeros(0, dtype=int)
+    i_prev = -1
+    ib_prev = -1
+
+    for chunk in _read_chunks(csv_file, chunk_rows):
+        i_vec = chunk[:, 0]
+        ib_vec = i_vec if emulate_lda_x else chunk[:, 1]
+
+        # Compare with the last purchase of the previous chunk
+        i_diff = np.diff(i_vec, prepend=i_prev)
+        ib_diff = np.diff(ib_vec, prepend=ib_prev)
+
+        # Assert that the customer ID's and basket ID's are sorted in
+        # ascending order, and that they are contiguous (no missing values)
+        assert np.all((i_diff == 0) | (i_diff == 1))
+        assert np.all((ib_diff == 0) | (ib_diff == 1))
+
+        # A basket belongs to a single customer
+        assert np.all(ib_diff[i_diff == 1] == 1)
+
+        counts = np.bincount(chunk[:, 2])
+        if len(counts) > len(n_per_product):
+            counts[:len(n_per_product)] += n_per_product
+            n_per_product = counts
+        else:
+            n_per_product[:len(counts)] += counts
+
+        total_purchases += len(chunk)
+        total_baskets += np.count_nonzero(ib_diff)
+        total_customers += np.count_nonzero(i_diff)
+        i_prev = i_vec[-1]
+        ib_prev = ib_vec[-1]
+
+    return total_purchases, total_baskets, total_customers, n_per_product
+
+
+def _open_index_array(index_folder, name, shape):
+    # Opens a new .npy array under a temporary name, which is renamed once
+    # the array is written completely
+    tmp_file = os.path.join(
+        index_folder, '{}.{}.tmp.npy'.format(name, os.getpid()))
+    return tmp_file, np.lib.format.open_memmap(
+        tmp_file, mode='w+', dtype=int, shape=shape)
+
+
+def _build_purchase_index(csv_file, index_folder, emulate_lda_x, chunk_rows):
+    total_purchases, total_baskets, total_customers, n_per_product = \
+        _scan_purchases(csv_file, emulate_lda_x, chunk_rows)
+
+    y_file, y = _open_index_array(
+        index_folder, 'y', (total_purchases,))
+    i_to_ib_lb_file, i_to_ib_lb = _open_index_array(
+        index_folder, 'i_to_ib_lb', (total_customers,))
+    i_to_ib_ub_file, i_to_ib_ub = _open_index_array(
+        index_folder, 'i_to_ib_ub', (total_customers,))
+    ib_to_ibn_lb_file, ib_to_ibn_lb = _open_index_array(
+        index_folder, 'ib_to_ibn_lb', (total_baskets,))
+    ib_to_ibn_ub_file, ib_to_ibn_ub = _open_index_array(
+        index_folder, 'ib_to_ibn_ub', (total_baskets,))
+
+    # Second pass over the purchase data. Only complete baskets are written,
+    # the purchases of the last basket of a chunk are carried over to the
+    # next chunk
+    n_written = 0 # purchases
+    b_written = 0 # baskets
+    c_written = 0 # customers
+    i_prev = -1
+    carry = np.zeros((0, 3), dtype=int)
+
+    chunks = _read_chunks(csv_file, chunk_rows)
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            # End of file, the carried over basket is complete
+            rows = carry
+            n_complete = len(rows)
+        else:
+            if emulate_lda_x:
+                # Set basket IDs to customer IDs, collapse to LDA-X
+                chunk[:, 1] = chunk[:, 0]
+            rows = np.concatenate((carry, chunk))
+            n_complete = np.searchsorted(rows[:, 1], rows[-1, 1])
+
+        carry = rows[n_complete:]
+        rows = rows[:n_complete]
+        if n_complete == 0:
+            continue
+
+        i_vec = rows[:, 0]
+        ib_vec = rows[:, 1]
+
+        # Sort the purchases per basket, the baskets are already sorted
+        y[n_written:n_written + n_complete] = \
+            rows[np.lexsort((rows[:, 2], ib_vec)), 2]
+
+        # ib_to_ibn_lb, ib_to_ibn_ub. The rows end with a complete basket
+        starts = np.flatnonzero(np.diff(ib_vec, prepend=-1))
+        n_baskets = len(starts)
+        ib_to_ibn_lb[b_written:b_written + n_baskets] = n_written + starts
+        ib_to_ibn_ub[b_written:b_written + n_baskets] = \
+            n_written + np.append(starts[1:], n_complete)
+
+        # i_to_ib_lb. Baskets where the customer differs from the customer
+        # of the previous basket
+        new_customer = np.flatnonzero(np.diff(i_vec[starts], prepend=i_prev))
+        n_customers = len(new_customer)
+        i_to_ib_lb[c_written:c_written + n_customers] = \
+            b_written + new_customer
+
+        n_written += n_complete
+        b_written += n_baskets
+        c_written += n_customers
+        i_prev = i_vec[-1]
+
+    assert n_written == total_purchases
+    assert b_written == total_baskets
+    assert c_written == total_customers
+
+    # i_to_ib_ub
+    i_to_ib_ub[:-1] = i_to_ib_lb[1:]
+    i_to_ib_ub[-1] = total_baskets
+
+    # Close the memory maps before the arrays are moved into place
+    for array in (y, i_to_ib_lb, i_to_ib_ub, ib_to_ibn_lb, ib_to_ibn_ub):
+        array.flush()
+    del y, i_to_ib_lb, i_to_ib_ub, ib_to_ibn_lb, ib_to_ibn_ub
+
+    n_per_product_file = os.path.join(
+        index_folder, 'n_per_product.{}.tmp.npy'.format(os.getpid()))
+    np.save(n_per_product_file, n_per_product)
+
+    tmp_files = {
+        'y': y_file,
+        'n_per_product': n_per_product_file,
+        'i_to_ib_lb': i_to_ib_lb_file,
+        'i_to_ib_ub': i_to_ib_ub_file,
+        'ib_to_ibn_lb': ib_to_ibn_lb_file,
+        'ib_to_ibn_ub': ib_to_ibn_ub_file,
+    }
+    for name, tmp_file in tmp_files.items():
+        os.replace(tmp_file, os.path.join(index_folder, name + '.npy'))
+
+
+def load_purchase_index(
+        y_csv,
+        index_folder,
+        emulate_lda_x,
+        chunk_rows=INDEX_CHUNK_ROWS,
+        mmap_mode='r',
+):
+    """Loads a PurchaseIndex of the y_fused_ibn CSV file.
+
+    The index is built out-of-core: the CSV file is read twice in blocks of
+    chunk_rows rows, and the sorted product stream and the offsets are
+    written straight to .npy arrays in index_folder. Like load_cached_csv,
+    the index is only rebuilt when the content of the CSV file has changed.
+    The result can be passed to model.data.create_dataset_from_index.
+
+    Parameters
+        y_csv: Location of the (customer, basket, product) input file.
+        index_folder: Folder that holds the .npy/.json index files.
+        emulate_lda_x: Use the customers as baskets, as in LDA-X.
+        chunk_rows: Number of rows of the CSV file that is read at once.
+        mmap_mode: Memory-map mode used to load the .npy arrays.
+    """
+
+    if not os.path.exists(index_folder):
+        os.makedirs(index_folder, exist_ok=True)
+
+    metadata_file = os.path.join(index_folder, 'index.json')
+    layout = {
+        'dtype': np.dtype(int).str,
+        'emulate_lda_x': emulate_lda_x,
+    }
+
+    is_valid = (
+        all(
+            os.path.exists(os.path.join(index_folder, name + '.npy'))
+            for name in PurchaseIndex._fields
+        )
+        and _is_cache_valid(y_csv, metadata_file, layout)
+    )
+
+    if not is_valid:
+        print('Building purchase index of {} in {}'.format(y_csv, index_folder))
+        if os.path.exists(metadata_file):
+            os.remove(metadata_file)
+        csv_stat = os.stat(y_csv)
+        sha256 = _sha256_of_file(y_csv)
+        _build_purchase_index(
+            csv_file=y_csv,
+            index_folder=index_folder,
+            emulate_lda_x=emulate_lda_x,
+            chunk_rows=chunk_rows,
+        )
+        _write_metadata(
+            metadata_file,
+            {
+                'source': os.path.abspath(y_csv),
+                'size': csv_stat.st_size,
+                'mtime_ns': csv_stat.st_mtime_ns,
+                'sha256': sha256,
+                'layout': layout,
+            },
+        )
+
+    return PurchaseIndex(**{
+        name: np.load(
+            os.path.join(index_folder, name + '.npy'), mmap_mode=mmap_mode)
+        for name in PurchaseIndex._fields
+    })
+
+
+def _lookup_rows(table, keys, name):
+    # Position of each key in the sorted table. Keys that are not in the
+    # table (e.g. rows of filtered customers or baskets) are dropped, and
+    # each entry of the table should be found exactly once
+    positions = np.searchsorted(table, keys)
+    is_found = positions < len(table)
+    is_found[is_found] = (table[positions[is_found]] == keys[is_found])
+    assert np.all(
+        np.bincount(positions[is_found], minlength=len(table)) == 1
+    ), 'every {} should have exactly one row'.format(name)
+    return positions[is_found], is_found
+
+
+def remap_ids(
+        raw_y_fused_ibn,
+        raw_x,
+        raw_h,
+):
+    """Maps raw IDs to the dense IDs expected by model.data.create_dataset.
+
+    Customer and product IDs are mapped to 0..n-1 in the order of their raw
+    IDs. The purchases are sorted by (customer, raw basket ID), such that the
+    baskets of a customer should have chronologically increasing raw IDs, and
+    the baskets are numbered 0..n-1 in this order.
+
+    Parameters
+        raw_y_fused_ibn: Rows of (customer_id, basket_id, product_id).
+        raw_x: Rows of (customer_id, basket_id, x_1, ..., x_K).
+        raw_h: Rows of (customer_id, h_1, ..., h_K).
+
+    The IDs in raw_x and raw_h are read as floats and should therefore be
+    smaller than 2^53. Rows of raw_x and raw_h without purchases are dropped.
+    Returns the dense (y_fused_ibn, x, h)-data and an IdMap.
+    """
+
+    raw_customer = np.asarray(raw_y_fused_ibn[:, 0])
+    raw_basket = np.asarray(raw_y_fused_ibn[:, 1])
+    raw_product = np.asarray(raw_y_fused_ibn[:, 2])
+
+    # Dense customer and product IDs
+    customer_raw, i_vec = np.unique(raw_customer, return_inverse=True)
+    product_raw, y = np.unique(raw_product, return_inverse=True)
+
+    # Sort the purchases by (customer, basket), and number the baskets
+    order = np.lexsort((raw_basket, i_vec))
+    i_vec = i_vec[order]
+    raw_basket = raw_basket[order]
+    y = y[order]
+
+    is_new_ib = np.empty(len(order), dtype=bool)
+    is_new_ib[0] = True
+    is_new_ib[1:] = (
+        (i_vec[1:] != i_vec[:-1]) | (raw_basket[1:] != raw_basket[:-1])
+    )
+    ib_vec = np.cumsum(is_new_ib) - 1
+    basket_raw = raw_basket[is_new_ib]
+
+    y_fused_ibn = np.column_stack((i_vec, ib_vec, y))
+
+    # Rows of x, matched on (raw customer ID, raw basket ID). The baskets
+    # are sorted on this key, as the dense customer IDs follow the raw IDs
+    key_dtype = np.dtype([('customer', np.int64), ('basket', np.int64)])
+    basket_keys = np.empty(len(basket_raw), dtype=key_dtype)
+    basket_keys['customer'] = customer_raw[i_vec[is_new_ib]]
+    basket_keys['basket'] = basket_raw
+
+    x_keys = np.empty(len(raw_x), dtype=key_dtype)
+    x_keys['customer'] = raw_x[:, 0]
+    x_keys['basket'] = raw_x[:, 1]
+
+    positions, is_found = _lookup_rows(basket_keys, x_keys, 'basket')
+    x = np.zeros((len(basket_raw), raw_x.shape[1] - 2))
+    x[positions] = raw_x[is_found, 2:]
+
+    # Rows of h, matched on the raw customer ID
+    positions, is_found = _lookup_rows(
+        customer_raw, raw_h[:, 0].astype(np.int64), 'customer')
+    h = np.zeros((len(customer_raw), raw_h.shape[1] - 1), order='F')
+    h[positions] = raw_h[is_found, 1:]
+
+    id_map = IdMap(
+        customer_raw=customer_raw,
+        basket_raw=basket_raw,
+        product_raw=product_raw,
+    )
+
+    return y_fused_ibn, x, h, id_map
+
+
+def save_id_map(
+        id_map,
+        folder,
+):
+    """Saves an IdMap as .npy arrays, using 32-bit integers when possible."""
+
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    int32_info = np.iinfo(np.int32)
+    for name, raw_ids in id_map._asdict().items():
+        if len(raw_ids) == 0 or (
+                raw_ids.min() >= int32_info.min
+                and raw_ids.max() <= int32_info.max
+        ):
+            raw_ids = raw_ids.astype(np.int32)
+        np.save(os.path.join(folder, name + '.npy'), raw_ids)
+
+
+def load_id_map(
+        folder,
+        mmap_mode='r',
+):
+    """Loads an IdMap saved by save_id_map."""
+
+    return IdMap(**{
+        name: np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+        for name in IdMap._fields
+    })
+
+
+def dataset_key(
+        csv_files,
+        cache_folder,
+        **options
+):
+    """Returns a key that identifies a dataset created from csv_files.
+
+    The key changes when the content of one of the CSV files changes, when
+    one of the options (e.g. the model variant) differs, or when the fields of
+    model.data.Data change.
+    """
+
+    description = {
+        'sources': [
+            _source_sha256(csv_file, cache_folder) for csv_file in csv_files
+        ],
+        'options': options,
+        'fields': list(Data._fields),
+    }
+    sha256 = hashlib.sha256(
+        json.dumps(description, sort_keys=True).encode('utf-8')
+    )
+    return sha256.hexdigest()[:16]
+
+
+def prepare_dataset(
+        y_csv,
+        x_csv,
+        h_csv,
+        cache_folder,
+        datasets_folder,
+        index_folder,
+        emulate_lda_x,
+        raw_ids,
+        out_of_core_index,
+        compact_data,
+        float32_regressors,
+):
+    """Returns the folder of the saved dataset of the (y_fused_ibn, x, h) CSV
+    files, in datasets_folder under its dataset_key. If the folder does not
+    exist, the dataset is created, compacted if compact_data, and saved with
+    model.data.save_dataset first. It is then loaded with
+    model.data.load_dataset.
+
+    With raw_ids, the mapping from dense IDs to raw IDs is saved next to the
+    dataset, in the folder with '.id_map' appended. With out_of_core_index,
+    the purchase data is streamed into an index of disk-backed arrays in
+    index_folder (see load_purchase_index), which requires dense IDs.
+    """
+
+    dataset_folder = os.path.join(
+        datasets_folder,
+        dataset_key(
+            csv_files=[y_csv, x_csv, h_csv],
+            cache_folder=cache_folder,
+            emulate_lda_x=emulate_lda_x,
+            raw_ids=raw_ids,
+            # The memory-mapped arrays of the out-of-core index are not
+            # compacted, so the two build paths give different dtypes
+            out_of_core_index=out_of_core_index,
+            compact_data=compact_data,
+            float32_regressors=float32_regressors,
+        ),
+    )
+
+    if os.path.exists(dataset_folder):
+        return dataset_folder
+
+    print('Creating dataset in {}'.format(dataset_folder))
+
+    assert not (out_of_core_index and raw_ids), \
+        'OUT_OF_CORE_INDEX requires dense IDs, set RAW_IDS to False'
+
+    if out_of_core_index:
+        # Load the (x, h)-data, and stream the purchase data into an index of
+        # disk-backed arrays, such that y_fused_ibn is never held in memory
+        x = load_cached_csv(
+            csv_file=x_csv,
+            cache_folder=cache_folder,
+            dtype=float,
+        )
+        h = load_cached_csv(
+            csv_file=h_csv,
+            cache_folder=cache_folder,
+            dtype=float,
+            fortran_order=True,
+        )
+        purchase_index = load_purchase_index(
+            y_csv=y_csv,
+            index_folder=os.path.join(
+                index_folder, 'LDA_X' if emulate_lda_x else 'BASKETS'),
+            emulate_lda_x=emulate_lda_x,
+        )
+
+        # Create a dataset, based on the purchase index and the (x, h)-data
+        data = model.data.create_dataset_from_index(
+            emulate_lda_x=emulate_lda_x,
+            index=purchase_index,
+            x=x,
+            h=h,
+        )
+    else:
+        # Load the (y_fused_ibn, x, h)-data, converted once to memory-mapped
+        # arrays
+        y_fused_ibn, x, h = load_inputs(
+            y_csv=y_csv,
+            x_csv=x_csv,
+            h_csv=h_csv,
+            cache_folder=cache_folder,
+        )
+
+        if raw_ids:
+            # Map the raw IDs to dense IDs, and keep the mapping with the
+            # dataset
+            y_fused_ibn, x, h, id_map = remap_ids(
+                raw_y_fused_ibn=y_fused_ibn,
+                raw_x=x,
+                raw_h=h,
+            )
+            save_id_map(
+                id_map=id_map,
+                folder=dataset_folder + '.id_map',
+            )
+
+        # Create a dataset, based on the (y_fused_ibn, x, h)-data
+        data = model.data.create_dataset(
+            emulate_lda_x=emulate_lda_x,
+            y_fused_ibn=y_fused_ibn,
+            x=x,
+            h=h,
+        )
+
+    if compact_data:
+        data = model.data.compact_dataset(
+            data=data,
+            float32_regressors=float32_regressors,
+        )
+
+    if not os.path.exists(datasets_folder):
+        os.makedirs(datasets_folder, exist_ok=True)
+    model.data.save_dataset(data=data, folder=dataset_folder)
+
+    return dataset_folder
@@ -50,8 +50,9 @@ def create_stub_initialization(
     )
     ev_q_counts_phi_init = np.zeros((data.dim_j, M))
     ev_q_counts_phi_init[:] = c_jm
-    ev_q_entropy_q_z_init = np.zeros(data.total_purchases)
-    ev_q_entropy_q_z_init[:] = (
+    # The entropy of q(z) per unique product in a basket, summed over the
+    # repeated purchases of that product
+    ev_q_entropy_q_z_init = data.multiplicity * (
         -np.sum(np.log(c_m_proportions) * c_m_proportions)
     )
     assert np.all(ev_q_entropy_q_z_init >= 0.0)
@@ -4,7 +4,20 @@ Description:
 
 Functions:
     routine: the optimization routine
+    local_step: the update of the local variational parameters
+    calc_ev_q_counts_phi: computes ev_q_counts_phi from q(z) of all purchases
     iteration: a single iteration of the optimization routine
+    global_step: the update of the global variational parameters
+    update_eps_alpha: recomputes ev_q_eps_alpha and ev_q_sum_ib_eps_alpha_sq
+    svi_iteration: a single iteration of the SVI mode (see model.svi)
+    distributed_iteration: a single iteration of the distributed mode (see
+        model.distributed)
+    distributed_global_step: the update of the global variational parameters
+        from the sufficient statistics of the workers
+    update_from_subset_tallies: copies the tallies of a subset of the
+        customers into the tallies
+    create_tallies: creates the tallies of the local step
+    save_theta_q_z: saves q(z) of all purchases as a float32 .npy file
 """
 
 # Standard library modules
@@ -17,9 +30,13 @@ import time
 import numpy as np
 
 # Own modules
+import model.data
+import model.distributed
 import model.elbo
 import model.functions
+import model.scheduling
 import model.state
+import model.svi
 
 
 def routine(
@@ -34,6 +51,9 @@ def routine(
         n_save_per,
         misc_settings,
         vi_settings,
+        svi_settings,
+        distributed_settings,
+        dataset_folder,
 ):
     # this code snippet prints the names of the fixed parameters
     if any(is_fixed):
@@ -43,6 +63,10 @@ def routine(
             in is_fixed._asdict().items() if is_fixed
         ]
 
+    # Keep the fields of a basket together in memory for the local step
+    if misc_settings.interleave_basket_state:
+        q = model.state.interleave_basket_state(q)
+
     elbo_start_routine = model.elbo.compute_elbo_container(
         q=q,
         M=M,
@@ -68,14 +92,103 @@ def routine(
     elbo_dict = {}
     elbo_current = elbo_start_routine
 
-    # Container for the variational parameters of q(z_ibn)
-    theta_q_z = np.empty((data.total_purchases, M))
+    tallies = create_tallies(data=data)
 
-    tallies = {
-        'updated_mu_q': np.zeros(data.total_baskets, dtype=int),
-        'updated_sigma_sq_q': np.zeros(data.total_baskets, dtype=int),
-        'updated_both': np.zeros(data.total_baskets, dtype=int),
-    }
+    # Active set of customers updated in the local step
+    is_active = np.ones(data.dim_i, dtype=bool)
+    n_skipped = np.zeros(data.dim_i, dtype=int)
+    global_shift = np.inf
+    customer_shift = np.full(data.dim_i, np.inf)
+
+    # Chunks of customers with an equal estimated cost for the local step
+    schedule = model.scheduling.create_schedule(
+        data=data,
+        M=M,
+        n_q_i_steps=vi_settings.n_q_i_steps,
+        n_chunks_per_thread=misc_settings.n_chunks_per_thread,
+        deterministic_counts_phi=misc_settings.deterministic_counts_phi,
+    )
+    model.scheduling.report_schedule(schedule=schedule)
+
+    # Container for the variational parameters of q(z_ibn), per unique
+    # product in a basket (see model.data.Data.y_unique). In the streaming
+    # mode, only the rows of the customer that a thread is updating are kept,
+    # and counts_phi is summed per thread during the local step. q(z) and its
+    # entropy are stored with the local precision.
+    local_dtype = np.dtype(misc_settings.local_precision)
+    assert local_dtype in (np.float32, np.float64), \
+        'Valid options for local_precision are float32 or float64'
+    q = q._replace(entropy_q_z=q.entropy_q_z.astype(local_dtype, copy=False))
+    if misc_settings.stream_q_z:
+        assert vi_settings.active_set_tol <= 0.0, \
+            'The active-set mode needs the q(z) of the skipped customers, ' \
+            'set stream_q_z to False'
+        n_rows_thread = np.max(model.data.unique_purchases_per_customer(data))
+        theta_q_z = np.empty(
+            (schedule.n_threads * n_rows_thread, M),
+            dtype=local_dtype,
+        )
+        counts_phi_thread = np.zeros((schedule.n_threads, data.dim_j, M))
+    else:
+        theta_q_z = np.empty((data.total_unique_purchases, M), dtype=local_dtype)
+        counts_phi_thread = np.zeros((0, data.dim_j, M))
+
+    # SVI mode: mini-batches of customers, see model.svi
+    if svi_settings.enabled:
+        assert not misc_settings.stream_q_z, \
+            'The SVI mode needs the q(z) of all customers, set stream_q_z ' \
+            'to False'
+        assert vi_settings.active_set_tol <= 0.0, \
+            'The SVI mode and the active-set mode can not be combined'
+        assert not misc_settings.check_state_consistency, \
+            'check_state assumes full updates of the global parameters, ' \
+            'set check_state_consistency to False'
+        assert svi_settings.step_delay >= 1.0 \
+            and (
+                svi_settings.step_forgetting == 0.0
+                or 0.5 < svi_settings.step_forgetting <= 1.0
+            ), \
+            'The SVI step size needs step_delay >= 1 and ' \
+            '0.5 < step_forgetting <= 1 (or step_forgetting = 0)'
+
+        rng = np.random.default_rng(svi_settings.seed)
+        batches = []
+
+        # q(z) of the customers that are not in a mini-batch yet, the
+        # proportions of ev_q_counts_phi per product, such that it is
+        # consistent with ev_q_counts_phi
+        theta_q_z[:] = (
+            q.counts_phi / np.sum(q.counts_phi, axis=1, keepdims=True)
+        )[data.y_unique]
+
+    # Distributed mode: the local step of shards of the customers in worker
+    # processes, see model.distributed
+    distributed = distributed_settings.n_workers > 0
+    if distributed:
+        assert not svi_settings.enabled, \
+            'The distributed mode and the SVI mode can not be combined'
+        assert vi_settings.active_set_tol <= 0.0, \
+            'The distributed mode and the active-set mode can not be combined'
+        assert not misc_settings.check_state_consistency, \
+            'check_state needs the local parameters of all customers, set ' \
+            'check_state_consistency to False'
+
+        # q(z) is kept by the workers
+        theta_q_z = None
+        connections, processes = model.distributed.start_workers(
+            distributed_settings=distributed_settings,
+        )
+        workers = model.distributed.setup_workers(
+            connections=connections,
+            q=q,
+            data=data,
+            dataset_folder=dataset_folder,
+            prior=prior,
+            is_fixed=is_fixed,
+            vi_settings=vi_settings,
+            misc_settings=misc_settings,
+            M=M,
+        )
 
     # Profiling code
     pr = None
@@ -96,6 +209,49 @@ def routine(
         tallies['updated_mu_q'][:] = 0
         tallies['updated_sigma_sq_q'][:] = 0
 
+        # Select the customers to update in the local step
+        if svi_settings.enabled:
+            if not batches:
+                # ev_q_counts_phi is updated per mini-batch, and is computed
+                # again from q(z) of all purchases after every pass
+                if n > 0 and not is_fixed.z:
+                    calc_ev_q_counts_phi(
+                        ev_q_counts_phi=q.counts_phi,
+                        theta_q_z=theta_q_z,
+                        schedule=schedule,
+                        data=data,
+                    )
+                batches = model.svi.create_batches(
+                    rng=rng,
+                    dim_i=data.dim_i,
+                    batch_size=svi_settings.batch_size,
+                )
+            batch_customers = batches.pop()
+            is_active[:] = False
+            is_active[batch_customers] = True
+            full_sweep = len(batch_customers) == data.dim_i
+        else:
+            full_sweep = model.scheduling.select_active_customers(
+                is_active=is_active,
+                n_skipped=n_skipped,
+                elbo_gain_q_i=tallies['elbo_gain_q_i'],
+                n=n,
+                global_shift=global_shift,
+                customer_shift=customer_shift,
+                vi_settings=vi_settings,
+            )
+            if full_sweep:
+                iteration_schedule = schedule
+            else:
+                iteration_schedule = model.scheduling.restrict_schedule(
+                    schedule=schedule,
+                    is_active=is_active,
+                )
+        previous_global_parameters = {
+            name: np.copy(getattr(q, name))
+            for name in model.scheduling.GLOBAL_PARAMETERS
+        }
+
         # Check the consistency of the variational state
         if misc_settings.check_state_consistency:
             model.state.check_state(
@@ -110,15 +266,55 @@ def routine(
             print('Variational state: Consistent')
 
         # Perform a single iteration of the optimization routine
-        q = iteration(
+        if svi_settings.enabled:
+            step_size = model.svi.calc_step_size(
+                n=n,
+                step_delay=svi_settings.step_delay,
+                step_forgetting=svi_settings.step_forgetting,
+            )
+            iteration_schedule = svi_iteration(
+                q=q,
+                theta_q_z=theta_q_z,
+                tallies=tallies,
+                customers=batch_customers,
+                step_size=step_size,
+                data=data,
+                prior=prior,
+                is_fixed=is_fixed,
+                vi_settings=vi_settings,
+                misc_settings=misc_settings,
+                M=M,
+            )
+        elif distributed:
+            elbo_after_iteration, local_step_times = distributed_iteration(
+                q=q,
+                workers=workers,
+                tallies=tallies,
+                data=data,
+                prior=prior,
+                is_fixed=is_fixed,
+                M=M,
+                return_tallies=print_this_iteration,
+            )
+        else:
+            q = iteration(
+                q=q,
+                theta_q_z=theta_q_z,
+                counts_phi_thread=counts_phi_thread,
+                stream_q_z=misc_settings.stream_q_z,
+                tallies=tallies,
+                schedule=iteration_schedule,
+                data=data,
+                prior=prior,
+                is_fixed=is_fixed,
+                vi_settings=vi_settings,
+                M=M,
+            )
+
+        global_shift, customer_shift = model.scheduling.calc_global_shift(
+            previous_global_parameters=previous_global_parameters,
             q=q,
-            theta_q_z=theta_q_z,
-            tallies=tallies,
             data=data,
-            prior=prior,
-            is_fixed=is_fixed,
-            vi_settings=vi_settings,
-            M=M,
         )
 
         # Check the consistency of the variational state
@@ -134,14 +330,29 @@ def routine(
 
             print('Variational state: Consistent')
 
-        # Compute the ELBO value after the iteration
-        elbo_after_iteration = model.elbo.compute_elbo_container(
-            q=q,
-            M=M,
-            n_purchases_per_basket=data.dim_n,
-            total_customers=data.total_customers,
-            total_baskets=data.total_baskets,
-        )
+        # In the SVI mode, the ELBO is only computed when it is printed or
+        # the state is saved, after ev_q_eps_alpha of all customers is
+        # recomputed for the current global parameters
+        if svi_settings.enabled:
+            if not (print_this_iteration or save_this_iteration
+                    or is_last_iteration):
+                continue
+            update_eps_alpha(
+                q=q,
+                data=data,
+                M=M,
+            )
+
+        # Compute the ELBO value after the iteration, in the distributed mode
+        # from the sums of the workers
+        if not distributed:
+            elbo_after_iteration = model.elbo.compute_elbo_container(
+                q=q,
+                M=M,
+                n_purchases_per_basket=data.dim_n,
+                total_customers=data.total_customers,
+                total_baskets=data.total_baskets,
+            )
 
         # Print information about the current iteration
         if print_this_iteration:
@@ -151,12 +362,47 @@ def routine(
                 'ELBO difference:',
                 elbo_after_iteration.total - elbo_current.total
             )
+            if distributed:
+                print('Local step time per worker: {}'.format(
+                    ' '.join('{:.2f}s'.format(t) for t in local_step_times)))
+            else:
+                model.scheduling.report_schedule(
+                    schedule=iteration_schedule,
+                    local_step_time=tallies['local_step_time'],
+                    thread_busy_time=tallies['thread_busy_time'],
+                )
+            if svi_settings.enabled:
+                print('Mini-batch: {} of {} customers, step size: {:.4f}'.format(
+                    len(batch_customers),
+                    data.dim_i,
+                    step_size,
+                ))
+            elif vi_settings.active_set_tol > 0.0:
+                print('Active customers: {} of {}, global shift: {:.2e}, median log_phi shift: {:.2e}'.format(
+                    np.sum(is_active),
+                    data.dim_i,
+                    global_shift,
+                    np.median(customer_shift),
+                ))
+            if np.any(is_active):
+                print(
+                    'q_i sub-iterations used: mean {:.2f}, median {:.0f}, max {}'.format(
+                        np.mean(tallies['n_q_i_steps'][is_active]),
+                        np.median(tallies['n_q_i_steps'][is_active]),
+                        np.max(tallies['n_q_i_steps'][is_active]),
+                    )
+                )
+            # In the SVI mode, of the baskets in the mini-batch
+            if svi_settings.enabled:
+                reported_baskets = np.repeat(is_active, data.dim_b)
+            else:
+                reported_baskets = slice(None)
             print('q(alpha) % of proposals accepted: ', end='')
             print(
                 'mu_q_ib {:.2f}%, sigma_sq_q_ib {:.2f}%, both {:.2f}%'.format(
-                    100 * np.mean(tallies['updated_mu_q'] != 0),
-                    100 * np.mean(tallies['updated_sigma_sq_q'] != 0),
-                    100 * np.mean(tallies['updated_both'] != 0),
+                    100 * np.mean(tallies['updated_mu_q'][reported_baskets] != 0),
+                    100 * np.mean(tallies['updated_sigma_sq_q'][reported_baskets] != 0),
+                    100 * np.mean(tallies['updated_both'][reported_baskets] != 0),
                 )
             )
 
@@ -168,10 +414,40 @@ def routine(
         elbo_dict[n] = elbo_after_iteration
 
         if save_this_iteration or is_last_iteration:
+            # The local parameters (and q(z)) of all customers from the
+            # workers
+            if distributed:
+                if misc_settings.save_theta_q_z and not misc_settings.stream_q_z:
+                    theta_q_z = np.empty(
+                        (data.total_unique_purchases, M),
+                        dtype=local_dtype,
+                    )
+                model.distributed.gather_state(
+                    workers=workers,
+                    q=q,
+                    theta_q_z=theta_q_z,
+                )
             np.savez_compressed(
                 os.path.join(model_output_folder, 'state_{0:0>10}'.format(n)),
                 **q._asdict()
             )
+            if misc_settings.save_theta_q_z:
+                save_theta_q_z(
+                    npy_file=os.path.join(
+                        model_output_folder,
+                        'theta_q_z_{0:0>10}.npy'.format(n)
+                    ),
+                    theta_q_z=theta_q_z,
+                    q=q,
+                    data=data,
+                    stream_q_z=misc_settings.stream_q_z,
+                )
+
+    if distributed:
+        model.distributed.stop_workers(
+            workers=workers,
+            processes=processes,
+        )
 
     if misc_settings.profile_code:
         pr.disable()
@@ -183,20 +459,58 @@ def routine(
     return q, elbo_dict
 
 
-def iteration(
+def save_theta_q_z(
+        npy_file,
+        theta_q_z,
+        q,
+        data,
+        stream_q_z,
+):
+    """Saves q(z) of all purchases as a float32 .npy file.
+
+    Row u is q(z_ibn) of the multiplicity[u] purchases of product y_unique[u]
+    in a basket (see model.data.Data). In the streaming mode, q(z) is not
+    kept during the optimization, and is computed again from mu_q_alpha and
+    log_phi (see model.functions.calc_theta_q_z).
+    """
+
+    theta_q_z_out = np.lib.format.open_memmap(
+        npy_file,
+        mode='w+',
+        dtype=np.float32,
+        shape=(data.total_unique_purchases, q.mu_q_alpha.shape[1]),
+    )
+    if stream_q_z:
+        model.functions.calc_theta_q_z(
+            theta_q_z=np.asarray(theta_q_z_out),
+            mu_q_alpha=q.mu_q_alpha,
+            ev_q_log_phi=q.log_phi,
+            y_unique=data.y_unique,
+            ib_to_iu_lb=data.ib_to_iu_lb,
+            ib_to_iu_ub=data.ib_to_iu_ub,
+        )
+    else:
+        theta_q_z_out[:] = theta_q_z
+    theta_q_z_out.flush()
+    del theta_q_z_out
+
+
+def local_step(
         q,
         theta_q_z,
+        counts_phi_thread,
+        stream_q_z,
         tallies,
+        schedule,
         data,
-        prior,
         is_fixed,
         vi_settings,
         M,
 ):
-
-    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-    # LOCAL Q UPDATE  # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    """Updates q(z), q(alpha) and q(kappa) of the customers in the schedule,
+    and ev_q_counts_phi, and records the time in tallies['local_step_time'],
+    and the measured busy time per thread in tallies['thread_busy_time'].
+    """
 
     # Auxiliary variables for the efficient inverse
     L_inv = np.diag(q.tau_alpha**-0.5)
@@ -204,13 +518,32 @@ def iteration(
     U_T_mmul_L_inv = U.T @ L_inv
     log_det_C = np.sum(np.log(q.tau_alpha))
 
+    # Covariance of q(kappa_i) per distinct number of baskets, read by all
+    # threads in the local step (none if kappa is fixed, as the covariance
+    # may not exist then)
+    (
+        cov_q_kappa,
+        log_det_cov_q_kappa,
+        cov_q_kappa_index,
+    ) = model.functions.calc_cov_q_kappa(
+        dim_b=data.dim_b,
+        customers=schedule.customers[:0] if is_fixed.kappa else schedule.customers,
+        ev_q_delta_kappa_sq=q.delta_kappa_sq,
+        U_T_mmul_L_inv=U_T_mmul_L_inv,
+        v=v,
+        log_det_C=log_det_C,
+    )
+
+    start_local_step = time.time()
+    counts_phi_thread[:] = 0.0
+    tallies['thread_busy_time'] = np.zeros(schedule.n_threads)
     model.functions.update_q_local(
         # # variables to be updated
         # z
         theta_q_z=theta_q_z,
+        ev_q_counts_phi_thread=counts_phi_thread,
         ev_q_counts_basket=q.counts_basket,
         ev_q_entropy_q_z=q.entropy_q_z,
-        ev_q_counts_phi=q.counts_phi,
         # alpha
         mu_q_alpha=q.mu_q_alpha,
         sigma_sq_q_alpha=q.sigma_sq_q_alpha,
@@ -231,28 +564,142 @@ def iteration(
         # mix
         ev_q_eps_alpha=q.eps_alpha,
         # # rest
-        ev_q_log_phi=q.log_phi,
+        # log_phi with the precision of q(z), as it is gathered per purchase
+        ev_q_log_phi=q.log_phi.astype(theta_q_z.dtype, copy=False),
         ev_q_tau_alpha=q.tau_alpha,
         ev_q_mu_kappa=q.mu_kappa,
         ev_q_lambda_kappa=q.lambda_kappa,
         ev_q_rho=q.rho,
         ev_q_rho_outer=q.rho_outer,
-        ev_q_delta_kappa=q.delta_kappa,
-        ev_q_delta_kappa_sq=q.delta_kappa_sq,
+        ev_q_delta_kappa=float(q.delta_kappa),
+        ev_q_delta_kappa_sq=float(q.delta_kappa_sq),
         dim_m=M,
         data=data,
         vi_settings=vi_settings,
         is_fixed=is_fixed,
-        U_T_mmul_L_inv=U_T_mmul_L_inv,
-        v=v,
-        log_det_C=log_det_C,
+        cov_q_kappa=cov_q_kappa,
+        log_det_cov_q_kappa=log_det_cov_q_kappa,
+        cov_q_kappa_index=cov_q_kappa_index,
+        customers=schedule.customers,
+        chunk_lb=schedule.chunk_lb,
+        chunk_ub=schedule.chunk_ub,
+        thread_chunk_lb=schedule.thread_chunk_lb,
+        thread_chunk_ub=schedule.thread_chunk_ub,
+        stream_q_z=stream_q_z,
+        n_steps_used=tallies['n_q_i_steps'],
+        elbo_gain_q_i=tallies['elbo_gain_q_i'],
+        thread_busy_time=tallies['thread_busy_time'],
+    )
+
+    # ev_q_counts_phi is fixed if z is fixed
+    if not is_fixed.z:
+        if stream_q_z:
+            np.sum(counts_phi_thread, axis=0, out=q.counts_phi)
+        else:
+            calc_ev_q_counts_phi(
+                ev_q_counts_phi=q.counts_phi,
+                theta_q_z=theta_q_z,
+                schedule=schedule,
+                data=data,
+            )
+    tallies['local_step_time'] = time.time() - start_local_step
+
+
+def calc_ev_q_counts_phi(
+        ev_q_counts_phi,
+        theta_q_z,
+        schedule,
+        data,
+):
+    """Computes ev_q_counts_phi from q(z) of all purchases, per product or
+    per block of purchases as in the schedule (see model.scheduling).
+    """
+
+    if schedule.purchases_by_product is not None:
+        model.functions.calc_ev_q_counts_phi_sorted(
+            ev_q_counts_phi=ev_q_counts_phi,
+            theta_q_z=theta_q_z,
+            multiplicity=data.multiplicity,
+            purchases_by_product=schedule.purchases_by_product,
+            product_lb=schedule.product_lb,
+            product_ub=schedule.product_ub,
+        )
+    else:
+        model.functions.calc_ev_q_counts_phi_partial(
+            ev_q_counts_phi=ev_q_counts_phi,
+            theta_q_z=theta_q_z,
+            y_unique=data.y_unique,
+            multiplicity=data.multiplicity,
+            n_blocks=schedule.n_threads,
+        )
+
+
+def iteration(
+        q,
+        theta_q_z,
+        counts_phi_thread,
+        stream_q_z,
+        tallies,
+        schedule,
+        data,
+        prior,
+        is_fixed,
+        vi_settings,
+        M,
+):
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    # LOCAL Q UPDATE  # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+    local_step(
+        q=q,
+        theta_q_z=theta_q_z,
+        counts_phi_thread=counts_phi_thread,
+        stream_q_z=stream_q_z,
+        tallies=tallies,
+        schedule=schedule,
+        data=data,
+        is_fixed=is_fixed,
+        vi_settings=vi_settings,
+        M=M,
     )
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     # GLOBAL Q UPDATE # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+    global_step(
+        q=q,
+        data=data,
+        prior=prior,
+        is_fixed=is_fixed,
+        M=M,
+    )
+
+    return q
+
+
+def global_step(
+        q,
+        data,
+        prior,
+        is_fixed,
+        M,
+        step_size=1.0,
+        scale=1.0,
+):
+    """Updates the global parameters that are not fixed, in place.
+
+    In the SVI mode (see model.svi), q and data are the state and dataset of
+    a mini-batch of customers (see model.state.subset_state), and each update
+    is followed by a step of size step_size from the previous natural
+    parameters towards the update, with the sufficient statistics multiplied
+    by scale. The default step_size and scale give the full update.
+    """
+
     if not is_fixed.phi:
+        eta_previous = np.copy(q.eta_q_phi)
         model.functions.update_q_phi(
             eta_q_phi=q.eta_q_phi,
             ev_q_log_phi=q.log_phi,
@@ -261,8 +708,19 @@ def iteration(
             prior=prior,
             dim_m=M,
         )
+        _blend_global_parameter(
+            q=q,
+            name='phi',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.beta:
+        eta_previous = np.copy(q.eta_q_beta)
         model.functions.update_q_beta(
             eta_q_beta=q.eta_q_beta,
             ev_q_beta=q.beta,
@@ -279,8 +737,19 @@ def iteration(
             ib_first=data.ib_first,
             ib_not_first=data.ib_not_first,
         )
+        _blend_global_parameter(
+            q=q,
+            name='beta',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.gamma:
+        eta_previous = np.copy(q.eta_q_gamma)
         model.functions.update_q_gamma(
             eta_q_gamma=q.eta_q_gamma,
             ev_q_gamma=q.gamma,
@@ -297,8 +766,19 @@ def iteration(
             ib_first=data.ib_first,
             ib_not_first=data.ib_not_first,
         )
+        _blend_global_parameter(
+            q=q,
+            name='gamma',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.rho:
+        eta_previous = np.copy(q.eta_q_rho)
         model.functions.update_q_rho(
             eta_q_rho=q.eta_q_rho,
             ev_q_rho=q.rho,
@@ -312,8 +792,19 @@ def iteration(
             ib_not_first=data.ib_not_first,
             ib_not_last=data.ib_not_last,
         )
+        _blend_global_parameter(
+            q=q,
+            name='rho',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.delta:
+        eta_previous = np.copy(q.eta_q_delta)
         model.functions.update_q_delta(
             eta_q_delta=q.eta_q_delta,
             ev_q_delta=q.delta,
@@ -325,8 +816,19 @@ def iteration(
             dim_i=data.dim_i,
             ib_first=data.ib_first,
         )
+        _blend_global_parameter(
+            q=q,
+            name='delta',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.delta_kappa:
+        eta_previous = np.copy(q.eta_q_delta_kappa)
         model.functions.update_q_delta_kappa(
             eta_q_delta_kappa=q.eta_q_delta_kappa,
             ev_q_delta_kappa=q.delta_kappa,
@@ -339,8 +841,19 @@ def iteration(
             prior=prior,
             ib_first=data.ib_first,
         )
+        _blend_global_parameter(
+            q=q,
+            name='delta_kappa',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.delta_beta:
+        eta_previous = np.copy(q.eta_q_delta_beta)
         model.functions.update_q_delta_beta(
             eta_q_delta_beta=q.eta_q_delta_beta,
             ev_q_delta_beta=q.delta_beta,
@@ -356,8 +869,19 @@ def iteration(
             x_outer_sum_first=data.x_outer_sum_first,
             ib_first=data.ib_first,
         )
+        _blend_global_parameter(
+            q=q,
+            name='delta_beta',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     if not is_fixed.delta_gamma:
+        eta_previous = np.copy(q.eta_q_delta_gamma)
         model.functions.update_q_delta_gamma(
             eta_q_delta_gamma=q.eta_q_delta_gamma,
             ev_q_delta_gamma=q.delta_gamma,
@@ -373,8 +897,135 @@ def iteration(
             h_outer_sum_first=data.h_outer_sum_first,
             ib_first=data.ib_first,
         )
+        _blend_global_parameter(
+            q=q,
+            name='delta_gamma',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
 
     # Recompute ev_q_eps_alpha and compute ev_q_sum_ib_eps_alpha_sq
+    update_eps_alpha(
+        q=q,
+        data=data,
+        M=M,
+    )
+
+    if not is_fixed.tau_alpha:
+        eta_previous = np.copy(q.eta_q_tau_alpha)
+        model.functions.update_q_tau_alpha(
+            eta_q_tau_alpha=q.eta_q_tau_alpha,
+            ev_q_tau_alpha=q.tau_alpha,
+            ev_q_log_tau_alpha=q.log_tau_alpha,
+            ev_q_negative_kl_q_p_tau_alpha=q.negative_kl_q_p_tau_alpha,
+            ev_q_sum_ib_eps_alpha_sq=q.sum_ib_eps_alpha_sq,
+            prior=prior,
+            total_baskets=data.total_baskets,
+            dim_m=M,
+        )
+        _blend_global_parameter(
+            q=q,
+            name='tau_alpha',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
+
+    if not is_fixed.mu_kappa:
+        eta_previous = np.copy(q.eta_q_mu_kappa)
+        model.functions.update_q_mu_kappa(
+            eta_q_mu_kappa=q.eta_q_mu_kappa,
+            ev_q_mu_kappa=q.mu_kappa,
+            ev_q_mu_kappa_outer=q.mu_kappa_outer,
+            ev_q_negative_kl_q_p_mu_kappa=q.negative_kl_q_p_mu_kappa,
+            sum_ev_q_kappa=np.sum(q.kappa, axis=0),
+            ev_q_lambda_kappa=q.lambda_kappa,
+            prior=prior,
+            dim_i=data.dim_i,
+        )
+        _blend_global_parameter(
+            q=q,
+            name='mu_kappa',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
+
+    if not is_fixed.lambda_kappa:
+        eta_previous = np.copy(q.eta_q_lambda_kappa)
+        model.functions.update_q_lambda_kappa(
+            eta_q_lambda_kappa=q.eta_q_lambda_kappa,
+            ev_q_lambda_kappa=q.lambda_kappa,
+            ev_q_log_det_lambda_kappa=q.log_det_lambda_kappa,
+            ev_q_negative_kl_q_p_lambda_kappa=q.negative_kl_q_p_lambda_kappa,
+            sum_ev_q_kappa=np.sum(q.kappa, axis=0),
+            sum_ev_q_kappa_outer=np.sum(q.kappa_outer, axis=0),
+            ev_q_mu_kappa=q.mu_kappa,
+            ev_q_mu_kappa_outer=q.mu_kappa_outer,
+            prior=prior,
+            dim_i=data.dim_i,
+        )
+        _blend_global_parameter(
+            q=q,
+            name='lambda_kappa',
+            eta_previous=eta_previous,
+            data=data,
+            prior=prior,
+            step_size=step_size,
+            scale=scale,
+            M=M,
+        )
+
+
+def _blend_global_parameter(
+        q,
+        name,
+        eta_previous,
+        data,
+        prior,
+        step_size,
+        scale,
+        M,
+):
+    # The step of the SVI mode, after which ev_q_eps_alpha of the mini-batch
+    # is recomputed for the new global parameter
+    if step_size == 1.0 and scale == 1.0:
+        return
+
+    model.svi.blend_global_parameter(
+        q=q,
+        name=name,
+        eta_previous=eta_previous,
+        prior=prior,
+        step_size=step_size,
+        scale=scale,
+    )
+    update_eps_alpha(
+        q=q,
+        data=data,
+        M=M,
+    )
+
+
+def update_eps_alpha(
+        q,
+        data,
+        M,
+):
+    """Recomputes ev_q_eps_alpha and ev_q_sum_ib_eps_alpha_sq of the baskets
+    in data, in place.
+    """
+
     model.functions.calc_ev_q_eps_alpha(
         ev_q_eps_alpha=q.eps_alpha,
         mu_q_alpha=q.mu_q_alpha,
@@ -414,6 +1065,389 @@ def iteration(
         data=data,
     )
 
+
+def svi_iteration(
+        q,
+        theta_q_z,
+        tallies,
+        customers,
+        step_size,
+        data,
+        prior,
+        is_fixed,
+        vi_settings,
+        misc_settings,
+        M,
+):
+    """Performs an iteration of the SVI mode (see model.svi): the local step
+    of a mini-batch of customers, and a step of size step_size on the global
+    parameters towards their update from the mini-batch.
+
+    q(z) of all purchases is kept in theta_q_z, and q.counts_phi is updated
+    with the change of the counts of the mini-batch. q.eps_alpha and
+    q.sum_ib_eps_alpha_sq are only recomputed for the mini-batch (see
+    update_eps_alpha). Returns the schedule of the mini-batch.
+    """
+
+    data_batch, baskets, unique_purchases = model.data.subset_dataset(
+        data=data,
+        customers=customers,
+    )
+    q_batch = model.state.subset_state(
+        q=q,
+        customers=customers,
+        baskets=baskets,
+        unique_purchases=unique_purchases,
+    )
+    scale = data.dim_i / data_batch.dim_i
+
+    # ev_q_eps_alpha of the mini-batch for the current global parameters
+    update_eps_alpha(
+        q=q_batch,
+        data=data_batch,
+        M=M,
+    )
+
+    # The counts of the mini-batch before the local step. If z is fixed,
+    # ev_q_counts_phi is fixed, and is divided by the scale of the global step
+    theta_q_z_batch = theta_q_z[unique_purchases]
+    counts_phi_previous = np.zeros_like(q.counts_phi)
+    if is_fixed.z:
+        q_batch.counts_phi[:] = q.counts_phi / scale
+    else:
+        model.functions.calc_ev_q_counts_phi_partial(
+            ev_q_counts_phi=counts_phi_previous,
+            theta_q_z=theta_q_z_batch,
+            y_unique=data_batch.y_unique,
+            multiplicity=data_batch.multiplicity,
+            n_blocks=1,
+        )
+
+    schedule = model.scheduling.create_schedule(
+        data=data_batch,
+        M=M,
+        n_q_i_steps=vi_settings.n_q_i_steps,
+        n_chunks_per_thread=misc_settings.n_chunks_per_thread,
+        deterministic_counts_phi=misc_settings.deterministic_counts_phi,
+    )
+    tallies_batch = create_tallies(data=data_batch)
+
+    local_step(
+        q=q_batch,
+        theta_q_z=theta_q_z_batch,
+        counts_phi_thread=np.zeros((0, data.dim_j, M)),
+        stream_q_z=False,
+        tallies=tallies_batch,
+        schedule=schedule,
+        data=data_batch,
+        is_fixed=is_fixed,
+        vi_settings=vi_settings,
+        M=M,
+    )
+
+    # q_batch shares the global parameters with q
+    global_step(
+        q=q_batch,
+        data=data_batch,
+        prior=prior,
+        is_fixed=is_fixed,
+        M=M,
+        step_size=step_size,
+        scale=scale,
+    )
+
+    # The local parameters of the mini-batch back into q
+    if not is_fixed.z:
+        q.counts_phi[:] += q_batch.counts_phi - counts_phi_previous
+    theta_q_z[unique_purchases] = theta_q_z_batch
+    model.state.update_from_subset_state(
+        q=q,
+        q_subset=q_batch,
+        customers=customers,
+        baskets=baskets,
+        unique_purchases=unique_purchases,
+    )
+
+    update_from_subset_tallies(
+        tallies=tallies,
+        tallies_subset=tallies_batch,
+        customers=customers,
+        baskets=baskets,
+    )
+    tallies['local_step_time'] = tallies_batch['local_step_time']
+    tallies['thread_busy_time'] = tallies_batch['thread_busy_time']
+
+    return schedule
+
+
+def distributed_iteration(
+        q,
+        workers,
+        tallies,
+        data,
+        prior,
+        is_fixed,
+        M,
+        return_tallies,
+):
+    """Performs an iteration of the distributed mode (see model.distributed):
+    the local step of all shards in the workers, and the global step on the
+    sufficient statistics summed over the workers.
+
+    The local parameters in q are not updated (see
+    model.distributed.gather_state). The tallies per basket and per customer
+    are only copied from the workers if return_tallies is True. Returns the
+    ELBO after the iteration, and the time of the local step per worker.
+    """
+
+    replies = model.distributed.request(
+        workers=workers,
+        command='local_step',
+        global_fields=model.distributed.global_fields(q=q),
+        return_tallies=return_tallies,
+    )
+
+    # ev_q_counts_phi is fixed if z is fixed
+    if not is_fixed.z:
+        q.counts_phi[:] = model.distributed.sum_replies(
+            [reply['counts_phi'] for reply in replies])
+
+    local_step_times = [reply['local_step_time'] for reply in replies]
+    tallies['local_step_time'] = max(local_step_times)
+    if return_tallies:
+        for worker, reply in zip(workers, replies):
+            update_from_subset_tallies(
+                tallies=tallies,
+                tallies_subset=reply['tallies'],
+                customers=worker.customers,
+                baskets=worker.baskets,
+            )
+
+    updated_parameters = distributed_global_step(
+        q=q,
+        workers=workers,
+        data=data,
+        prior=prior,
+        is_fixed=is_fixed,
+        M=M,
+    )
+
+    elbo_sums = model.distributed.sum_replies(model.distributed.request(
+        workers=workers,
+        command='elbo',
+        global_fields=model.distributed.global_fields(
+            q=q,
+            parameters=updated_parameters,
+        ),
+    ))
+    elbo = model.elbo.compute_elbo_container_from_sums(
+        q=q,
+        elbo_sums=elbo_sums,
+        M=M,
+        total_customers=data.total_customers,
+        total_baskets=data.total_baskets,
+    )
+
+    return elbo, local_step_times
+
+
+def _request_statistics(
+        workers,
+        name,
+        q,
+        updated_parameters,
+):
+    # The sufficient statistics of a global parameter summed over the workers,
+    # which first receive the parameters updated since the last request
+    statistics = model.distributed.sum_replies(model.distributed.request(
+        workers=workers,
+        command='statistics',
+        name=name,
+        global_fields=model.distributed.global_fields(
+            q=q,
+            parameters=updated_parameters,
+        ),
+    ))
+    updated_parameters.clear()
+
+    return statistics
+
+
+def distributed_global_step(
+        q,
+        workers,
+        data,
+        prior,
+        is_fixed,
+        M,
+):
+    """Updates the global parameters that are not fixed, in place, in the
+    order of global_step, from the sufficient statistics summed over the
+    workers (see model.worker.calc_sufficient_statistics).
+
+    Returns the parameters updated after the last request to the workers,
+    which still have to be sent to them.
+    """
+
+    updated_parameters = []
+
+    if not is_fixed.phi:
+        model.functions.update_q_phi(
+            eta_q_phi=q.eta_q_phi,
+            ev_q_log_phi=q.log_phi,
+            negative_kl_q_p_phi=q.negative_kl_q_p_phi,
+            ev_q_counts_phi=q.counts_phi,
+            prior=prior,
+            dim_m=M,
+        )
+        updated_parameters.append('phi')
+
+    if not is_fixed.beta:
+        model.functions.update_q_beta_ss(
+            eta_q_beta=q.eta_q_beta,
+            ev_q_beta=q.beta,
+            ev_q_beta_outer=q.beta_outer,
+            negative_kl_q_p_beta=q.negative_kl_q_p_beta,
+            ev_q_tau_alpha=q.tau_alpha,
+            ev_q_delta_beta_sq=q.delta_beta_sq,
+            ss_x_eps_alpha=_request_statistics(
+                workers=workers,
+                name='beta',
+                q=q,
+                updated_parameters=updated_parameters,
+            ),
+            x_outer_sum_first=data.x_outer_sum_first,
+            x_outer_sum_not_first=data.x_outer_sum_not_first,
+            prior=prior,
+        )
+        updated_parameters.append('beta')
+
+    if not is_fixed.gamma:
+        model.functions.update_q_gamma_ss(
+            eta_q_gamma=q.eta_q_gamma,
+            ev_q_gamma=q.gamma,
+            ev_q_gamma_outer=q.gamma_outer,
+            negative_kl_q_p_gamma=q.negative_kl_q_p_gamma,
+            ev_q_tau_alpha=q.tau_alpha,
+            ev_q_delta_gamma_sq=q.delta_gamma_sq,
+            ss_h_eps_alpha=_request_statistics(
+                workers=workers,
+                name='gamma',
+                q=q,
+                updated_parameters=updated_parameters,
+            ),
+            h_outer_sum_first=data.h_outer_sum_first,
+            h_outer_sum_not_first=data.h_outer_sum_not_first,
+            prior=prior,
+        )
+        updated_parameters.append('gamma')
+
+    if not is_fixed.rho:
+        ss_alpha_outer, ss_alpha_eps_alpha = _request_statistics(
+            workers=workers,
+            name='rho',
+            q=q,
+            updated_parameters=updated_parameters,
+        )
+        model.functions.update_q_rho_ss(
+            eta_q_rho=q.eta_q_rho,
+            ev_q_rho=q.rho,
+            ev_q_rho_outer=q.rho_outer,
+            negative_kl_q_p_rho=q.negative_kl_q_p_rho,
+            ev_q_tau_alpha=q.tau_alpha,
+            ss_alpha_outer=ss_alpha_outer,
+            ss_alpha_eps_alpha=ss_alpha_eps_alpha,
+            prior=prior,
+        )
+        updated_parameters.append('rho')
+
+    if not is_fixed.delta:
+        model.functions.update_q_delta_ss(
+            eta_q_delta=q.eta_q_delta,
+            ev_q_delta=q.delta,
+            ev_q_delta_sq=q.delta_sq,
+            ev_q_negative_kl_q_p_delta=q.negative_kl_q_p_delta,
+            ev_q_tau_alpha=q.tau_alpha,
+            ss_eps_alpha_first=_request_statistics(
+                workers=workers,
+                name='delta',
+                q=q,
+                updated_parameters=updated_parameters,
+            ),
+            prior=prior,
+            dim_i=data.dim_i,
+        )
+        updated_parameters.append('delta')
+
+    if not is_fixed.delta_kappa:
+        ss_kappa_eps_alpha_first, ss_kappa_sq = _request_statistics(
+            workers=workers,
+            name='delta_kappa',
+            q=q,
+            updated_parameters=updated_parameters,
+        )
+        model.functions.update_q_delta_kappa_ss(
+            eta_q_delta_kappa=q.eta_q_delta_kappa,
+            ev_q_delta_kappa=q.delta_kappa,
+            ev_q_delta_kappa_sq=q.delta_kappa_sq,
+            ev_q_negative_kl_q_p_delta_kappa=q.negative_kl_q_p_delta_kappa,
+            ev_q_tau_alpha=q.tau_alpha,
+            ss_kappa_eps_alpha_first=ss_kappa_eps_alpha_first,
+            ss_kappa_sq=ss_kappa_sq,
+            prior=prior,
+        )
+        updated_parameters.append('delta_kappa')
+
+    if not is_fixed.delta_beta:
+        model.functions.update_q_delta_beta_ss(
+            eta_q_delta_beta=q.eta_q_delta_beta,
+            ev_q_delta_beta=q.delta_beta,
+            ev_q_delta_beta_sq=q.delta_beta_sq,
+            ev_q_negative_kl_q_p_delta_beta=q.negative_kl_q_p_delta_beta,
+            ev_q_beta=q.beta,
+            ev_q_beta_outer=q.beta_outer,
+            ev_q_tau_alpha=q.tau_alpha,
+            ss_x_eps_alpha_first=_request_statistics(
+                workers=workers,
+                name='delta_beta',
+                q=q,
+                updated_parameters=updated_parameters,
+            ),
+            dim_m=M,
+            prior=prior,
+            x_outer_sum_first=data.x_outer_sum_first,
+        )
+        updated_parameters.append('delta_beta')
+
+    if not is_fixed.delta_gamma:
+        model.functions.update_q_delta_gamma_ss(
+            eta_q_delta_gamma=q.eta_q_delta_gamma,
+            ev_q_delta_gamma=q.delta_gamma,
+            ev_q_delta_gamma_sq=q.delta_gamma_sq,
+            ev_q_negative_kl_q_p_delta_gamma=q.negative_kl_q_p_delta_gamma,
+            ev_q_gamma=q.gamma,
+            ev_q_gamma_outer=q.gamma_outer,
+            ev_q_tau_alpha=q.tau_alpha,
+            ss_h_eps_alpha_first=_request_statistics(
+                workers=workers,
+                name='delta_gamma',
+                q=q,
+                updated_parameters=updated_parameters,
+            ),
+            dim_m=M,
+            prior=prior,
+            h_outer_sum_first=data.h_outer_sum_first,
+        )
+        updated_parameters.append('delta_gamma')
+
+    # Recompute ev_q_eps_alpha in the workers and sum ev_q_sum_ib_eps_alpha_sq
+    q.sum_ib_eps_alpha_sq[:] = _request_statistics(
+        workers=workers,
+        name='eps_alpha',
+        q=q,
+        updated_parameters=updated_parameters,
+    )
+
     if not is_fixed.tau_alpha:
         model.functions.update_q_tau_alpha(
             eta_q_tau_alpha=q.eta_q_tau_alpha,
@@ -425,6 +1459,15 @@ def iteration(
             total_baskets=data.total_baskets,
             dim_m=M,
         )
+        updated_parameters.append('tau_alpha')
+
+    if not (is_fixed.mu_kappa and is_fixed.lambda_kappa):
+        sum_ev_q_kappa, sum_ev_q_kappa_outer = _request_statistics(
+            workers=workers,
+            name='kappa',
+            q=q,
+            updated_parameters=updated_parameters,
+        )
 
     if not is_fixed.mu_kappa:
         model.functions.update_q_mu_kappa(
@@ -432,11 +1475,12 @@ def iteration(
             ev_q_mu_kappa=q.mu_kappa,
             ev_q_mu_kappa_outer=q.mu_kappa_outer,
             ev_q_negative_kl_q_p_mu_kappa=q.negative_kl_q_p_mu_kappa,
-            sum_ev_q_kappa=np.sum(q.kappa, axis=0),
+            sum_ev_q_kappa=sum_ev_q_kappa,
             ev_q_lambda_kappa=q.lambda_kappa,
             prior=prior,
             dim_i=data.dim_i,
         )
+        updated_parameters.append('mu_kappa')
 
     if not is_fixed.lambda_kappa:
         model.functions.update_q_lambda_kappa(
@@ -444,15 +1488,46 @@ def iteration(
             ev_q_lambda_kappa=q.lambda_kappa,
             ev_q_log_det_lambda_kappa=q.log_det_lambda_kappa,
             ev_q_negative_kl_q_p_lambda_kappa=q.negative_kl_q_p_lambda_kappa,
-            sum_ev_q_kappa=np.sum(q.kappa, axis=0),
-            sum_ev_q_kappa_outer=np.sum(q.kappa_outer, axis=0),
+            sum_ev_q_kappa=sum_ev_q_kappa,
+            sum_ev_q_kappa_outer=sum_ev_q_kappa_outer,
             ev_q_mu_kappa=q.mu_kappa,
             ev_q_mu_kappa_outer=q.mu_kappa_outer,
             prior=prior,
             dim_i=data.dim_i,
         )
+        updated_parameters.append('lambda_kappa')
 
-    return q
+    return updated_parameters
+
+
+def update_from_subset_tallies(
+        tallies,
+        tallies_subset,
+        customers,
+        baskets,
+):
+    """Copies the tallies per basket and per customer of the local step of a
+    subset of the customers (see model.data.subset_dataset) into tallies.
+    """
+
+    for name in ('updated_mu_q', 'updated_sigma_sq_q', 'updated_both'):
+        tallies[name][baskets] = tallies_subset[name]
+    for name in ('n_q_i_steps', 'elbo_gain_q_i'):
+        tallies[name][customers] = tallies_subset[name]
+
+
+def create_tallies(data):
+    """Returns the tallies of the local step, per basket and per customer."""
+
+    return {
+        'updated_mu_q': np.zeros(data.total_baskets, dtype=int),
+        'updated_sigma_sq_q': np.zeros(data.total_baskets, dtype=int),
+        'updated_both': np.zeros(data.total_baskets, dtype=int),
+        'n_q_i_steps': np.zeros(data.dim_i, dtype=int),
+        'elbo_gain_q_i': np.zeros(data.dim_i),
+        'local_step_time': 0.0,
+        'thread_busy_time': np.zeros(0),
+    }
 
 
 
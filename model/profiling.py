@@ -0,0 +1,240 @@
+"""
+Description:
+    Contains a profile of a dataset for the CTM model, used to size thread
+    counts, memory and chunk sizes before an estimation run.
+
+    All statistics are computed from the arrays of a model.data.Data
+    structure with vectorized numpy operations, without scanning the input
+    files again.
+
+Functions:
+    estimate_customer_cost: estimates the relative cost of the local step
+    (update_q_i) per customer.
+
+    profile_dataset: computes distributions of the baskets per customer, the
+    purchases per basket/customer, the product frequencies, and the estimated
+    local step cost per customer.
+
+    write_profile: writes a profile to a JSON file.
+"""
+
+# Standard library modules
+import json
+
+# External modules
+import numpy as np
+
+# Own modules
+import model.data
+import model.scheduling
+
+
+PERCENTILES = (1, 10, 50, 90, 99, 99.9)
+THREAD_COUNTS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def estimate_customer_cost(
+        data,
+        M,
+        n_q_i_steps,
+):
+    """Estimates the relative cost of the local step per customer.
+
+    Per sub-iteration, the q(z) update of a basket is linear in its number of
+    unique products times M (repeated purchases of a product share q(z)), and
+    the q(alpha) update of a basket is quadratic in M. The q(kappa) update per
+    customer is quadratic in M, as its covariance is computed once per
+    iteration (see model.functions.calc_cov_q_kappa). The unit of the cost is
+    arbitrary; only the relative cost between customers is meaningful.
+    """
+
+    n_per_customer = np.asarray(
+        model.data.unique_purchases_per_customer(data),
+        dtype=float,
+    )
+    dim_b = np.asarray(data.dim_b, dtype=float)
+
+    return n_q_i_steps * (
+        n_per_customer * M
+        +
+        dim_b * M**2
+        +
+        M**2
+    )
+
+
+def _summarize(values):
+    # Summary statistics and a histogram with power-of-two bin edges
+    values = np.asarray(values, dtype=float)
+    mean = np.mean(values)
+    std = np.std(values)
+    skewness = np.mean((values - mean)**3) / std**3 if std > 0 else 0.0
+
+    upper = int(np.ceil(np.log2(max(np.max(values), 1.0)))) + 1
+    edges = np.concatenate(([0.0], 2.0**np.arange(upper + 1)))
+    counts, _ = np.histogram(values, bins=edges)
+
+    return {
+        'count': int(len(values)),
+        'sum': float(np.sum(values)),
+        'mean': float(mean),
+        'std': float(std),
+        'skewness': float(skewness),
+        'min': float(np.min(values)),
+        'percentiles': {
+            str(p): float(v)
+            for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))
+        },
+        'max': float(np.max(values)),
+        'histogram': {
+            'edges': edges.tolist(),
+            'counts': counts.tolist(),
+        },
+    }
+
+
+def _concentration(counts):
+    # Gini coefficient and the share of the total covered by the largest items
+    counts = np.sort(np.asarray(counts, dtype=float))[::-1]
+    n = len(counts)
+    cumulative_share = np.cumsum(counts) / np.sum(counts)
+
+    # Gini coefficient of the counts sorted in ascending order
+    ranks = np.arange(1, n + 1)
+    gini = float(
+        np.sum((2 * ranks - n - 1) * counts[::-1]) / (n * np.sum(counts))
+    )
+
+    return {
+        'gini': gini,
+        'share_of_top': {
+            str(p): float(cumulative_share[max(int(np.ceil(n * p / 100)), 1) - 1])
+            for p in (0.1, 1, 10)
+        },
+        'items_covering': {
+            str(p): int(np.searchsorted(cumulative_share, p / 100) + 1)
+            for p in (50, 90, 99)
+        },
+    }
+
+
+def _thread_balance(cost, n_chunks_per_thread):
+    # Load balance of the local step, when the customers are divided into
+    # chunks per thread as in the local step (see
+    # model.scheduling.assign_chunks)
+    total = np.sum(cost)
+
+    balance = {}
+    for n_threads in THREAD_COUNTS:
+        if n_threads > len(cost):
+            break
+        chunks = model.scheduling.assign_chunks(
+            customers=np.arange(len(cost)),
+            cost=cost,
+            n_threads=n_threads,
+            n_chunks_per_thread=n_chunks_per_thread,
+        )
+        chunk_cost, chunk_thread = chunks[3], chunks[4]
+        thread_cost = np.bincount(
+            chunk_thread,
+            weights=chunk_cost,
+            minlength=n_threads,
+        )
+        makespan = np.max(thread_cost)
+        balance[str(n_threads)] = {
+            'max_thread_cost': float(makespan),
+            'mean_thread_cost': float(total / n_threads),
+            'efficiency': float(total / (n_threads * makespan)),
+            # A single customer cannot be split over threads
+            'max_efficiency': float(
+                min(1.0, total / (n_threads * np.max(cost)))
+            ),
+        }
+    return balance
+
+
+def _state_bytes(data, M):
+    # Estimated size of the largest arrays of the variational state
+    float_bytes = np.dtype(float).itemsize
+    return {
+        'per_purchase': float_bytes * data.total_unique_purchases * (M + 1),
+        'per_basket': float_bytes * data.total_baskets * (5 * M + 4),
+        'per_customer': float_bytes * data.dim_i * (M**2 + 2 * M + 1),
+        'per_product': float_bytes * data.dim_j * 3 * M,
+    }
+
+
+def profile_dataset(
+        data,
+        M,
+        n_q_i_steps,
+        n_chunks_per_thread,
+):
+    """Computes a profile of a dataset.
+
+    Parameters
+        data: The dataset (model.data.Data).
+        M: Number of motivations, used for the cost and memory estimates.
+        n_q_i_steps: Number of sub-iterations of the local step per customer.
+        n_chunks_per_thread: Number of chunks per thread of the local step,
+            used for the load balance per number of threads.
+    """
+
+    cost = estimate_customer_cost(
+        data=data,
+        M=M,
+        n_q_i_steps=n_q_i_steps,
+    )
+    sorted_cost = np.sort(cost)[::-1]
+
+    data_bytes = model.data.memory_footprint(data)
+    state_bytes = _state_bytes(data, M)
+
+    return {
+        'dimensions': {
+            'total_customers': int(data.total_customers),
+            'total_baskets': int(data.total_baskets),
+            'total_purchases': int(data.total_purchases),
+            'total_unique_purchases': int(data.total_unique_purchases),
+            'dim_j': int(data.dim_j),
+            'dim_x': int(data.dim_x),
+            'dim_h': int(data.dim_h),
+            'M': int(M),
+            'n_q_i_steps': int(n_q_i_steps),
+            'n_chunks_per_thread': int(n_chunks_per_thread),
+        },
+        'baskets_per_customer': _summarize(data.dim_b),
+        'purchases_per_basket': _summarize(data.dim_n),
+        'purchases_per_customer': _summarize(data.n_per_customer),
+        'purchases_per_product': dict(
+            _summarize(data.n_per_product),
+            **_concentration(data.n_per_product)
+        ),
+        'local_step_cost_per_customer': dict(
+            _summarize(cost),
+            max_over_mean=float(sorted_cost[0] / np.mean(cost)),
+            share_of_top_1_percent=float(
+                np.sum(sorted_cost[:max(len(cost) // 100, 1)]) / np.sum(cost)
+            ),
+            thread_balance=_thread_balance(
+                cost=cost,
+                n_chunks_per_thread=n_chunks_per_thread,
+            ),
+        ),
+        'memory_bytes': {
+            'data': data_bytes,
+            'data_total': int(sum(data_bytes.values())),
+            'state_estimate': state_bytes,
+            'state_estimate_total': int(sum(state_bytes.values())),
+        },
+    }
+
+
+def write_profile(
+        profile,
+        json_file,
+):
+    """Writes a profile to a JSON file."""
+
+    with open(json_file, 'w') as f:
+        json.dump(profile, f, indent=4)
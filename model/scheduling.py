@@ -0,0 +1,446 @@
+"""
+Description:
+    Contains the schedule of the customers over the threads in the local step
+    (model.functions.update_q_local), and of the purchases over the threads in
+    the computation of ev_q_counts_phi that follows it.
+
+    numba.prange splits its range into equally sized contiguous blocks, one
+    per thread. As the cost of a customer is proportional to its number of
+    baskets and purchases, which is heavily skewed, looping over the customers
+    in ID order leaves most threads idle at the end of the local step.
+    Instead, the customers are divided into chunks with an (estimated) equal
+    cost, using the longest-processing-time-first rule, and each thread loops
+    over a contiguous block of chunks.
+
+    In the active-set mode, customers whose local ELBO gain was small are
+    skipped, and the chunks are divided again over the remaining (active)
+    customers in each iteration.
+
+    ev_q_counts_phi is either summed per thread into a J x M buffer over a
+    contiguous block of purchases, or, if it should not depend on the number
+    of threads, per product in the order of the purchases.
+
+Functions:
+    create_schedule: divides the customers into chunks with an equal
+    estimated cost.
+
+    create_shards: divides the customers into shards with an equal estimated
+    cost, one per worker process.
+
+    assign_chunks: divides customers into chunks with an equal estimated
+    cost, and assigns the chunks to the threads.
+
+    restrict_schedule: divides only the active customers into chunks with an
+    equal estimated cost.
+
+    calc_global_shift: computes the shift of the global parameters used in
+    the local step, in total and per customer.
+
+    select_active_customers: selects the customers to update in the next
+    local step (active-set mode).
+
+    report_schedule: prints the estimated efficiency of a schedule, and the
+    measured busy time per thread of a local step.
+"""
+
+# Standard library modules
+from collections import namedtuple
+import heapq
+
+# External modules
+import numba
+import numpy as np
+
+# Own modules
+import model.profiling
+
+
+Schedule = namedtuple(
+    typename='Schedule',
+    field_names=[
+        # The customers ordered per chunk
+        'customers',
+        # The customers of chunk c are customers[chunk_lb[c]:chunk_ub[c]]
+        'chunk_lb',
+        'chunk_ub',
+        # The estimated cost per chunk, and the thread of each chunk
+        'chunk_cost',
+        'chunk_thread',
+        # The chunks of thread t are thread_chunk_lb[t]:thread_chunk_ub[t]
+        'thread_chunk_lb',
+        'thread_chunk_ub',
+        'n_threads',
+        'n_chunks_per_thread',
+        # The estimated cost per customer
+        'customer_cost',
+        # The purchases of product j are
+        # purchases_by_product[product_lb[j]:product_ub[j]], or None if
+        # ev_q_counts_phi is summed per block of purchases
+        'purchases_by_product',
+        'product_lb',
+        'product_ub',
+    ]
+)
+
+
+def create_schedule(
+        data,
+        M,
+        n_q_i_steps,
+        n_chunks_per_thread,
+        deterministic_counts_phi,
+        n_threads=None,
+):
+    """Divides the customers into chunks with an equal estimated cost.
+
+    Each customer, in order of decreasing cost, is assigned to the chunk with
+    the lowest total cost so far (longest-processing-time-first). Within a
+    chunk, the customers are in ID order, such that the baskets of a chunk are
+    read in memory order.
+
+    Parameters
+        data: The dataset (model.data.Data).
+        M: Number of motivations.
+        n_q_i_steps: Number of sub-iterations of the local step per customer.
+        n_chunks_per_thread: Number of chunks per thread.
+        deterministic_counts_phi: Whether ev_q_counts_phi is summed per
+            product in the order of the purchases, which does not depend on
+            the number of threads, instead of per block of purchases.
+        n_threads: Number of threads, numba.get_num_threads() by default.
+    """
+
+    if n_threads is None:
+        n_threads = numba.get_num_threads()
+
+    cost = model.profiling.estimate_customer_cost(
+        data=data,
+        M=M,
+        n_q_i_steps=n_q_i_steps,
+    )
+
+    (
+        customers,
+        chunk_lb,
+        chunk_ub,
+        chunk_cost,
+        chunk_thread,
+        thread_chunk_lb,
+        thread_chunk_ub,
+    ) = assign_chunks(
+        customers=np.arange(data.dim_i),
+        cost=cost,
+        n_threads=n_threads,
+        n_chunks_per_thread=n_chunks_per_thread,
+    )
+
+    purchases_by_product = None
+    product_lb = None
+    product_ub = None
+    if deterministic_counts_phi:
+        purchases_by_product = np.argsort(data.y_unique, kind='stable')
+        n_per_product = np.bincount(data.y_unique, minlength=data.dim_j)
+        product_ub = np.cumsum(n_per_product)
+        product_lb = product_ub - n_per_product
+
+    return Schedule(
+        customers=customers,
+        chunk_lb=chunk_lb,
+        chunk_ub=chunk_ub,
+        chunk_cost=chunk_cost,
+        chunk_thread=chunk_thread,
+        thread_chunk_lb=thread_chunk_lb,
+        thread_chunk_ub=thread_chunk_ub,
+        n_threads=n_threads,
+        n_chunks_per_thread=n_chunks_per_thread,
+        customer_cost=cost,
+        purchases_by_product=purchases_by_product,
+        product_lb=product_lb,
+        product_ub=product_ub,
+    )
+
+
+def create_shards(
+        data,
+        M,
+        n_q_i_steps,
+        n_shards,
+):
+    """Divides the customers into n_shards shards with an equal estimated
+    cost, e.g. one per worker process in the distributed mode (see
+    model.distributed), with the same rule as the chunks of create_schedule.
+
+    Returns a list of arrays with the sorted IDs of the customers per shard.
+    """
+
+    cost = model.profiling.estimate_customer_cost(
+        data=data,
+        M=M,
+        n_q_i_steps=n_q_i_steps,
+    )
+
+    customers, chunk_lb, chunk_ub, *_ = assign_chunks(
+        customers=np.arange(data.dim_i),
+        cost=cost,
+        n_threads=n_shards,
+        n_chunks_per_thread=1,
+    )
+
+    return [customers[lb:ub] for lb, ub in zip(chunk_lb, chunk_ub)]
+
+
+def assign_chunks(
+        customers,
+        cost,
+        n_threads,
+        n_chunks_per_thread,
+):
+    """Divides the customers into n_threads * n_chunks_per_thread chunks
+    (at most one per customer) with the longest-processing-time-first rule,
+    and assigns contiguous blocks of chunks to the threads.
+
+    Parameters
+        customers: The IDs of the customers to divide.
+        cost: The estimated cost per customer, of all customers.
+        n_threads: Number of threads.
+        n_chunks_per_thread: Number of chunks per thread.
+
+    Returns the customers ordered per chunk, the bounds of the chunks in it,
+    the cost and the thread per chunk, and the bounds of the chunks per
+    thread (see Schedule).
+    """
+
+    # Longest-processing-time-first assignment of customers to chunks
+    n_chunks = max(min(n_threads * n_chunks_per_thread, len(customers)), 1)
+    chunk_of_customer = np.empty(len(customers), dtype=np.int64)
+    heap = [(0.0, c) for c in range(n_chunks)]
+    for k in np.argsort(-cost[customers], kind='stable'):
+        chunk_cost_c, c = heapq.heappop(heap)
+        chunk_of_customer[k] = c
+        heapq.heappush(heap, (chunk_cost_c + cost[customers[k]], c))
+
+    # Customers grouped per chunk, in ID order within a chunk
+    order = np.argsort(chunk_of_customer, kind='stable')
+    n_per_chunk = np.bincount(chunk_of_customer, minlength=n_chunks)
+    chunk_ub = np.cumsum(n_per_chunk)
+    chunk_lb = chunk_ub - n_per_chunk
+    chunk_cost = np.bincount(
+        chunk_of_customer,
+        weights=cost[customers],
+        minlength=n_chunks,
+    )
+
+    # Contiguous blocks of chunks per thread
+    thread_bounds = np.linspace(0, n_chunks, n_threads + 1).astype(np.int64)
+    chunk_thread = np.repeat(np.arange(n_threads), np.diff(thread_bounds))
+
+    return (
+        customers[order],
+        chunk_lb,
+        chunk_ub,
+        chunk_cost,
+        chunk_thread,
+        thread_bounds[:-1],
+        thread_bounds[1:],
+    )
+
+
+def restrict_schedule(
+        schedule,
+        is_active,
+):
+    """Divides only the active customers into chunks with an equal estimated
+    cost.
+
+    Parameters
+        schedule: The schedule of all customers (see create_schedule).
+        is_active: Boolean array, whether a customer is updated.
+    """
+
+    (
+        customers,
+        chunk_lb,
+        chunk_ub,
+        chunk_cost,
+        chunk_thread,
+        thread_chunk_lb,
+        thread_chunk_ub,
+    ) = assign_chunks(
+        customers=np.flatnonzero(is_active),
+        cost=schedule.customer_cost,
+        n_threads=schedule.n_threads,
+        n_chunks_per_thread=schedule.n_chunks_per_thread,
+    )
+
+    return schedule._replace(
+        customers=customers,
+        chunk_lb=chunk_lb,
+        chunk_ub=chunk_ub,
+        chunk_cost=chunk_cost,
+        chunk_thread=chunk_thread,
+        thread_chunk_lb=thread_chunk_lb,
+        thread_chunk_ub=thread_chunk_ub,
+    )
+
+
+# The global parameters that enter the local step
+GLOBAL_PARAMETERS = [
+    'log_phi',
+    'tau_alpha',
+    'mu_kappa',
+    'lambda_kappa',
+    'beta',
+    'gamma',
+    'rho',
+    'delta',
+    'delta_kappa',
+    'delta_beta',
+    'delta_gamma',
+]
+
+
+def _softmax_rows(a):
+    """Returns the softmax of each row of a."""
+
+    e = np.exp(a - np.max(a, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
+
+
+def calc_global_shift(
+        previous_global_parameters,
+        q,
+        data,
+):
+    """Computes the shift of the global parameters used in the local step,
+    in total and per customer.
+
+    The shift of a global parameter other than log_phi is its root mean
+    square change, relative to its root mean square value (or 1, if that is
+    smaller), and the global shift is the largest of these. q(z_ibn) of a
+    purchase of product j depends on log_phi[j] through its softmax over m,
+    such that the shift of log_phi[j] is the total variation distance between
+    the softmax before and after the global step (a change of log_phi[j, m]
+    for a motivation m with a negligible phi_jm does not change q(z_ibn)). A
+    customer only depends on the rows of log_phi of the products it bought,
+    and its shift is the largest shift of these rows.
+
+    Parameters
+        previous_global_parameters: Dictionary with copies of the global
+            parameters in GLOBAL_PARAMETERS before the global step.
+        q: The variational state after the global step.
+        data: The data.
+
+    Returns
+        global_shift: The largest shift of the global parameters other than
+            log_phi.
+        customer_shift: The shift of log_phi per customer.
+    """
+
+    global_shift = 0.0
+    for name, previous in previous_global_parameters.items():
+        if name == 'log_phi':
+            continue
+        change = np.asarray(getattr(q, name)) - previous
+        global_shift = max(
+            global_shift,
+            np.sqrt(np.mean(change**2)) / max(np.sqrt(np.mean(previous**2)), 1.0),
+        )
+
+    product_shift = 0.5 * np.sum(np.abs(
+        _softmax_rows(q.log_phi)
+        - _softmax_rows(previous_global_parameters['log_phi'])
+    ), axis=1)
+    customer_shift = np.maximum.reduceat(
+        product_shift[data.y_unique],
+        np.asarray(data.ib_to_iu_lb)[data.i_to_ib_lb],
+    )
+
+    return global_shift, customer_shift
+
+
+def select_active_customers(
+        is_active,
+        n_skipped,
+        elbo_gain_q_i,
+        n,
+        global_shift,
+        customer_shift,
+        vi_settings,
+):
+    """Selects the customers to update in local step n (active-set mode).
+
+    A customer is skipped if its local ELBO gain at its last update is at most
+    active_set_tol, until it has been skipped for active_set_revisit
+    iterations, or until the rows of log_phi of its products shift by more
+    than active_set_shift_tol. All customers are updated in the first
+    iteration, in every active_set_full_sweep-th iteration, and after a global
+    step that shifted a global parameter other than log_phi by more than
+    active_set_shift_tol (see calc_global_shift).
+
+    Parameters
+        is_active: Boolean array, updated in place.
+        n_skipped: Number of consecutive skipped iterations per customer,
+            updated in place.
+        elbo_gain_q_i: The local ELBO gain per customer at its last update.
+        n: The iteration number.
+        global_shift: The shift of the global parameters other than log_phi
+            in the previous iteration.
+        customer_shift: The shift of log_phi per customer in the previous
+            iteration.
+        vi_settings: The VI settings.
+    """
+
+    full_sweep = (
+        (vi_settings.active_set_tol <= 0.0)
+        or (n % vi_settings.active_set_full_sweep == 0)
+        or (global_shift > vi_settings.active_set_shift_tol)
+    )
+
+    if full_sweep:
+        is_active[:] = True
+    else:
+        is_active[:] = (
+            (elbo_gain_q_i > vi_settings.active_set_tol)
+            | (n_skipped >= vi_settings.active_set_revisit)
+            | (customer_shift > vi_settings.active_set_shift_tol)
+        )
+
+    n_skipped[is_active] = 0
+    n_skipped[~is_active] += 1
+
+    return full_sweep
+
+
+def report_schedule(
+        schedule,
+        local_step_time=None,
+        thread_busy_time=None,
+):
+    """Prints the estimated efficiency of a schedule, and the measured busy
+    time per thread of a local step.
+
+    The estimated efficiency follows from the cost of the chunks of each
+    thread. The measured busy time of a thread is the time it spent in its
+    chunks (see model.functions.update_q_local), and the idle fraction is the
+    share of the thread time of the local step that the threads were not busy.
+    """
+
+    thread_cost = np.bincount(
+        schedule.chunk_thread,
+        weights=schedule.chunk_cost,
+        minlength=schedule.n_threads,
+    )
+    busy_fraction = thread_cost / max(np.max(thread_cost), 1.0)
+
+    print('Local step: {} chunks over {} threads, estimated efficiency {:.1f}%'.format(
+        len(schedule.chunk_cost),
+        schedule.n_threads,
+        100 * np.mean(busy_fraction),
+    ))
+    if local_step_time is not None and thread_busy_time is not None:
+        idle_fraction = 1.0 - np.sum(thread_busy_time) / max(
+            len(thread_busy_time) * local_step_time, 1e-12)
+        print('Local step time: {:.2f}s, measured busy time per thread: {}, idle {:.1f}%'.format(
+            local_step_time,
+            ' '.join('{:.2f}s'.format(busy_time) for busy_time in thread_busy_time),
+            100 * idle_fraction,
+        ))
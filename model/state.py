@@ -6,6 +6,14 @@ Functions:
     create_state: initializes a variational state, based on the state's stub,
     data, prior, and fixed model parameters.
 
+    interleave_basket_state: stores the per-basket fields of a variational
+    state in one array, with the fields of a basket contiguous.
+
+    subset_state: returns the variational state of a subset of the customers.
+
+    update_from_subset_state: copies the local fields of the state of a
+    subset of the customers back into a variational state.
+
     check_state: checks the consistency of a variational state
 """
 
@@ -153,7 +161,7 @@ def create_state(
     if is_fixed.z:
         ev_q_counts_basket = fixed_values.counts_basket
         ev_q_counts_phi = fixed_values.counts_phi
-        entropy_q_z = np.zeros(data.total_purchases)
+        entropy_q_z = np.zeros(data.total_unique_purchases)
     else:
         ev_q_counts_basket = state_stub.ev_q_counts_basket
         ev_q_counts_phi = state_stub.ev_q_counts_phi
@@ -547,6 +555,117 @@ def create_state(
     return q
 
 
+# The per-basket fields of the state that are updated in the local step, in
+# the order of their columns in the interleaved layout
+BASKET_FIELDS = (
+    'mu_q_alpha',
+    'sigma_sq_q_alpha',
+    'alpha_sq',
+    'eps_alpha',
+    'counts_basket',
+    'log_theta_denom_approx',
+    'entropy_q_alpha',
+    'ss_mu_q_alpha',
+    'ss_log_sigma_q_alpha',
+)
+
+
+def interleave_basket_state(q):
+    """Returns the state q with the fields in BASKET_FIELDS stored in one
+    B x (5M + 4) array, such that the fields of a basket are contiguous in
+    memory, as they are read and written together in the local step.
+
+    The fields of the returned state are strided views into this array (B x M
+    or B), so they are used as before. Fields should only be updated in place,
+    as an assigned array would no longer be part of the interleaved array.
+    """
+
+    widths = [
+        1 if getattr(q, name).ndim == 1 else getattr(q, name).shape[1]
+        for name in BASKET_FIELDS
+    ]
+    records = np.empty((len(q.mu_q_alpha), sum(widths)))
+
+    views = {}
+    lb = 0
+    for name, width in zip(BASKET_FIELDS, widths):
+        field = getattr(q, name)
+        if field.ndim == 1:
+            views[name] = records[:, lb]
+        else:
+            views[name] = records[:, lb:lb + width]
+        views[name][...] = field
+        lb += width
+
+    return q._replace(**views)
+
+
+# The per-customer fields of the state that are updated in the local step
+CUSTOMER_FIELDS = (
+    'kappa',
+    'kappa_sq',
+    'kappa_outer',
+    'entropy_q_kappa',
+)
+
+
+# The per-purchase fields of the state (per entry of y_unique)
+PURCHASE_FIELDS = (
+    'entropy_q_z',
+)
+
+
+def subset_state(
+        q,
+        customers,
+        baskets,
+        unique_purchases,
+):
+    """Returns the state of a subset of the customers, for the dataset
+    returned by model.data.subset_dataset (with its baskets and
+    unique_purchases).
+
+    The fields in CUSTOMER_FIELDS, BASKET_FIELDS and PURCHASE_FIELDS are
+    copies, and counts_phi and sum_ib_eps_alpha_sq, which are sums over the
+    customers, are zero. All other (global) fields are shared with q, such
+    that a global step on the returned state updates q.
+    """
+
+    local_fields = {}
+    for name in CUSTOMER_FIELDS:
+        local_fields[name] = getattr(q, name)[customers]
+    for name in BASKET_FIELDS:
+        local_fields[name] = getattr(q, name)[baskets]
+    for name in PURCHASE_FIELDS:
+        local_fields[name] = getattr(q, name)[unique_purchases]
+
+    return q._replace(
+        counts_phi=np.zeros_like(q.counts_phi),
+        sum_ib_eps_alpha_sq=np.zeros_like(q.sum_ib_eps_alpha_sq),
+        **local_fields
+    )
+
+
+def update_from_subset_state(
+        q,
+        q_subset,
+        customers,
+        baskets,
+        unique_purchases,
+):
+    """Copies the fields in CUSTOMER_FIELDS, BASKET_FIELDS and
+    PURCHASE_FIELDS of the state of a subset of the customers (see
+    subset_state) back into q, in place.
+    """
+
+    for name in CUSTOMER_FIELDS:
+        getattr(q, name)[customers] = getattr(q_subset, name)
+    for name in BASKET_FIELDS:
+        getattr(q, name)[baskets] = getattr(q_subset, name)
+    for name in PURCHASE_FIELDS:
+        getattr(q, name)[unique_purchases] = getattr(q_subset, name)
+
+
 def check_ev_q_eps_alpha(
         q,
         data,
@@ -630,7 +749,7 @@ def check_state(
     # z
     assert q.counts_basket.shape == (data.total_baskets, M)
     assert q.counts_phi.shape == (data.dim_j, M)
-    assert q.entropy_q_z.shape == (data.total_purchases,)
+    assert q.entropy_q_z.shape == (data.total_unique_purchases,)
 
     assert np.isclose(np.sum(q.counts_basket), data.total_purchases)
     assert np.allclose(np.sum(q.counts_basket, 1), data.dim_n)
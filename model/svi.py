@@ -0,0 +1,165 @@
+"""
+Description:
+    Contains the stochastic variational inference (SVI) mode of the
+    optimization routine for the ULSDPB model.
+
+    In the SVI mode, an iteration updates q(z), q(alpha) and q(kappa) of a
+    mini-batch of customers only. The global step computes the update of
+    each global parameter from the mini-batch, with the sufficient statistics
+    scaled from the mini-batch to all customers, and takes a Robbins-Monro
+    step from the current natural parameters towards it.
+
+Functions:
+    create_batches: divides the customers in random mini-batches, for a pass
+    over all customers.
+
+    calc_step_size: returns the Robbins-Monro step size of an iteration.
+
+    blend_global_parameter: takes a step from the previous natural
+    parameters of a global parameter towards its update from a mini-batch.
+"""
+
+# External modules
+import numpy as np
+
+# Own modules
+from expfam import dirichlet
+from expfam import gamma_v
+from expfam import mvn
+from expfam import normal_v
+from expfam import wishart
+
+
+# The fields with the variational expectations of the global parameters
+# whose q(.) is a (vector of) normal distribution(s)
+NORMAL_V_FIELDS = {
+    'delta': ('delta', 'delta_sq', 'negative_kl_q_p_delta'),
+    'delta_kappa': (
+        'delta_kappa', 'delta_kappa_sq', 'negative_kl_q_p_delta_kappa'),
+    'delta_beta': ('delta_beta', 'delta_beta_sq', 'negative_kl_q_p_delta_beta'),
+    'delta_gamma': (
+        'delta_gamma', 'delta_gamma_sq', 'negative_kl_q_p_delta_gamma'),
+}
+
+
+def create_batches(
+        rng,
+        dim_i,
+        batch_size,
+):
+    """Divides the customers in random mini-batches of (almost) batch_size
+    customers, for a pass over all customers.
+
+    Returns a list of arrays with the sorted IDs of the customers per
+    mini-batch.
+    """
+
+    n_batches = max(int(np.ceil(dim_i / batch_size)), 1)
+    return [
+        np.sort(customers)
+        for customers in np.array_split(rng.permutation(dim_i), n_batches)
+    ]
+
+
+def calc_step_size(
+        n,
+        step_delay,
+        step_forgetting,
+):
+    """Returns the Robbins-Monro step size (n + step_delay)^-step_forgetting
+    of iteration n.
+
+    With step_delay >= 1 the step size is at most 1. The step sizes satisfy
+    the Robbins-Monro conditions for 0.5 < step_forgetting <= 1, and
+    step_forgetting = 0 gives a constant step size of 1.
+    """
+
+    return (n + step_delay) ** -step_forgetting
+
+
+def _assign(array, value):
+    # Assigns in place, also to the ()-arrays of the scalar parameters
+    array[...] = np.reshape(value, np.shape(array))
+
+
+def blend_global_parameter(
+        q,
+        name,
+        eta_previous,
+        prior,
+        step_size,
+        scale,
+):
+    """Takes a step from the previous natural parameters of a global
+    parameter towards its update from a mini-batch, and updates its
+    variational expectations and negative KL divergence in q.
+
+    Parameters
+        q: The state, in which q.eta_q_<name> is the update of the global
+            parameter from the mini-batch (see
+            model.optimization.global_step).
+        name: The name of the global parameter, e.g. 'beta'.
+        eta_previous: The natural parameters before the update.
+        prior: The prior, with the natural parameters <name>_eta.
+        step_size: The step size, in (0, 1].
+        scale: The number of customers divided by the number of customers
+            in the mini-batch.
+
+    The natural parameters of the update are the prior plus sufficient
+    statistics that are sums over the customers, which are multiplied by
+    scale.
+    """
+
+    eta_q = getattr(q, 'eta_q_' + name)
+    prior_eta = getattr(prior, name + '_eta')
+    eta_q[:] = (
+        (1.0 - step_size) * eta_previous
+        + step_size * (prior_eta + scale * (eta_q - prior_eta))
+    )
+
+    if name == 'phi':
+        for m in range(eta_q.shape[1]):
+            q.log_phi[:, m] = dirichlet.ev_t(eta=eta_q[:, m])
+            q.negative_kl_q_p_phi[m] = -dirichlet.kl_divergence(
+                eta_q=eta_q[:, m],
+                eta_p=prior_eta[:, m],
+            )
+    elif name in ('beta', 'gamma', 'rho'):
+        for m in range(eta_q.shape[0]):
+            getattr(q, name)[m] = mvn.ev_x(eta=eta_q[m])
+            getattr(q, name + '_outer')[m] = mvn.ev_outer_x(eta=eta_q[m])
+            getattr(q, 'negative_kl_q_p_' + name)[m] = -mvn.kl_divergence(
+                eta_q=eta_q[m],
+                eta_p=prior_eta,
+            )
+    elif name in NORMAL_V_FIELDS:
+        ev_x, ev_x_sq, negative_kl = NORMAL_V_FIELDS[name]
+        _assign(getattr(q, ev_x), normal_v.ev_x(eta=eta_q))
+        _assign(getattr(q, ev_x_sq), normal_v.ev_x_sq(eta=eta_q))
+        _assign(
+            getattr(q, negative_kl),
+            -normal_v.kl_divergence(eta_q=eta_q, eta_p=prior_eta),
+        )
+    elif name == 'tau_alpha':
+        q.tau_alpha[:] = gamma_v.ev_x(eta=eta_q)
+        q.log_tau_alpha[:] = gamma_v.ev_log_x(eta=eta_q)
+        _assign(
+            q.negative_kl_q_p_tau_alpha,
+            -gamma_v.kl_divergence(eta_q=eta_q, eta_p=prior_eta),
+        )
+    elif name == 'mu_kappa':
+        q.mu_kappa[:] = mvn.ev_x(eta=eta_q)
+        q.mu_kappa_outer[:] = mvn.ev_outer_x(eta=eta_q)
+        _assign(
+            q.negative_kl_q_p_mu_kappa,
+            -mvn.kl_divergence(eta_q=eta_q, eta_p=prior_eta),
+        )
+    elif name == 'lambda_kappa':
+        q.lambda_kappa[:] = wishart.ev_x(eta=eta_q)
+        _assign(q.log_det_lambda_kappa, wishart.ev_log_det_x(eta=eta_q))
+        _assign(
+            q.negative_kl_q_p_lambda_kappa,
+            -wishart.kl_divergence(eta_q=eta_q, eta_p=prior_eta),
+        )
+    else:
+        raise ValueError('Unknown global parameter: {}'.format(name))
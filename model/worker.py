@@ -0,0 +1,437 @@
+"""
+Description:
+    Contains the worker process of the distributed mode of the optimization
+    routine for the ULSDPB model (see model.distributed).
+
+    A worker runs the local step of its shard of the customers, and returns
+    the sums over its shard that the global step of the coordinator needs.
+    The workers on this machine are started by the coordinator. A worker on
+    another machine, with the same code, settings.py and saved dataset (at
+    the same path, e.g. on a shared file system), is started with
+        python -m model.worker -ADDRESS host:port
+    with the authentication key that the coordinator prints in the
+    environment variable model.distributed.AUTHKEY_ENV, or entered at the
+    prompt if it is not set.
+
+    ev_q_eps_alpha is kept up to date as in model.optimization.global_step:
+    before the sufficient statistics of a global parameter are computed, the
+    term of the parameter is added to ev_q_eps_alpha, and the term of the
+    updated parameter is subtracted again when the coordinator sends it with
+    the next request.
+
+Functions:
+    serve: handles the requests of the coordinator until it stops.
+
+    add_eps_alpha_term: adds or subtracts the term of a global parameter in
+    ev_q_eps_alpha.
+
+    calc_sufficient_statistics: computes the sufficient statistics of a
+    global parameter.
+"""
+
+# Standard library modules
+from collections import namedtuple
+import argparse
+import getpass
+import multiprocessing.connection
+import os
+import sys
+import traceback
+
+# External modules
+import numpy as np
+
+# Own modules
+import model.data
+import model.distributed
+import model.elbo
+import model.functions
+import model.optimization
+import model.scheduling
+import model.state
+
+
+def serve(connection):
+    """Handles the requests of the coordinator, until it sends 'stop' or the
+    connection is closed. A request is a command and a dict with its
+    arguments, and every request is answered with ('ok', reply) or
+    ('error', traceback).
+    """
+
+    shard = None
+    while True:
+        try:
+            command, kwargs = connection.recv()
+        except EOFError:
+            break
+
+        if command == 'stop':
+            connection.send(('ok', None))
+            break
+
+        try:
+            if command == 'setup':
+                shard = setup(**kwargs)
+                reply = None
+            else:
+                reply = HANDLERS[command](shard=shard, **kwargs)
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+            continue
+
+        connection.send(('ok', reply))
+
+    connection.close()
+
+
+def setup(
+        dataset_folder,
+        customers,
+        q,
+        prior,
+        is_fixed,
+        vi_settings,
+        misc_settings,
+        M,
+):
+    # The shard of the dataset, the rest of the memory-mapped dataset is not
+    # read
+    data, _, _ = model.data.subset_dataset(
+        data=model.data.load_dataset(folder=dataset_folder),
+        customers=customers,
+    )
+
+    vi_settings = namedtuple('SettingsVI', vi_settings)(**vi_settings)
+    misc_settings = namedtuple('SettingsMisc', misc_settings)(**misc_settings)
+
+    if misc_settings.interleave_basket_state:
+        q = model.state.interleave_basket_state(q)
+
+    schedule = model.scheduling.create_schedule(
+        data=data,
+        M=M,
+        n_q_i_steps=vi_settings.n_q_i_steps,
+        n_chunks_per_thread=misc_settings.n_chunks_per_thread,
+        deterministic_counts_phi=misc_settings.deterministic_counts_phi,
+    )
+
+    # q(z) of the purchases of the shard, as in model.optimization.routine
+    local_dtype = np.dtype(misc_settings.local_precision)
+    if misc_settings.stream_q_z:
+        n_rows_thread = np.max(model.data.unique_purchases_per_customer(data))
+        theta_q_z = np.empty(
+            (schedule.n_threads * n_rows_thread, M),
+            dtype=local_dtype,
+        )
+        counts_phi_thread = np.zeros((schedule.n_threads, data.dim_j, M))
+    else:
+        theta_q_z = np.empty((data.total_unique_purchases, M), dtype=local_dtype)
+        counts_phi_thread = np.zeros((0, data.dim_j, M))
+
+    return {
+        'data': data,
+        'q': q,
+        'theta_q_z': theta_q_z,
+        'counts_phi_thread': counts_phi_thread,
+        'tallies': model.optimization.create_tallies(data=data),
+        'schedule': schedule,
+        'prior': prior,
+        'is_fixed': is_fixed,
+        'vi_settings': vi_settings,
+        'misc_settings': misc_settings,
+        'M': M,
+        # The global parameter whose term was added to ev_q_eps_alpha
+        'pending': None,
+    }
+
+
+def _update_global_fields(
+        shard,
+        global_fields,
+):
+    # The global parameters updated by the coordinator, after which the term
+    # of the pending parameter is subtracted from ev_q_eps_alpha again
+    q = shard['q']
+    for field, value in global_fields.items():
+        getattr(q, field)[...] = value
+
+    if shard['pending'] is not None:
+        add_eps_alpha_term(
+            name=shard['pending'],
+            q=q,
+            data=shard['data'],
+            sign=-1.0,
+        )
+        shard['pending'] = None
+
+
+def local_step(
+        shard,
+        global_fields,
+        return_tallies,
+):
+    _update_global_fields(
+        shard=shard,
+        global_fields=global_fields,
+    )
+
+    tallies = shard['tallies']
+    tallies['updated_both'][:] = 0
+    tallies['updated_mu_q'][:] = 0
+    tallies['updated_sigma_sq_q'][:] = 0
+
+    model.optimization.local_step(
+        q=shard['q'],
+        theta_q_z=shard['theta_q_z'],
+        counts_phi_thread=shard['counts_phi_thread'],
+        stream_q_z=shard['misc_settings'].stream_q_z,
+        tallies=tallies,
+        schedule=shard['schedule'],
+        data=shard['data'],
+        is_fixed=shard['is_fixed'],
+        vi_settings=shard['vi_settings'],
+        M=shard['M'],
+    )
+
+    return {
+        'counts_phi': shard['q'].counts_phi,
+        'local_step_time': tallies['local_step_time'],
+        'tallies': tallies if return_tallies else None,
+    }
+
+
+def statistics(
+        shard,
+        name,
+        global_fields,
+):
+    _update_global_fields(
+        shard=shard,
+        global_fields=global_fields,
+    )
+
+    q = shard['q']
+    data = shard['data']
+
+    # ev_q_eps_alpha for the current global parameters, and its sum of squares
+    if name == 'eps_alpha':
+        model.optimization.update_eps_alpha(
+            q=q,
+            data=data,
+            M=shard['M'],
+        )
+        return q.sum_ib_eps_alpha_sq
+
+    if name == 'kappa':
+        return np.sum(q.kappa, axis=0), np.sum(q.kappa_outer, axis=0)
+
+    add_eps_alpha_term(
+        name=name,
+        q=q,
+        data=data,
+        sign=1.0,
+    )
+    shard['pending'] = name
+
+    return calc_sufficient_statistics(
+        name=name,
+        q=q,
+        data=data,
+    )
+
+
+def elbo(
+        shard,
+        global_fields,
+):
+    _update_global_fields(
+        shard=shard,
+        global_fields=global_fields,
+    )
+
+    return model.elbo.calc_elbo_sums(
+        q=shard['q'],
+        n_purchases_per_basket=shard['data'].dim_n,
+    )
+
+
+def gather(
+        shard,
+        return_theta_q_z,
+):
+    theta_q_z = None
+    if return_theta_q_z:
+        theta_q_z = shard['theta_q_z']
+
+    return shard['q'], theta_q_z
+
+
+HANDLERS = {
+    'local_step': local_step,
+    'statistics': statistics,
+    'elbo': elbo,
+    'gather': gather,
+}
+
+
+def add_eps_alpha_term(
+        name,
+        q,
+        data,
+        sign,
+):
+    """Adds (sign = 1) or subtracts (sign = -1) the term of the global
+    parameter name in ev_q_eps_alpha, in place, with the same functions as
+    its update in model.functions.
+    """
+
+    if name == 'beta':
+        model.functions.add_eps_alpha_beta(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_beta=q.beta,
+            ev_q_delta_beta=q.delta_beta,
+            x=data.x,
+            ib_first=data.ib_first,
+            ib_not_first=data.ib_not_first,
+            sign=sign,
+        )
+    elif name == 'gamma':
+        model.functions.add_eps_alpha_gamma(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_gamma=q.gamma,
+            ev_q_delta_gamma=q.delta_gamma,
+            h_per_basket=data.h_per_basket,
+            ib_first=data.ib_first,
+            ib_not_first=data.ib_not_first,
+            sign=sign,
+        )
+    elif name == 'rho':
+        model.functions.add_eps_alpha_rho(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_rho=q.rho,
+            mu_q_alpha=q.mu_q_alpha,
+            ib_not_first=data.ib_not_first,
+            ib_not_last=data.ib_not_last,
+            sign=sign,
+        )
+    elif name == 'delta':
+        model.functions.add_eps_alpha_delta(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_delta=q.delta,
+            ib_first=data.ib_first,
+            sign=sign,
+        )
+    elif name == 'delta_kappa':
+        model.functions.add_eps_alpha_delta_kappa(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_kappa=q.kappa,
+            ev_q_delta_kappa=q.delta_kappa,
+            ib_first=data.ib_first,
+            sign=sign,
+        )
+    elif name == 'delta_beta':
+        model.functions.add_eps_alpha_delta_beta(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_beta=q.beta,
+            ev_q_delta_beta=q.delta_beta,
+            x=data.x,
+            ib_first=data.ib_first,
+            sign=sign,
+        )
+    elif name == 'delta_gamma':
+        model.functions.add_eps_alpha_delta_gamma(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_gamma=q.gamma,
+            ev_q_delta_gamma=q.delta_gamma,
+            h=data.h,
+            ib_first=data.ib_first,
+            sign=sign,
+        )
+    else:
+        raise ValueError('Unknown global parameter: {}'.format(name))
+
+
+def calc_sufficient_statistics(
+        name,
+        q,
+        data,
+):
+    """Returns the sufficient statistics of the global parameter name of the
+    shard, with the term of the parameter added to ev_q_eps_alpha (see
+    add_eps_alpha_term).
+    """
+
+    if name == 'beta':
+        return model.functions.calc_ss_q_beta(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_delta_beta=q.delta_beta,
+            x=data.x,
+            ib_first=data.ib_first,
+            ib_not_first=data.ib_not_first,
+        )
+    if name == 'gamma':
+        return model.functions.calc_ss_q_gamma(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_delta_gamma=q.delta_gamma,
+            h_per_basket=data.h_per_basket,
+            ib_first=data.ib_first,
+            ib_not_first=data.ib_not_first,
+        )
+    if name == 'rho':
+        return model.functions.calc_ss_q_rho(
+            ev_q_eps_alpha=q.eps_alpha,
+            mu_q_alpha=q.mu_q_alpha,
+            sigma_sq_q_alpha=q.sigma_sq_q_alpha,
+            ib_not_first=data.ib_not_first,
+            ib_not_last=data.ib_not_last,
+        )
+    if name == 'delta':
+        return model.functions.calc_ss_q_delta(
+            ev_q_eps_alpha=q.eps_alpha,
+            ib_first=data.ib_first,
+        )
+    if name == 'delta_kappa':
+        return model.functions.calc_ss_q_delta_kappa(
+            ev_q_eps_alpha=q.eps_alpha,
+            ev_q_kappa=q.kappa,
+            ev_q_kappa_sq=q.kappa_sq,
+            ib_first=data.ib_first,
+        )
+    if name == 'delta_beta':
+        return model.functions.calc_ss_q_delta_beta(
+            ev_q_eps_alpha=q.eps_alpha,
+            x=data.x,
+            ib_first=data.ib_first,
+        )
+    if name == 'delta_gamma':
+        return model.functions.calc_ss_q_delta_gamma(
+            ev_q_eps_alpha=q.eps_alpha,
+            h=data.h,
+            ib_first=data.ib_first,
+        )
+    raise ValueError('Unknown global parameter: {}'.format(name))
+
+
+if __name__ == '__main__':
+
+    # Numpy settings, as in estimate.py
+    np.seterr(divide='raise', over='raise', under='ignore', invalid='raise')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-ADDRESS', type=str)
+    parser_args = parser.parse_args()
+
+    host, port = parser_args.ADDRESS.rsplit(':', 1)
+
+    # The authentication key of the run, from the environment or the prompt
+    authkey = os.environ.get(model.distributed.AUTHKEY_ENV)
+    if not authkey and sys.stdin.isatty():
+        authkey = getpass.getpass('Authentication key: ')
+    if not authkey:
+        sys.exit('The authentication key is missing, set {}'.format(
+            model.distributed.AUTHKEY_ENV))
+
+    serve(multiprocessing.connection.Client(
+        address=(host, int(port)),
+        authkey=bytes.fromhex(authkey.strip()),
+    ))
@@ -0,0 +1,92 @@
+
+# Standard library modules
+import argparse
+import os
+
+# Own modules
+import model.data
+import model.ingest
+import model.profiling
+
+import settings
+
+# Get user arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-MODEL', type=str, default='FULL')
+parser.add_argument('-M', type=int)
+parser.add_argument('-OUTPUT_FILE', type=str)
+parser_args = parser.parse_args()
+
+MODEL = parser_args.MODEL
+M = parser_args.M
+OUTPUT_FILE = parser_args.OUTPUT_FILE
+
+assert MODEL in ['FULL', 'CTM', 'LDA_X'], \
+    'Valid options for MODEL argument are FULL, CTM, or LDA_X'
+assert M >= 2, \
+    'M should be an integer larger than or equal to 2'
+
+EMULATE_LDA_X = MODEL == 'LDA_X'
+
+if OUTPUT_FILE is None:
+    OUTPUT_FILE = os.path.join(
+        settings.OUTPUT_FOLDER,
+        'data_profile_' + ('LDA_X' if EMULATE_LDA_X else 'BASKETS') + '.json',
+    )
+
+# Use the saved dataset of estimate.py, created first if it does not exist
+DATASET_FOLDER = model.ingest.prepare_dataset(
+    y_csv=settings.Y_CSV,
+    x_csv=settings.X_CSV,
+    h_csv=settings.H_CSV,
+    cache_folder=settings.CACHE_FOLDER,
+    datasets_folder=settings.DATASET_FOLDER,
+    index_folder=settings.INDEX_FOLDER,
+    emulate_lda_x=EMULATE_LDA_X,
+    raw_ids=settings.RAW_IDS,
+    out_of_core_index=settings.OUT_OF_CORE_INDEX,
+    compact_data=settings.COMPACT_DATA,
+    float32_regressors=settings.FLOAT32_REGRESSORS,
+)
+data = model.data.load_dataset(folder=DATASET_FOLDER)
+
+profile = model.profiling.profile_dataset(
+    data=data,
+    M=M,
+    n_q_i_steps=settings.VI['n_q_i_steps'],
+    n_chunks_per_thread=settings.MISC['n_chunks_per_thread'],
+)
+
+if not os.path.exists(os.path.dirname(OUTPUT_FILE)):
+    os.makedirs(os.path.dirname(OUTPUT_FILE))
+model.profiling.write_profile(profile=profile, json_file=OUTPUT_FILE)
+
+# Print a short summary
+print('Customers: {}, baskets: {}, purchases: {}, products: {}'.format(
+    profile['dimensions']['total_customers'],
+    profile['dimensions']['total_baskets'],
+    profile['dimensions']['total_purchases'],
+    profile['dimensions']['dim_j'],
+))
+for key in ['baskets_per_customer', 'purchases_per_basket', 'purchases_per_customer']:
+    print('{}: mean {:.1f}, p99 {:.0f}, max {:.0f}'.format(
+        key,
+        profile[key]['mean'],
+        profile[key]['percentiles']['99'],
+        profile[key]['max'],
+    ))
+print('Product frequency Gini coefficient: {:.3f}'.format(
+    profile['purchases_per_product']['gini']))
+
+cost = profile['local_step_cost_per_customer']
+print('Local step cost, max over mean: {:.1f}'.format(cost['max_over_mean']))
+for n_threads, balance in cost['thread_balance'].items():
+    print('    {} threads: efficiency {:.2f} (at most {:.2f})'.format(
+        n_threads, balance['efficiency'], balance['max_efficiency']))
+
+memory = profile['memory_bytes']
+print('Memory: data {:.1f} MB, variational state about {:.1f} MB'.format(
+    memory['data_total'] / 1e6,
+    memory['state_estimate_total'] / 1e6,
+))
+print('Profile written to {}'.format(OUTPUT_FILE))
@@ -9,6 +9,23 @@ Y_CSV = os.path.join(INPUT_FOLDER, "y.csv")
 X_CSV = os.path.join(INPUT_FOLDER, "x.csv")
 H_CSV = os.path.join(INPUT_FOLDER, "h.csv")
 
+# BINARY CACHE OF THE DATA FILES, REBUILT WHEN A CSV FILE CHANGES
+CACHE_FOLDER = os.path.join(INPUT_FOLDER, "cache")
+
+# THE DATA FILES CONTAIN RAW IDS, WHICH ARE MAPPED TO DENSE IDS (SEE README)
+RAW_IDS = False
+
+# STREAM Y_CSV INTO AN INDEX OF DISK-BACKED ARRAYS, FOR DATA LARGER THAN MEMORY
+OUT_OF_CORE_INDEX = False
+INDEX_FOLDER = os.path.join(CACHE_FOLDER, "index")
+
+# SAVED DATASETS, MEMORY-MAPPED AND SHARED BY CONCURRENT RUNS ON THE SAME DATA
+DATASET_FOLDER = os.path.join(CACHE_FOLDER, "datasets")
+
+# COMPACT DATA LAYOUT: 32-BIT IDS AND COUNTS, OPTIONALLY 32-BIT FLOAT REGRESSORS
+COMPACT_DATA = True
+FLOAT32_REGRESSORS = False
+
 # NOTE: INIT_C_JM_FILENAME SHOULD BE PLACED IN OUTPUT_FOLDER/$M
 INIT_C_JM_FILENAME = 'initial_c_jm.csv'
 
@@ -22,6 +39,33 @@ INIT_SS_LOG_SIGMA_Q_ALPHA_IB = 0.125
 VI = {
     # Number of subiterations per customer (denoted by L in the paper)
     'n_q_i_steps': 25,
+    # Stop the subiterations of a customer early, after q_i_patience
+    # consecutive subiterations in which the q(alpha) updates of the customer
+    # increase the ELBO by at most q_i_tol (0 disables stopping early, e.g. 3)
+    'q_i_patience': 0,
+    'q_i_tol': 1e-3,
+    # Active set: skip customers whose local ELBO gain was at most
+    # active_set_tol (0 disables skipping, e.g. 1e-3), until skipped for
+    # active_set_revisit iterations, or until the phi of their products
+    # shifts by more than active_set_shift_tol. All customers are updated
+    # every active_set_full_sweep iterations, and after a relative change of
+    # another global parameter larger than active_set_shift_tol
+    'active_set_tol': 0.0,
+    'active_set_revisit': 5,
+    'active_set_full_sweep': 20,
+    'active_set_shift_tol': 5e-2,
+    # Update of q(alpha_ib): 'gradient' (a gradient step with an adaptive
+    # step size) or 'newton' (a Newton step, halved at most
+    # newton_max_halvings times until the ELBO increases)
+    'q_alpha_method': 'gradient',
+    'newton_max_halvings': 10,
+    # Update sigma_sq_q_alpha_ib with a damped fixed-point step instead
+    # (moves log sigma_sq_q_alpha_ib a fraction sigma_sq_damping towards the
+    # fixed point, halved at most sigma_sq_max_halvings times until the ELBO
+    # increases)
+    'sigma_sq_fixed_point': False,
+    'sigma_sq_damping': 1.0,
+    'sigma_sq_max_halvings': 3,
     # Settings for adaptive step sizes
     'ss_factor': 1.125,
     'ss_min': 1e-6,
@@ -34,4 +78,53 @@ MISC = {
     'n_print_per': 1,
     'check_state_consistency': False,  # if True slows down code significantly
     'profile_code': False,
+    # Number of chunks of customers per thread in the local step
+    'n_chunks_per_thread': 4,
+    # Sum counts_phi per product, independent of the number of threads
+    'deterministic_counts_phi': True,
+    # Do not keep q(z) of all purchases, but add it to counts_phi per thread
+    # during the local step (ignores deterministic_counts_phi)
+    'stream_q_z': False,
+    # Save q(z) of all purchases as float32 with the variational state
+    'save_theta_q_z': False,
+    # Store the per-basket fields of the variational state interleaved per
+    # basket (see model.state.interleave_basket_state)
+    'interleave_basket_state': False,
+    # Floating point type of q(z), its entropy and the gathered log_phi in the
+    # local step: 'float64' or 'float32' (sums are always in float64). float32
+    # only saves memory: q(alpha) stays float64, and the conversions per
+    # purchase can make the local step slower (e.g. 20.5s vs 17.8s at M=100)
+    'local_precision': 'float64',
+}
+
+# STOCHASTIC VARIATIONAL INFERENCE (SVI) SETTINGS
+SVI = {
+    # Update the local parameters of a random mini-batch of batch_size
+    # customers per iteration, followed by a step on the global parameters
+    # towards their update from the mini-batch (see model.svi)
+    'enabled': False,
+    'batch_size': 1000,
+    # Step size (n + step_delay)^-step_forgetting in iteration n, with
+    # step_delay >= 1 and 0.5 < step_forgetting <= 1 (0 gives step size 1)
+    'step_delay': 1.0,
+    'step_forgetting': 0.7,
+    # Seed of the random mini-batches
+    'seed': 0,
+}
+
+# DISTRIBUTED SETTINGS
+DISTRIBUTED = {
+    # Number of worker processes that run the local step of a shard of the
+    # customers each (0 runs the local step in this process, see
+    # model.distributed)
+    'n_workers': 0,
+    # Number of the workers started on this machine, the others are started
+    # on other machines with: python -m model.worker -ADDRESS host:port
+    'n_local_workers': 0,
+    # Address on which the workers connect (port 0 picks a free port, which
+    # is only known to the local workers)
+    'host': 'localhost',
+    'port': 0,
+    # Number of numba threads per local worker (0 keeps numba's default)
+    'n_threads_per_worker': 0,
 }
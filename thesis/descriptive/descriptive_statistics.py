@@ -47,7 +47,7 @@ product_id_lowest_level = filtered_final_sample[['product_id', 'lowest_level']].
 # Count unique baskets for each top product
 basket_counts = {}
 for product_id in top_product_ids:
-    baskets_ith_product = y[y.iloc[:, 2] == product_id].iloc[:, 1].nunique()  # Assuming second column contains basket IDs
+    baskets_with_product = y[y.iloc[:, 2] == product_id].iloc[:, 1].nunique()  # Assuming second column contains basket IDs
     basket_counts[product_id] = baskets_with_product
 
 # Calculate percentages